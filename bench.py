@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import aiohttp
+import numpy as np
+
+import results
+import sender
+import tgi_stub
+import workload
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+BENCH_PORT = 18180
+
+# Event loop implementations the suite can run the clients on
+LOOPS = {'asyncio': asyncio.run}
+if uvloop is not None:
+    LOOPS['uvloop'] = uvloop.run
+
+# Sinks of the suite and their service time in seconds (see tgi_stub.FixedDelay)
+SINKS = {'zero': 0.0, 'delay': 0.05}
+RATES = [50, 100, 200, 500, 1000, 2000, 5000]
+CLIENTS = [1, 2]
+
+# A rate is sustained when the achieved send rate is within RATE_SHORTFALL of it, no request failed and
+# the p99 schedule lateness stays below MAX_LATENESS seconds
+RATE_SHORTFALL = 0.05
+MAX_LATENESS = 0.01
+
+# Every rate is run REPEATS times; a point holds the medians of its repeats, the spread (max - min) of its
+# p99 statistics, and is sustained when most repeats were
+REPEATS = 3
+SPREAD_STATS = ['lateness_p99', 'added_p99']
+
+# A check fails when a max sustained rate drops by more than TOLERANCE, or a median p99 latency at a rate
+# sustained both times grows by more than TOLERANCE plus SLACK seconds plus NOISE times the larger spread
+# of the two runs' repeats
+TOLERANCE = 0.2
+SLACK = 0.001
+NOISE = 2.0
+
+# Lead time for the client processes to start before the common start time of a run
+START_LEAD = 1.0
+
+
+async def dict_request(session, url, prompt, max_tokens, writer):
+    """The request path before payloads were pre-encoded: a dict JSON encoded per request, the reply parsed."""
+    payload = {"inputs": prompt, "parameters": {"max_new_tokens": max_tokens}}
+    start = time.time()
+    t_start = time.perf_counter_ns()
+    async with session.post(url, json=payload) as response:
+        await response.json()
+        rtt = (time.perf_counter_ns() - t_start) * 1e-9
+        writer.append((0, start, start + rtt, rtt, 0, 0.0, np.nan, np.nan, np.nan, -1, sender.queue_time(response),
+                       np.nan))
+
+
+async def encoded_request(session, url, body, writer):
+    await sender.send_request(session, url, False, writer, 0, body, 0.0)
+
+
+async def client_cpu(mode, url, trace, concurrency):
+    """Client CPU seconds and wall clock seconds to send every request of trace, concurrency at a time."""
+    prompts, max_tokens = trace['prompt'].tolist(), trace['max_tokens'].tolist()
+    writer = results.ResultWriter(None, capacity=len(trace) + 1)
+    conn = aiohttp.connector.TCPConnector(limit=1000, limit_per_host=1000)
+    async with aiohttp.ClientSession(connector=conn) as session:
+        # Warm up the connection pool outside the measurement
+        await asyncio.gather(*(dict_request(session, url, workload.PROMPTS[0], 1, writer) for _ in range(concurrency)))
+        cpu, wall = time.process_time(), time.perf_counter()
+        if mode == 'encoded':
+            bodies = sender.encode_payloads(trace)
+        for first in range(0, len(trace), concurrency):
+            last = min(first + concurrency, len(trace))
+            if mode == 'encoded':
+                await asyncio.gather(*(encoded_request(session, url, bodies[i], writer) for i in range(first, last)))
+            else:
+                await asyncio.gather(*(dict_request(session, url, workload.PROMPTS[prompts[i]], max_tokens[i], writer)
+                                       for i in range(first, last)))
+        return time.process_time() - cpu, time.perf_counter() - wall
+
+
+def payload_benchmark(args):
+    """Client CPU per request of the request path before and after payloads were pre-encoded."""
+    # A server without service time, so the client is all that is measured
+    server = tgi_stub.start_server_process(port=args.p, max_batch_size=100_000, decode_seconds=0.0,
+                                           prefill_seconds=0.0)
+    try:
+        if not tgi_stub.wait_until_ready(args.p):
+            raise SystemExit(1)
+        url = f"http://127.0.0.1:{args.p}/generate"
+        trace = workload.generate(np.random.default_rng(1), args.n, 1.0, args.t)
+        timings = {'dict': [], 'encoded': []}
+        for _ in range(args.r):
+            for mode in timings:
+                timings[mode].append(asyncio.run(client_cpu(mode, url, trace, args.c)))
+    finally:
+        tgi_stub.stop_server_process(server)
+
+    for mode, runs in timings.items():
+        cpu = min(c for c, _ in runs) / args.n
+        wall = min(w for _, w in runs) / args.n
+        print(f"{mode}: client CPU {cpu * 1e6:.1f} us/request, wall {wall * 1e6:.1f} us/request (best of {args.r})")
+    dict_cpu = min(c for c, _ in timings['dict'])
+    encoded_cpu = min(c for c, _ in timings['encoded'])
+    print(f"Pre-encoded payloads and discarded bodies save {(1 - encoded_cpu / dict_cpu) * 100:.1f}% client CPU")
+
+
+def bench_client(c, C, url, rate, num_requests, max_tokens, loop, start_at):
+    """Runs client c of C of a benchmark run in a worker process and returns its records."""
+    trace = sender.client_trace(c, C, sender.SEED_BASE, num_requests, C / rate, max_tokens)
+    time.sleep(max(0.0, start_at - time.time()))
+    return LOOPS[loop](sender.run_client(trace, url))
+
+
+def run_point(url, delay, rate, C, loop, duration, max_tokens, max_lateness=MAX_LATENESS):
+    """Sends rate requests per second for duration seconds from C client processes; returns its statistics."""
+    num_requests = max(int(rate * duration / C), 10)
+    start_at = time.time() + START_LEAD
+    with ProcessPoolExecutor(C) as pool:
+        records = np.concatenate(list(pool.map(bench_client, range(1, C + 1), [C] * C, [url] * C, [rate] * C,
+                                               [num_requests] * C, [max_tokens] * C, [loop] * C, [start_at] * C)))
+    ok = records['ok'] == 0
+    failed = int((~ok).sum())
+    span = records['start'].max() - records['start'].min() if len(records) > 1 else 0.0
+    # The rate the Poisson schedule actually asked for, which is only rate on average
+    intended_span = records['intended'].max() - records['intended'].min() if len(records) > 1 else 0.0
+    lateness = records['start'] - records['intended']
+    # What the client adds to the sink's service time: connection handling, the event loop and recording
+    added = records['rtt'][ok] - delay
+    point = {'rate': rate, 'requests': C * num_requests, 'failed': failed,
+             'target_rate': (len(records) - 1) / intended_span if intended_span > 0 else 0.0,
+             'achieved_rate': (len(records) - 1) / span if span > 0 else 0.0,
+             'lateness_mean': float(lateness.mean()) if len(records) else np.nan,
+             'lateness_p99': float(np.quantile(lateness, 0.99)) if len(records) else np.nan,
+             'added_p50': float(np.quantile(added, 0.5)) if len(added) else np.nan,
+             'added_p99': float(np.quantile(added, 0.99)) if len(added) else np.nan}
+    point['sustained'] = bool(failed == 0 and point['achieved_rate'] >= (1 - RATE_SHORTFALL) * point['target_rate']
+                              and point['lateness_p99'] <= max_lateness)
+    return point
+
+
+def median_point(repeats):
+    """One point from the repeats of a rate: the median of every statistic, and the spread of the p99s."""
+    point = {key: float(np.median([repeat[key] for repeat in repeats])) for key in repeats[0]
+             if key not in ('rate', 'requests', 'failed', 'sustained')}
+    point.update(rate=repeats[0]['rate'], requests=sum(repeat['requests'] for repeat in repeats),
+                 failed=sum(repeat['failed'] for repeat in repeats), repeats=len(repeats),
+                 sustained=2 * sum(repeat['sustained'] for repeat in repeats) > len(repeats))
+    for stat in SPREAD_STATS:
+        values = [repeat[stat] for repeat in repeats]
+        point[f'{stat}_spread'] = float(max(values) - min(values))
+    return point
+
+
+def format_point(point):
+    return (f"{point['rate']:g} req/s: achieved {point['achieved_rate']:.1f} req/s "
+            f"(target {point['target_rate']:.1f}), {point['failed']} failed, "
+            f"lateness p99 {point['lateness_p99'] * 1e3:.2f} ms, client-added latency "
+            f"p50 {point['added_p50'] * 1e3:.2f} ms p99 {point['added_p99'] * 1e3:.2f} ms"
+            f"{'' if point['sustained'] else ', not sustained'}")
+
+
+def run_suite(args):
+    """Runs every sink, loop and client count over the rates, each up to its first rate not sustained."""
+    suite = {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+             'machine': platform.machine(), 'cpus': os.cpu_count(), 'duration': args.d, 'max_tokens': args.t,
+             'repeats': args.i, 'rate_shortfall': RATE_SHORTFALL, 'max_lateness': args.x * 1e-3,
+             'configurations': []}
+    for sink in args.s:
+        delay = SINKS[sink]
+        server = tgi_stub.start_server_process(port=args.p, fixed_delay=delay)
+        try:
+            if not tgi_stub.wait_until_ready(args.p):
+                raise SystemExit(1)
+            url = f"http://127.0.0.1:{args.p}/generate"
+            for loop in args.l:
+                for C in args.C:
+                    points = []
+                    for rate in args.R:
+                        point = median_point([run_point(url, delay, rate, C, loop, args.d, args.t, args.x * 1e-3)
+                                              for _ in range(args.i)])
+                        points.append(point)
+                        print(f"{sink} sink, {loop}, C={C}, {format_point(point)}")
+                        if not point['sustained']:
+                            break
+                    sustained = [point['rate'] for point in points if point['sustained']]
+                    suite['configurations'].append({'sink': sink, 'delay': delay, 'loop': loop, 'C': C,
+                                                    'max_sustained_rate': max(sustained, default=0),
+                                                    'points': points})
+        finally:
+            tgi_stub.stop_server_process(server)
+    return suite
+
+
+def regressions(suite, baseline, tolerance=TOLERANCE, slack=SLACK, noise=NOISE):
+    """Describes every configuration of suite that is worse than the same configuration in baseline.
+
+    Beyond tolerance and slack, a p99 statistic may grow by noise times the larger spread of its repeats in
+    either run, so a difference within the run to run variation of the machine is not a regression.
+    """
+    found = []
+    configurations = {(conf['sink'], conf['loop'], conf['C']): conf for conf in suite['configurations']}
+    for base in baseline['configurations']:
+        key = (base['sink'], base['loop'], base['C'])
+        if key not in configurations:
+            continue
+        conf = configurations[key]
+        name = f"{base['sink']} sink, {base['loop']}, C={base['C']}"
+        if conf['max_sustained_rate'] < (1 - tolerance) * base['max_sustained_rate']:
+            found.append(f"{name}: max sustained rate {conf['max_sustained_rate']} req/s, "
+                         f"baseline {base['max_sustained_rate']} req/s")
+        points = {point['rate']: point for point in conf['points'] if point['sustained']}
+        for base_point in base['points']:
+            point = points.get(base_point['rate'])
+            if point is None or not base_point['sustained']:
+                continue
+            for stat in SPREAD_STATS:
+                spread = max(point.get(f'{stat}_spread', 0.0), base_point.get(f'{stat}_spread', 0.0))
+                if point[stat] > (1 + tolerance) * base_point[stat] + slack + noise * spread:
+                    found.append(f"{name}, {point['rate']:g} req/s: {stat} {point[stat] * 1e3:.2f} ms, "
+                                 f"baseline {base_point[stat] * 1e3:.2f} ms")
+    return found
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="load generator self-benchmark: sender.py against local sinks of "
+                                                 "known service time, to tell client limits from server limits")
+    parser.add_argument("-b", help="write the results as a baseline JSON file", type=str)
+    parser.add_argument("-C", help="client counts (1 2)", type=int, nargs='+', default=CLIENTS)
+    parser.add_argument("-c", help="payload benchmark: requests in flight at a time (50)", type=int, default=50)
+    parser.add_argument("-d", help="seconds per rate (3)", type=float, default=3)
+    parser.add_argument("-e", help=f"relative tolerance of the baseline check ({TOLERANCE})", type=float,
+                        default=TOLERANCE)
+    parser.add_argument("-i", help=f"repeats of every rate, summarized by their medians ({REPEATS})", type=int,
+                        default=REPEATS)
+    parser.add_argument("-k", help="check the results against this baseline JSON file, exit 1 on a regression",
+                        type=str)
+    parser.add_argument("-l", help=f"event loops ({' '.join(LOOPS)})", nargs='+', choices=list(LOOPS),
+                        default=list(LOOPS))
+    parser.add_argument("-n", help="payload benchmark: requests per mode and repetition (5_000)", type=int,
+                        default=5_000)
+    parser.add_argument("-P", help="run the payload encoding micro-benchmark instead of the suite",
+                        action="store_true")
+    parser.add_argument("-p", help=f"port of the sinks ({BENCH_PORT})", type=int, default=BENCH_PORT)
+    parser.add_argument("-R", help=f"send rates in requests per second ({' '.join(map(str, RATES))})", type=float,
+                        nargs='+', default=RATES)
+    parser.add_argument("-r", help="payload benchmark: repetitions, alternating the modes (3)", type=int, default=3)
+    parser.add_argument("-s", help=f"sinks ({' '.join(SINKS)})", nargs='+', choices=list(SINKS), default=list(SINKS))
+    parser.add_argument("-t", help="max output tokens, which sets the response size (200)", type=int, default=200)
+    parser.add_argument("-x", help=f"max p99 schedule lateness in ms of a sustained rate ({MAX_LATENESS * 1e3:g})",
+                        type=float, default=MAX_LATENESS * 1e3)
+    args = parser.parse_args()
+
+    if args.P:
+        payload_benchmark(args)
+        sys.exit(0)
+
+    suite = run_suite(args)
+    for conf in suite['configurations']:
+        print(f"{conf['sink']} sink, {conf['loop']}, C={conf['C']}: max sustained rate "
+              f"{conf['max_sustained_rate']:g} req/s")
+    if args.b:
+        print(f"Writing baseline to {args.b}")
+        with open(args.b, 'w') as f:
+            json.dump(suite, f, indent=1)
+    if args.k:
+        with open(args.k) as f:
+            found = regressions(suite, json.load(f), args.e)
+        for regression in found:
+            print(f"Regression: {regression}")
+        if found:
+            sys.exit(1)
+        print(f"No regression against {args.k}")
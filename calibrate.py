@@ -1,14 +1,22 @@
 import atexit
 import sys
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import subprocess
 import inspect
+from statistics import NormalDist
 
-import pandas as pd
+import numpy as np
+import requests
 import yaml
 import argparse
+import asyncio
+
+import metrics
+import runner
+import tgi_stub
+from queues import drift, mean_se
 
 
 def print_parameters():
@@ -19,34 +27,20 @@ def print_parameters():
 
 def run_experiment(poll_interval=5, q_fname="queue_size.csv", prom_url="http://localhost:9090/api/v1/query",
                    num_clients="1", num_requests_per_client=20_000, rt_fname="round_trips.csv", max_output_tokens=100,
-                   inf_url="http://127.0.0.1:8080/generate", mean_interarrival_micro_s=1_000_000):
+                   inf_url="http://127.0.0.1:8080/generate", mean_interarrival_micro_s=1_000_000,
+                   scrape_url=None, on_sample=None, stop=None, seed=1):
     print_parameters()
-    print(f"Starting metrics.py to {q_fname}")
-    metrics_args = ["python", "metrics.py", "-i", str(poll_interval), "-o", q_fname, "-u", prom_url]
-    metrics_process = subprocess.Popen(metrics_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    atexit.register(metrics_process.terminate)
-
-    sender_args = ["python", "sender.py", "-C", str(num_clients), "-n", str(num_requests_per_client), "-o",
-                   rt_fname, "-t", str(max_output_tokens), "-u",
-                   inf_url, "-w", str(mean_interarrival_micro_s)]
-
+    print(f"Running sender to {rt_fname} and collecting metrics to {q_fname}")
     try:
-        print(f"Running sender.py to {rt_fname}")
-        subprocess.run(sender_args, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"sender.py exited with an error: {e}")
-    finally:
-        print("Terminating metrics.py...")
-        metrics_process.terminate()
-
-        try:
-            metrics_process.wait(timeout=5)  # Wait for it to terminate
-            print("metrics.py terminated successfully.")
-        except subprocess.TimeoutExpired:
-            print("metrics.py did not terminate in time, killing it forcefully.")
-            metrics_process.kill()
-            atexit.unregister(metrics_process.terminate)
+        return runner.run_point_sync(inf_url=inf_url, num_clients=int(num_clients),
+                                     num_requests_per_client=num_requests_per_client,
+                                     mean_interarrival_micro_s=mean_interarrival_micro_s,
+                                     max_output_tokens=max_output_tokens, seed=seed, poll_interval=poll_interval,
+                                     scrape_url=scrape_url, prom_url=prom_url, rt_fname=rt_fname, q_fname=q_fname,
+                                     on_sample=on_sample, stop=stop)
+    except Exception as e:
+        print(f"sender exited with an error: {e}")
+        return None
 
 
 def ensure_docker_network_exists(network_name):
@@ -160,27 +154,131 @@ def wait_for_container(container_name, check_word='Connected', timeout=120):
         time.sleep(1)  # Check logs every second
 
 
-def load_df(r_fname, q_fname):
-    print(f'Reading from {r_fname}')
-    r_df = pd.read_csv(r_fname, names=['i', 'start', 'end', 'rtt', 'ok'])
-    r_df['start'] = pd.to_datetime(r_df['start'], unit="s")
-    r_df['end'] = pd.to_datetime(r_df['end'], unit="s")
-    first, last = r_df['start'].min(), r_df['start'].max()
-    interval = last - first
-    start, end = first + 0.1 * interval, first + 0.9 * interval
-    print(f'Reading from {q_fname}')
-    q_df = pd.read_csv(q_fname)
-    q_df['timestamp'] = pd.to_datetime(q_df['timestamp'], format='mixed')
-    q_df = q_df.loc[(q_df['timestamp'] >= start) & (q_df['timestamp'] <= end)]
-    q_df.index = q_df['timestamp']
-    q_df['in_service'] = q_df.queue_size + q_df.batch_current_size
-    return q_df
+class LiveTest:
+    """Sequential test of whether the server is over or under capacity, fed the queue samples of a run.
+
+    Over capacity the number in system grows: its drift is significantly above a small fraction of lambda
+    and, by Little's law, the mean sojourn L / lambda of the second half of the run exceeds the first
+    half's. Under capacity the drift is bounded by a small fraction of lambda. The stop event is set as
+    soon as either holds.
+
+    Over capacity the server is never idle, so lambda - drift is its service rate: mu and mu_se hold that
+    estimate, lambda being the arrival rate the server counted (request_rate) rather than the nominal one.
+
+    The test is repeated at every sample, so each look only gets the part of the error rate 1 - Phi(z) that
+    an O'Brien-Fleming type spending function allots to the samples since the last look, max_samples being
+    the samples of a full length run; by Bonferroni the looks together stay within 1 - Phi(z) per verdict.
+    """
+
+    def __init__(self, lam, stop, z=2.58, tol=0.05, min_samples=20, max_samples=30):
+        self.lam = lam
+        self.stop = stop
+        self.z = z
+        self.tol = tol
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.samples = []
+        self.verdict = None
+        self.slope, self.se = np.nan, np.nan
+        self.mu, self.mu_se = np.nan, np.nan
+        self.spent = 0.0
+        self.z_look = np.inf
+
+    def spending(self, fraction):
+        """Error rate spent by the given fraction of a full length run, 1 - Phi(z) by its end."""
+        alpha = 1 - NormalDist().cdf(self.z)
+        return 2 - 2 * NormalDist().cdf(NormalDist().inv_cdf(1 - alpha / 2) / np.sqrt(min(fraction, 1.0)))
+
+    def look_z(self):
+        """z of the test at this look, from the error rate spent since the last one."""
+        spent = self.spending(len(self.samples) / self.max_samples)
+        alpha, self.spent = spent - self.spent, spent
+        return NormalDist().inv_cdf(1 - alpha) if alpha > 0 else np.inf
+
+    def on_sample(self, sample):
+        self.samples.append(sample)
+        if self.verdict is None and len(self.samples) >= self.min_samples:
+            self.verdict = self.test()
+            if self.verdict:
+                print(f'lambda={self.lam:.3f}: {self.verdict} capacity after {len(self.samples)} samples, '
+                      f'drift {self.slope:.4f} +- {self.se:.4f} req/s (z {self.z_look:.2f})')
+                self.stop.set()
+
+    def test(self):
+        samples = np.array(self.samples)
+        # Skip the ramp up at the start of the run
+        samples = samples[max(2, len(samples) // 5):]
+        t = samples['timestamp']
+        in_service = samples['queue_size'] + samples['batch_current_size']
+        self.slope, self.se = drift(t, in_service)
+        half = len(samples) // 2
+        sojourn = [in_service[i].mean() / max(samples['request_rate'][i].mean(), 1e-9)
+                   for i in (slice(None, half), slice(half, None))]
+        arrivals, arrivals_se = mean_se(samples['request_rate'])
+        self.mu, self.mu_se = arrivals - self.slope, np.hypot(arrivals_se, self.se)
+        z = self.z_look = self.look_z()
+        if self.slope - z * self.se > self.tol * self.lam and sojourn[1] > (1 + self.tol) * sojourn[0]:
+            return 'over'
+        if self.slope + z * self.se < self.tol * self.lam:
+            return 'under'
+        return None
+
+
+def wait_for_idle(scrape_url=None, prom_url=metrics.PROMETHEUS_URL, poll_interval=1, timeout=600):
+    """Waits until the server has nothing queued or in its batch, so a run does not start on the backlog
+    left by an overloaded one that was stopped early."""
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            if scrape_url:
+                samples = metrics.parse_exposition(requests.get(scrape_url, timeout=5).text)
+                in_service = samples.get('tgi_queue_size', 0) + samples.get('tgi_batch_current_size', 0)
+            else:
+                query_time = datetime.now(timezone.utc).isoformat()
+                in_service = sum(metrics.query_prometheus(metric, query_time)[1] or 0
+                                 for metric in metrics.METRICS[:2])
+            if in_service == 0:
+                return True
+            print(f'waiting for {in_service:.0f} requests to drain...')
+        except requests.RequestException as e:
+            print(f'Error polling {scrape_url or prom_url}: {e}')
+        time.sleep(poll_interval)
+    print('Timeout waiting for the server to drain.')
+    return False
+
+
+def saturation_estimate(estimates, z=1.96):
+    """Inverse variance weighted mean of the service rate estimates of overloaded runs and its CI."""
+    mu, se = np.array(estimates).T
+    weights = 1 / np.maximum(se, 1e-9) ** 2
+    mean = (weights * mu).sum() / weights.sum()
+    half_width = z / np.sqrt(weights.sum())
+    return mean, mean - half_width, mean + half_width
+
+
+def next_lambda(lam, verdict, k, estimates, low, high, gain=0.5, tol=0.05):
+    """Robbins-Monro step towards the rate at which a run is as likely over as under capacity.
+
+    The step is taken from the current saturation estimate when overloaded runs gave one (a run over
+    capacity measures the service rate directly as lambda - drift), otherwise from the last lambda; it
+    shrinks as gain / k and the result is kept strictly inside the bracket [low, high]. Returns None once
+    the bracket is narrower than tol.
+    """
+    if high <= low * (1 + tol) ** 2:
+        return None
+    center = saturation_estimate(estimates)[0] if estimates else lam
+    step = np.exp(-gain / k * ((verdict == 'over') - 0.5) * 2)
+    return float(np.clip(center * step, low * (1 + tol), high / (1 + tol)))
 
 
 # Main process
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="experiment runner")
+    parser.add_argument("-l", help="run against the local TGI stand-in (tgi_stub.py) instead of the docker container",
+                        action="store_true")
+    parser.add_argument("-s", help="scrape the TGI /metrics endpoint directly instead of querying prometheus",
+                        action="store_true")
     parser.add_argument("-c", help="config file name (calibrate.yaml)", type=str, default='calibrate.yaml')
 
     args = parser.parse_args()
@@ -189,65 +287,113 @@ if __name__ == "__main__":
 
     with open(config_file, "r") as file:
         config = yaml.safe_load(file)
+    # Service model of the stand-in server (decode_seconds, decode_slope_seconds, prefill_seconds)
+    stub_config = config.get('stub', {})
+    scrape_url = "http://127.0.0.1:8080/metrics" if args.s else None
 
     date_dname = f'data_{datetime.now().strftime("%d%b")}_cal'
     if not os.path.exists(date_dname):
         os.makedirs(date_dname)
 
-    max_batch_size = config.get('batch_sizes', 1)
+    max_batch_size = config.get('batch_size', 1)
     num_clients = 1
     max_output_tokens = config.get('max_output_tokens', 200)
     min_lambda = config.get('min_lambda', 0.1)
     max_lambda = config.get('max_lambda', 4.0)
 
-    high = int(1_000 / min_lambda) * 1_000
-    low = int(1_000 / max_lambda) * 1_000
     delta = config.get('delta', 2)
-
-    atexit.register(stop_and_remove_container, 'tgis')
-
-    container_name = run_docker_container(max_batch_size=max_batch_size)
-    if container_name is None:
-        print('failed to start container!')
-        sys.exit(1)
-
-    print(f'waiting for container with max-batch-size={max_batch_size} to be ready...')
-    ok = wait_for_container(container_name)
-    if not ok:
-        print('failed to start tgi server')
-        sys.exit(2)
-
-    tol = 1e2
-
-    while True:
-        w = int(0.5 * (low + high))
-
-        n = max(60, 1 * 60 * 1_000_000 // w // num_clients)
+    # Longest run, in seconds, when the live test stays undecided
+    max_duration = config.get('max_duration', 60)
+    max_runs = config.get('max_runs', 10)
+    # Relative tolerance of the search and z-score of the live test
+    tol = config.get('tolerance', 0.05)
+    z = config.get('z', 2.58)
+    min_samples = config.get('min_samples', 20)
+
+    if args.l:
+        container_name = None
+        server = tgi_stub.start_server_process(max_batch_size=max_batch_size, **stub_config)
+        atexit.register(server.terminate)
+        print(f'waiting for stand-in with max-batch-size={max_batch_size} to be ready...')
+        if not tgi_stub.wait_until_ready():
+            print('failed to start tgi stand-in')
+            tgi_stub.stop_server_process(server)
+            sys.exit(2)
+    else:
+        server = None
+        atexit.register(stop_and_remove_container, 'tgis')
+
+        container_name = run_docker_container(max_batch_size=max_batch_size)
+        if container_name is None:
+            print('failed to start container!')
+            sys.exit(1)
+
+        print(f'waiting for container with max-batch-size={max_batch_size} to be ready...')
+        ok = wait_for_container(container_name)
+        if not ok:
+            print('failed to start tgi server')
+            sys.exit(2)
+
+    lam = max_lambda
+    low, high = min_lambda, max_lambda
+    estimates = []
+    # Runs in a row that ended without enough samples to test
+    untested = 0
+
+    for k in range(1, max_runs + 1):
+        w = int(1_000_000 / lam)
+
+        n = max(60, int(max_duration * 1_000_000) // w // num_clients)
         name_part = f'MB_{max_batch_size}_C{num_clients}_w{w}_t{max_output_tokens}_n{n}_d{delta}'
         q_fname = f'{date_dname}/queue_size_{name_part}.csv'
         rt_fname = f'{date_dname}/round_trips_{name_part}.csv'
-        run_experiment(q_fname=q_fname, num_clients=num_clients, num_requests_per_client=n,
-                       max_output_tokens=max_output_tokens, poll_interval=delta,
-                       mean_interarrival_micro_s=w, rt_fname=rt_fname)
-
-        df = load_df(rt_fname, q_fname)
-        mean_batch = df.batch_current_size.mean()
-        mean_queue = df.queue_size.mean()
-        mean_srvc = df.in_service.mean()
-        zeros = df.in_service.loc[df.in_service==0]
-        num_zeros = zeros.size
-        print(f'w={w} low={low} high={high} num_zeros={num_zeros}')
-
-        if num_zeros > 0:
-            high = w
-            w = (low + high) / 2
-        elif high - low < tol:
-            print(f'final inter-arrival time {w} final lambda {1_000_000 / w}')
+        wait_for_idle(scrape_url)
+        live = LiveTest(lam, asyncio.Event(), z, tol, min_samples, max(min_samples, int(n * w / 1_000_000 / delta)))
+        result = run_experiment(q_fname=q_fname, num_clients=num_clients, num_requests_per_client=n,
+                                max_output_tokens=max_output_tokens, poll_interval=delta,
+                                mean_interarrival_micro_s=w, rt_fname=rt_fname, scrape_url=scrape_url,
+                                on_sample=live.on_sample, stop=live.stop, seed=k)
+        if result is None:
+            print(f'run at lambda={lam:.3f} failed')
             break
+
+        _, samples = result
+        verdict = live.verdict
+        if verdict is None and np.isnan(live.slope):
+            # Too few samples to test: no evidence either way, so the bracket stays as it is
+            untested += 1
+            if untested > 1:
+                print(f'lambda={lam:.3f}: too few samples to test twice in a row, stopping the search')
+                break
+            print(f'lambda={lam:.3f}: too few samples to test, running it again')
+            continue
+        untested = 0
+        if verdict is None:
+            # The run went the full length without a clear answer: it is close to capacity
+            verdict = 'over' if live.slope > live.z * live.se else 'under'
+            print(f'lambda={lam:.3f}: no early decision, taking {verdict} capacity')
+        if verdict == 'over':
+            estimates.append((live.mu, live.mu_se))
+            high = min(high, lam)
         else:
-            low = w
-            w = (low + high) / 2
+            low = max(low, lam)
+        duration = samples['timestamp'].max() - samples['timestamp'].min() if len(samples) else 0.0
+        print(f'run {k}: lambda={lam:.3f} {verdict} after {duration:.1f}s low={low:.3f} high={high:.3f}')
+
+        lam = next_lambda(lam, verdict, k, estimates, low, high, tol=tol)
+        if lam is None:
+            break
+
+    if estimates:
+        mu, mu_low, mu_high = saturation_estimate(estimates)
+        print(f'saturation rate {mu:.3f} req/s, 95% CI [{mu_low:.3f}, {mu_high:.3f}], '
+              f'bracketed by runs in [{low:.3f}, {high:.3f}], final inter-arrival time {int(1_000_000 / mu)}us')
+    else:
+        print(f'no run overloaded the server: saturation rate above {low:.3f} req/s')
 
+    if server:
+        tgi_stub.stop_server_process(server)
+        atexit.unregister(server.terminate)
     if container_name:
         stop_and_remove_container(container_name)
         time.sleep(10)
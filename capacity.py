@@ -0,0 +1,306 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import estimation
+import queues
+import store
+
+# Experiments sharing a configuration ran the same model and prompt lengths, only MB and the load differ
+CONFIG_KEYS = ['date', 't']
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+MODEL_KEYS = ['mu1', 'kappa', 'S1', 'c', 'tail']
+
+# Grids searched for the service rate of one batch slot (in units of 1 / the fastest mean latency) and
+# the batch slowdown
+RATE_FACTORS = np.geomspace(0.05, 20, 161)
+SLOWDOWNS = np.linspace(0.0, 1.0, 41)
+
+# A run is overloaded when its latency rises significantly, by more than this fraction of its mean, or
+# when it completed fewer requests than it sent by more than this fraction (when a client connection
+# limit keeps the number in flight and so the latency from growing)
+OVERLOAD_RISE = 0.5
+OVERLOAD_SHORTFALL = 0.1
+# Runs whose mean latency is off by more than OUTLIER_Z robust standard deviations and this fraction
+OUTLIER_Z = 3.0
+OUTLIER_ERROR = 0.1
+
+
+def observe(row, store_dname=store.STORE_DNAME, z=2.58):
+    """Offered load, latency, number in flight and overload verdict of one experiment's trimmed window."""
+    q_df, r_df, raw_r_df = store.load_row(row, store_dname)
+    if 'ok' in r_df:
+        r_df = r_df[r_df['ok'] == 0]
+    if len(r_df) < 3:
+        return None
+    rtt = r_df['rtt'].to_numpy()
+    lam = estimation.get_lam(row['C'], row['w'])
+    if 'start' in r_df:
+        t = queues.nanoseconds(r_df['start']) * 1e-9
+        times, q = queues.in_flight(raw_r_df['start'], raw_r_df['end'])
+        window_start, window_end = r_df['start'].min(), r_df['start'].max()
+        L = queues.time_weighted_mean(times, q, window_start, window_end)
+        # Completions over the window shifted by the mean latency, so a stable run completes what it sent
+        lag = pd.Timedelta(seconds=rtt.mean())
+        ends = raw_r_df['end']
+        shortfall = 1 - ((ends >= window_start + lag) & (ends < window_end + lag)).sum() / len(r_df)
+    else:
+        # Only the round trip times were kept, in the order the requests were sent
+        t = np.arange(len(rtt), dtype=float)
+        L = lam * rtt.mean()
+        shortfall = 0.0
+    slope, se = queues.drift(t - t[0], rtt)
+    rising = slope - z * se > 0 and slope * (t[-1] - t[0]) > OVERLOAD_RISE * rtt.mean()
+    overloaded = rising or shortfall > OVERLOAD_SHORTFALL
+    return dict(lam=lam, W=rtt.mean(), W99=np.quantile(rtt, 0.99), L=L, overloaded=overloaded, requests=len(rtt))
+
+
+def observe_sweep(catalog, store_dname=store.STORE_DNAME):
+    """One row per experiment with its parameters and observations; experiments without a known MB are kept
+    but not fitted."""
+    rows = []
+    for _, row in catalog.iterrows():
+        observed = observe(row, store_dname)
+        if observed is not None:
+            rows.append(dict(**{key: row[key] for key in ['date', 'name'] + store.PARAMETERS}, **observed))
+    return pd.DataFrame(rows)
+
+
+def capacity(mu1, kappa, B):
+    """Requests per second a server with max batch size B completes when saturated.
+
+    A batch of b requests takes 1 + kappa * (b - 1) times as long per token as a single request, so
+    kappa = 0 is perfect batching and kappa = 1 no gain at all.
+    """
+    return mu1 * B / (1 + kappa * (B - 1))
+
+
+def model_terms(lam, B, mu1, kappa):
+    """Utilization, service time relative to a lone request's and P-K waiting time per unit of
+    (1 + cs^2) / 2, at arrival rate lam."""
+    mu = capacity(mu1, kappa, B)
+    rho = lam / mu
+    # Requests are served alongside rho * B others on average, each slowing the decode down by kappa
+    slowdown = 1 + kappa * (np.clip(rho * B, 1, B) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(rho < 1, rho / (mu * (1 - rho)), np.inf)
+    return rho, slowdown, x
+
+
+def predict(model, lam, B, p=0.99):
+    """Mean and p-quantile latency, number in the system and number queued of a fitted model.
+
+    model holds the columns mu1, S1, kappa, c and tail (or scalars); lam and B broadcast against them. The
+    queueing delay of an M/G/1 queue is approximately exponential, with probability rho of waiting at all,
+    and the service time quantile is tail times its mean.
+    """
+    rho, slowdown, x = model_terms(lam, B, model['mu1'], model['kappa'])
+    S = model['S1'] * slowdown
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Wq = np.where(x > 0, model['c'] * x, 0.0)
+        Wq_p = np.where(rho > 1 - p, Wq / rho * np.log(rho / (1 - p)), 0.0)
+    W = S + Wq
+    return dict(rho=rho, W=W, Wp=model['tail'] * S + Wq_p, L=lam * W, Lq=lam * Wq)
+
+
+def fit_candidates(lam, B, W, stable, g, mu1, kappa):
+    """Sum of squared relative errors of every candidate (mu1, kappa) [K, G] for each configuration.
+
+    For a candidate, the mean latency S1 * slowdown + c * x is linear in S1 and c, so the best S1 and
+    c >= 0 follow from weighted least squares in closed form. A stable run predicted overloaded rules the
+    candidate out, an overloaded run predicted stable costs as much as a 100% error.
+    Returns (sse, S1, c), each [K, G].
+    """
+    onehot = np.zeros((len(g), mu1.shape[1]))
+    onehot[np.arange(len(g)), g] = 1
+    rho, a, x = model_terms(lam, B, mu1[:, g], kappa[:, g])
+    w = np.where(stable, 1 / W ** 2, 0.0)
+    feasible = np.isfinite(x)
+    x = np.where(feasible, x, 0.0)
+    saa, sax, sxx = (w * a * a) @ onehot, (w * a * x) @ onehot, (w * x * x) @ onehot
+    say, sxy, syy = (w * a * W) @ onehot, (w * x * W) @ onehot, (w * W * W) @ onehot
+    det = saa * sxx - sax * sax
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S1 = (sxx * say - sax * sxy) / det
+        c = (saa * sxy - sax * say) / det
+        # Without load to tell them apart, or if queueing would have to shorten latency, S1 explains it all;
+        # if S1 would have to be negative, queueing does
+        alone = ~(det > 1e-12 * saa * sxx) | (c < 0)
+        S1 = np.where(alone, say / saa, S1)
+        c = np.where(alone, 0.0, c)
+        queued = S1 < 0
+        S1 = np.where(queued, 0.0, S1)
+        c = np.where(queued, np.maximum(sxy / sxx, 0.0), c)
+    sse = syy - 2 * S1 * say - 2 * c * sxy + S1 * S1 * saa + 2 * S1 * c * sax + c * c * sxx
+    infeasible = (stable & ~feasible) @ onehot
+    mismatched = (~stable & feasible) @ onehot
+    return np.where(infeasible > 0, np.inf, sse + mismatched), S1, c
+
+
+def fit(points, batch_sizes=BATCH_SIZES):
+    """Fits the batch service model to every configuration of the sweep at once.
+
+    Each configuration gets the service rate mu1 of one batch slot, a batch slowdown kappa, the latency S1
+    of a lone request, the P-K variability factor c = (1 + cs^2) / 2 and a service time tail ratio.
+    (mu1, kappa) come from a grid search vectorized over all candidates and configurations, refined once
+    around the best candidate. kappa is only identified by runs at two batch sizes or more; with one, the
+    search holds it at 0, so mu1 is the service rate per slot at that batch size, and it is reported as NaN.
+    Returns the model per configuration and the points with their predictions and outlier flags.
+    """
+    points = points.copy()
+    fitted = points[points['MB'] > 0]
+    g = fitted.groupby(CONFIG_KEYS, sort=True).ngroup().to_numpy()
+    configs = fitted.drop_duplicates(CONFIG_KEYS).sort_values(CONFIG_KEYS)[CONFIG_KEYS].reset_index(drop=True)
+    lam, B, W = fitted['lam'].to_numpy(), fitted['MB'].to_numpy(float), fitted['W'].to_numpy()
+    stable = ~fitted['overloaded'].to_numpy(bool)
+    # A configuration without a stable run has nothing to fit its service time to
+    has_stable = np.bincount(g[stable], minlength=len(configs)) > 0
+    W_min = np.array([W[(g == k) & stable].min() if has_stable[k] else 1.0 for k in range(len(configs))])
+    identified = np.array([len(np.unique(B[g == k])) > 1 for k in range(len(configs))])
+
+    mu1 = np.outer(RATE_FACTORS, 1 / W_min).repeat(len(SLOWDOWNS), axis=0)
+    kappa = np.tile(SLOWDOWNS, len(RATE_FACTORS))[:, None].repeat(len(configs), axis=1) * identified
+    cols = np.arange(len(configs))
+    for refine in range(2):
+        sse, S1, c = fit_candidates(lam, B, W, stable, g, mu1, kappa)
+        best = np.argmin(np.where(np.isnan(sse), np.inf, sse), axis=0)
+        mu1_best, kappa_best = mu1[best, cols], kappa[best, cols]
+        if refine:
+            break
+        # A finer grid spanning one coarse step either side of the best candidate
+        step = RATE_FACTORS[1] / RATE_FACTORS[0]
+        factors = np.geomspace(1 / step, step, 21)
+        slowdowns = np.linspace(-1, 1, 21) * (SLOWDOWNS[1] - SLOWDOWNS[0])
+        mu1 = np.outer(factors, mu1_best).repeat(len(slowdowns), axis=0)
+        kappa = np.clip(np.tile(slowdowns, len(factors))[:, None] + kappa_best, 0.0, 1.0) * identified
+
+    models = configs.copy()
+    models['mu1'] = mu1_best
+    models['kappa'] = np.where(identified, kappa_best, np.nan)
+    models['S1'] = S1[best, cols]
+    models['c'] = c[best, cols]
+    models['sse'] = sse[best, cols]
+    models['points'] = np.bincount(g, minlength=len(configs))
+    # Predictions beyond the highest stable load observed are extrapolations
+    models['max_stable_rate'] = [lam[(g == k) & stable].max() if has_stable[k] else np.nan
+                                 for k in range(len(configs))]
+    models['batch_sizes'] = [sorted(set(fitted['MB'][g == k])) for k in range(len(configs))]
+    # Service time tail from the least loaded stable run, where round trips are mostly service
+    tail = []
+    for k in range(len(configs)):
+        mine = fitted[(g == k) & stable]
+        lightest = mine.loc[mine['lam'].idxmin()] if len(mine) else None
+        tail.append(lightest['W99'] / lightest['W'] if lightest is not None else np.nan)
+    models['tail'] = tail
+    models.loc[~np.isfinite(models['sse']) | ~has_stable, ['mu1', 'kappa', 'S1', 'c', 'tail']] = np.nan
+    for B_ in batch_sizes:
+        models[f'mu_{B_}'] = np.where(observed_range(models, B_), capacity(models['mu1'], fitted_kappa(models), B_),
+                                      np.nan)
+
+    model = models.iloc[g]
+    predicted = predict(dict({key: model[key].to_numpy() for key in MODEL_KEYS}, kappa=fitted_kappa(model)), lam, B)
+    points['rho'] = np.nan
+    points['W_fit'] = np.nan
+    points['W99_fit'] = np.nan
+    points['L_fit'] = np.nan
+    points.loc[fitted.index, 'rho'] = predicted['rho']
+    points.loc[fitted.index, 'W_fit'] = predicted['W']
+    points.loc[fitted.index, 'W99_fit'] = predicted['Wp']
+    points.loc[fitted.index, 'L_fit'] = predicted['L']
+    points['flag'] = np.where(points['MB'] > 0, '', 'unknown_batch')
+    points.loc[fitted.index[~stable & (predicted['rho'] < 1)], 'flag'] = 'overload'
+    points.loc[fitted.index[stable & ~(predicted['rho'] < 1)], 'flag'] = 'stability'
+    # Robust z scores of the log latency errors of the stable runs
+    checked = fitted.index[stable & (predicted['rho'] < 1)]
+    error = np.log(points.loc[checked, 'W'] / points.loc[checked, 'W_fit'])
+    mad = 1.4826 * np.median(np.abs(error - error.median()))
+    points['z'] = np.nan
+    if mad > 0:
+        points.loc[checked, 'z'] = (error - error.median()) / mad
+    deviates = (points['z'].abs() > OUTLIER_Z) & ((points['W'] / points['W_fit'] - 1).abs() > OUTLIER_ERROR)
+    points.loc[deviates, 'flag'] = 'residual'
+    return models, points
+
+
+def fitted_kappa(models):
+    """kappa as used by the fit: 0 where it is not identified, which only holds at the one batch size observed."""
+    return np.nan_to_num(np.asarray(models['kappa'], dtype=float), nan=0.0)
+
+
+def observed_range(models, B):
+    """Whether batch size B lies within the batch sizes each model was fitted to."""
+    return np.array([min(sizes) <= B <= max(sizes) for sizes in models['batch_sizes']], dtype=bool)
+
+
+def max_rate(models, B, slo, p=0.99, iterations=60):
+    """Largest arrival rate whose predicted latency stays within slo seconds, per model, by bisection on rho.
+
+    The latency is the p-quantile, or the mean when p is None. Zero when even a lone request misses the slo,
+    NaN when B lies outside the batch sizes the model was fitted to.
+    """
+    params = dict({key: models[key].to_numpy() for key in MODEL_KEYS}, kappa=fitted_kappa(models))
+    mu = capacity(params['mu1'], params['kappa'], B)
+    low, high = np.zeros(len(models)), np.ones(len(models))
+    for _ in range(iterations):
+        rho = (low + high) / 2
+        predicted = predict(params, rho * mu, B, p or 0.5)
+        ok = (predicted['W'] if p is None else predicted['Wp']) <= slo
+        low, high = np.where(ok, rho, low), np.where(ok, high, rho)
+    return np.where(observed_range(models, B), low * mu, np.nan)
+
+
+def recommend(models, slo, p=0.99, batch_sizes=BATCH_SIZES):
+    """Max safe arrival rate of every configuration and batch size, and the batch size allowing the most.
+
+    Rates above the configuration's max_stable_rate rest on the model alone; batch sizes outside those the
+    configuration ran at are not extrapolated to, and not recommended.
+    """
+    rates = pd.DataFrame({B: max_rate(models, B, slo, p) for B in batch_sizes}, index=models.index)
+    table = models[CONFIG_KEYS + ['max_stable_rate']].copy()
+    for B in batch_sizes:
+        table[f'max_rate_{B}'] = rates[B]
+    fitted = rates.notna().any(axis=1)
+    table['MB'] = np.nan
+    table['max_rate'] = np.nan
+    # The first of equally good batch sizes is the smallest
+    table.loc[fitted, 'MB'] = rates[fitted].idxmax(axis=1)
+    table.loc[fitted, 'max_rate'] = rates[fitted].max(axis=1)
+    return table
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="queueing model fit and capacity planning over a sweep")
+    parser.add_argument("dates", help="dates (data directory suffixes) to fit, all by default", nargs='*')
+    parser.add_argument("-l", help="latency SLO in seconds to recommend a batch size and max rate for", type=float)
+    parser.add_argument("-o", help="output file prefix (capacity)", type=str, default='capacity')
+    parser.add_argument("-p", help="latency percentile the SLO applies to, 0 for the mean (99)", type=float,
+                        default=99)
+    parser.add_argument("-s", help="store directory (store)", type=str, default=store.STORE_DNAME)
+    args = parser.parse_args()
+
+    catalog = store.select(store.read_catalog(args.s), date=args.dates or None)
+    t0 = time.perf_counter()
+    points = observe_sweep(catalog, args.s)
+    t1 = time.perf_counter()
+    models, points = fit(points)
+    t2 = time.perf_counter()
+    print(f"Observed {len(points)} experiments in {t1 - t0:.2f}s, fitted {len(models)} configurations in "
+          f"{t2 - t1:.2f}s")
+    print(models.drop(columns=['sse']).to_string(index=False, float_format='{:.4g}'.format))
+    flagged = points[~points['flag'].isin(['', 'unknown_batch'])]
+    print(f"{len(flagged)} experiments deviate from the fitted model")
+    if len(flagged):
+        print(flagged[['date', 'name', 'lam', 'W', 'W_fit', 'rho', 'overloaded', 'flag']].to_string(
+            index=False, float_format='{:.4g}'.format))
+    models.to_csv(f'{args.o}_models.csv', index=False)
+    points.to_csv(f'{args.o}_points.csv', index=False)
+
+    if args.l:
+        p = args.p / 100 if args.p else None
+        table = recommend(models, args.l, p)
+        print(f"Max arrival rate (req/s) meeting a {'mean' if p is None else f'p{args.p:g}'} latency of "
+              f"{args.l:g}s:")
+        print(table.to_string(index=False, float_format='{:.4g}'.format))
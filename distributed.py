@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import functools
+import io
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+import yaml
+from aiohttp import web
+
+import sender
+import tgi_stub
+import workload
+from histogram import LatencyHistogram, format_summary, histogram_fname
+from results import export_csv, records_fname
+
+AGENT_PORT = 9100
+
+# Ping exchanges per agent to estimate its clock offset
+NUM_PINGS = 16
+
+# The run starts this long after the last agent was pinged, so every agent has its task by then
+START_LEAD_SECONDS = 2.0
+
+# Added to the agent's clock, only to test the offset correction with agents on one host
+SKEW = 0.0
+
+# Columns of a record that hold wall clock times of the machine that sent the request
+CLOCK_COLUMNS = ['start', 'end', 'intended']
+
+
+def clock():
+    """Wall clock time of this agent."""
+    return time.time() + SKEW
+
+
+def estimate_offset(samples):
+    """NTP style clock offset of an agent from ping exchanges.
+
+    Each sample is (t1, t2, t3, t4): coordinator send, agent receive, agent send and coordinator receive
+    time. The offset ((t2 - t1) + (t3 - t4)) / 2 is exact when both legs take equally long and off by at
+    most half the round trip delay (t4 - t1) - (t3 - t2) otherwise, so the sample with the least delay is
+    used. Returns the agent's clock minus the coordinator's and that sample's round trip delay, in seconds.
+    """
+    t1, t2, t3, t4 = np.asarray(samples, dtype=float).T
+    delay = (t4 - t1) - (t3 - t2)
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    best = np.argmin(delay)
+    return float(offset[best]), float(delay[best])
+
+
+def npy_bytes(array):
+    buf = io.BytesIO()
+    np.save(buf, array, allow_pickle=False)
+    return buf.getvalue()
+
+
+class Agent:
+    """Runs the sender engine for a coordinator, one run at a time.
+
+    POST /run takes a task (see coordinate), waits until its start time on this agent's clock, sends the
+    requests and answers with their records as .npy; GET /histogram then gives the run's latency
+    histogram. GET /ping answers with the agent's clock for the offset estimation.
+    """
+
+    def __init__(self, shards=1):
+        self.shards = shards
+        self.lock = asyncio.Lock()
+        self.histogram = LatencyHistogram()
+
+    async def ping(self, request):
+        t2 = clock()
+        return web.json_response({'t2': t2, 't3': clock()})
+
+    async def health(self, request):
+        return web.Response()
+
+    async def run(self, request):
+        task = await request.json()
+        async with self.lock:
+            trace = sender.client_trace(task['c'], task['C'], task['seed'], task['num_requests'],
+                                        task['mean_wait_time_seconds'], task['max_tokens'], arrival=task['arrival'])
+            users = workload.closed_users(task['arrival'])
+            delay = task['start_at'] - clock()
+            print(f"Sending {len(trace)} requests to {task['url']} as client {task['c']} of {task['C']} "
+                  f"in {delay:.3f} seconds", flush=True)
+            # Scheduled from a monotonic epoch, so the wait does not add to the first request's lateness
+            if self.shards > 1:
+                records = await asyncio.get_running_loop().run_in_executor(
+                    None, functools.partial(sender.run_sharded, trace, self.shards, task['url'], task['stream'],
+                                            users=users, seed=[task['seed'], task['c']],
+                                            overload=task.get('overload'), epoch=time.monotonic() + delay))
+            else:
+                records = await sender.run_client(trace, task['url'], task['stream'], users=users,
+                                                  epoch=time.monotonic() + delay, overload=task.get('overload'))
+            for column in CLOCK_COLUMNS:
+                records[column] += SKEW
+            self.histogram = LatencyHistogram().observe_records(records)
+        print(f"Sent {len(records)} requests: {format_summary(self.histogram.summary())}", flush=True)
+        return web.Response(body=npy_bytes(records), content_type='application/octet-stream')
+
+    async def get_histogram(self, request):
+        buf = io.BytesIO()
+        self.histogram.save(buf)
+        return web.Response(body=buf.getvalue(), content_type='application/octet-stream')
+
+    def app(self):
+        app = web.Application(client_max_size=1 << 20)
+        app.add_routes([web.get('/ping', self.ping), web.get('/health', self.health), web.post('/run', self.run),
+                        web.get('/histogram', self.get_histogram)])
+        return app
+
+
+async def ping_agent(session, agent, num_pings=NUM_PINGS):
+    """Clock offset and round trip delay of an agent (see estimate_offset)."""
+    samples = []
+    for _ in range(num_pings):
+        t1 = time.time()
+        async with session.get(f'http://{agent}/ping') as response:
+            reply = await response.json()
+        t4 = time.time()
+        samples.append((t1, reply['t2'], reply['t3'], t4))
+    return estimate_offset(samples)
+
+
+async def run_agent(session, agent, task, offset):
+    """Runs a task on an agent; returns its records and histogram moved to the coordinator's clock."""
+    async with session.post(f'http://{agent}/run', json=task) as response:
+        response.raise_for_status()
+        records = np.load(io.BytesIO(await response.read()), allow_pickle=False)
+    async with session.get(f'http://{agent}/histogram') as response:
+        response.raise_for_status()
+        histogram = LatencyHistogram.load(io.BytesIO(await response.read()))
+    for column in CLOCK_COLUMNS:
+        records[column] -= offset
+    histogram.first_start -= offset
+    histogram.last_end -= offset
+    return records, histogram
+
+
+async def coordinate(agents, url=sender.INFERENCE_URL, num_requests=sender.NUM_REQUESTS,
+                     mean_wait_time_seconds=sender.MEAN_WAIT_TIME_SECONDS, max_tokens=None, seed=sender.SEED_BASE,
+                     arrival=None, stream=False, shares=None, fname=None, num_pings=NUM_PINGS, overload=None):
+    """Runs one load generation run over several agents and merges their results on this machine's clock.
+
+    Agent k is client k of the run (see sender.client_trace) with share k of the requests and of the
+    aggregate rate 1 / mean_wait_time_seconds (equal shares by default), on its own random stream of the
+    seed, so the agents' Poisson streams superpose to one of the aggregate rate; closed loop users are
+    divided by the same shares. Every agent runs in the given overload mode (see sender.Overload). Every
+    agent's clock offset is estimated first, so that all agents start at the same time and their records
+    and histograms are corrected to the coordinator's clock. Returns the merged records, sorted by send
+    time and numbered in that order, and the merged histogram; with fname they are written as one record
+    stream, round trip CSV and histogram.
+    """
+    shares = np.full(len(agents), 1.0) if shares is None else np.asarray(shares, dtype=float)
+    shares = shares / shares.sum()
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        offsets = []
+        for agent in agents:
+            offset, delay = await ping_agent(session, agent, num_pings)
+            print(f"Agent {agent}: clock offset {offset * 1e3:+.3f} ms (+/- {delay / 2 * 1e3:.3f} ms)")
+            offsets.append(offset)
+
+        start_at = time.time() + START_LEAD_SECONDS
+        tasks = []
+        for k, (agent, share, offset) in enumerate(zip(agents, shares, offsets)):
+            agent_arrival = arrival
+            if workload.closed_users(arrival):
+                agent_arrival = dict(arrival, users=max(1, round(workload.closed_users(arrival) * share)))
+            task = {'url': url, 'c': k + 1, 'C': len(agents), 'seed': seed,
+                    'num_requests': int(round(num_requests * share)),
+                    'mean_wait_time_seconds': mean_wait_time_seconds / share, 'max_tokens': max_tokens,
+                    'arrival': agent_arrival, 'stream': stream, 'overload': overload, 'start_at': start_at + offset}
+            tasks.append(run_agent(session, agent, task, offset))
+        results = await asyncio.gather(*tasks)
+
+    records = np.concatenate([records for records, _ in results])
+    records = records[np.argsort(records['start'], kind='stable')]
+    records['i'] = np.arange(len(records))
+    histogram = LatencyHistogram()
+    for _, agent_histogram in results:
+        histogram.merge(agent_histogram)
+    if fname:
+        print(f"Writing requests of {len(agents)} agents to {fname}")
+        with open(records_fname(fname), 'wb') as f:
+            np.save(f, records, allow_pickle=False)
+        export_csv(records, fname)
+        histogram.save(histogram_fname(fname))
+    return records, histogram
+
+
+def start_local_agents(num_agents, port=AGENT_PORT, skew=0.0):
+    """Starts agents on consecutive ports of this host, agent k with a clock skewed by k * skew."""
+    agents = []
+    for k in range(num_agents):
+        args = [sys.executable, "distributed.py", "-p", str(port + k), "-x", str(k * skew)]
+        print(f"Starting agent: {args}")
+        agents.append(subprocess.Popen(args))
+    for k in range(num_agents):
+        if not tgi_stub.wait_until_ready(port + k):
+            raise RuntimeError(f'agent on port {port + k} did not start')
+    return agents
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="distributed load generation: a coordinator running sender.py "
+                                                 "on agents, with their clocks corrected to its own")
+    parser.add_argument("-A", help="arrival process as a YAML mapping (poisson, see workload.py)", type=yaml.safe_load)
+    parser.add_argument("-a", help="coordinate the agents at these host:port addresses", nargs='+', default=[])
+    parser.add_argument("-L", help="start this many agents on this host and coordinate them", type=int)
+    parser.add_argument("-N", help="agent: split the requests over this many worker processes (1)", type=int,
+                        default=1)
+    parser.add_argument("-n", help="total number of requests (20_000)", type=int, default=sender.NUM_REQUESTS)
+    parser.add_argument("-O", help="overload mode as a YAML mapping, e.g. '{deadline: 30, max_in_flight: 200, "
+                                   "policy: shed}' (see sender.Overload)", type=yaml.safe_load)
+    parser.add_argument("-o", help="output file name (round_trips.csv)", type=str, default=sender.CSV_FILE)
+    parser.add_argument("-p", help=f"run as an agent listening on this port ({AGENT_PORT})", type=int)
+    parser.add_argument("-r", help="rate shares of the agents (equal)", type=float, nargs='+')
+    parser.add_argument("-S", help="stream tokens from /generate_stream", action="store_true")
+    parser.add_argument("-s", help="randomization seed (1)", type=int, default=sender.SEED_BASE)
+    parser.add_argument("-t", help="max output tokens (RANDOM)", type=int)
+    parser.add_argument("-u", help=f"url of inference server ({sender.INFERENCE_URL})", type=str,
+                        default=sender.INFERENCE_URL)
+    parser.add_argument("-w", help="mean wait time in microseconds between requests of all agents together (100)",
+                        type=int, default=int(sender.MEAN_WAIT_TIME_SECONDS * 1e6))
+    parser.add_argument("-x", help="skew the agent clock by this many seconds, to test the offset correction "
+                                   "(with -L, agent k by k times as many)", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.p:
+        SKEW = args.x
+        web.run_app(Agent(args.N).app(), port=args.p, print=lambda message: print(message.strip()))
+        sys.exit(0)
+
+    url = args.u + '_stream' if args.S and args.u.endswith('/generate') else args.u
+    local_agents = start_local_agents(args.L, skew=args.x) if args.L else []
+    agents = args.a + [f'127.0.0.1:{AGENT_PORT + k}' for k in range(len(local_agents))]
+    try:
+        _, histogram = asyncio.run(coordinate(agents, url, args.n, args.w * 1e-6, args.t, args.s, args.A, args.S,
+                                              args.r, args.o, overload=args.O))
+    finally:
+        for agent in local_agents:
+            agent.terminate()
+            agent.wait()
+    print(f"All {len(agents)} agents: {format_summary(histogram.summary())}")
@@ -0,0 +1,146 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import queues
+import store
+
+# Parameters that identify a sweep point; its MC replicas only differ in mc
+POINT_KEYS = ['date', 'MB', 'C', 'w', 't', 'n', 'd']
+
+# Batches a single run is split into when it has no replicas to compare against
+NUM_BATCHES = 10
+NUM_RESAMPLES = 2000
+
+
+def get_lam(C, w):
+    """compute lambda in requests per second"""
+    return float(C * 1_000_000 / w)
+
+
+def finite_difference(q_df, lam, d, MB):
+    """The notebooks' estimate_mu: service rate per batch slot from the change of in_service between polls."""
+    in_service = q_df['queue_size'] + q_df['batch_current_size']
+    mu_hat = -1 / d * in_service.diff() + lam
+    return 1 / MB * mu_hat.dropna()
+
+
+def batches(start, end, num_batches=NUM_BATCHES):
+    edges = np.linspace(start, end, num_batches + 1).astype(np.int64)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def estimate_experiment(row, store_dname=store.STORE_DNAME, num_batches=NUM_BATCHES):
+    """Runs every estimator on one experiment, over its trimmed window and over each of its batches.
+
+    Returns a list of (estimator, quantity, estimate, batch estimates) tuples, rates in requests per second.
+    """
+    q_df, r_df, raw_r_df = store.load_row(row, store_dname)
+    MB = max(row['MB'], 1)
+    lam = get_lam(row['C'], row['w'])
+    results = []
+
+    if len(q_df) > 2:
+        d = row['d'] if row['d'] > 0 else np.median(np.diff(queues.nanoseconds(q_df['timestamp']))) * 1e-9
+        mu_hat = finite_difference(q_df, lam, d, MB)
+        rate = q_df['request_rate']
+        parts = np.array_split(np.arange(len(mu_hat)), num_batches)
+        results.append(('finite_difference', 'mu', mu_hat.mean(),
+                        [mu_hat.iloc[part].mean() for part in parts if len(part)]))
+        parts = np.array_split(np.arange(len(rate)), num_batches)
+        results.append(('finite_difference', 'lambda', rate.mean(),
+                        [rate.iloc[part].mean() for part in parts if len(part)]))
+
+    if 'start' in r_df and len(r_df) > 1:
+        starts = queues.nanoseconds(raw_r_df['start'])
+        ends = queues.nanoseconds(raw_r_df['end'])
+        times, q = queues.in_flight(starts, ends)
+        window_start, window_end = queues.nanoseconds(r_df['start']).min(), queues.nanoseconds(r_df['start']).max()
+
+        def little(a, b):
+            # Little's law on the client side queue: lambda = L / W
+            sent = (starts >= a) & (starts < b)
+            if not sent.any():
+                return np.nan
+            return queues.time_weighted_mean(times, q, a, b) / raw_r_df['rtt'].to_numpy()[sent].mean()
+
+        def departures(a, b):
+            # Requests completed per second the server had work, i.e. while a request was in flight
+            busy = queues.durations(times, a, b)[q > 0].sum()
+            done = ((ends >= a) & (ends < b)).sum()
+            return done / busy / MB if busy > 0 else np.nan
+
+        def arrivals(a, b):
+            return ((starts >= a) & (starts < b)).sum() / ((b - a) * 1e-9)
+
+        windows = batches(window_start, window_end, num_batches)
+        for name, quantity, estimator in [('little', 'lambda', little), ('departures', 'mu', departures),
+                                          ('departures', 'lambda', arrivals)]:
+            results.append((name, quantity, estimator(window_start, window_end),
+                            [estimator(a, b) for a, b in windows]))
+    return results
+
+
+def bootstrap(values, rng, num_resamples=NUM_RESAMPLES, confidence=0.95):
+    """Percentile bootstrap CI of the mean of values."""
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) < 2:
+        return np.nan, np.nan
+    means = values[rng.integers(len(values), size=(num_resamples, len(values)))].mean(axis=1)
+    alpha = (1 - confidence) / 2
+    return tuple(np.quantile(means, [alpha, 1 - alpha]))
+
+
+def estimate_sweep(catalog, store_dname=store.STORE_DNAME, num_batches=NUM_BATCHES, workers=None, seed=1,
+                   confidence=0.95):
+    """Runs every estimator on every experiment of the catalog and summarizes them per sweep point.
+
+    Experiments are estimated in a process pool. A point with several MC replicas gets a bootstrap CI
+    over its replicas' estimates; a point run once is estimated by the mean of its batches, with a
+    bootstrap CI over those batch means.
+    Returns one tidy table with a row per (sweep point, estimator, quantity).
+    """
+    rows = [row for _, row in catalog.iterrows()]
+    with ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(estimate_experiment, rows, [store_dname] * len(rows), [num_batches] * len(rows)))
+
+    estimates = pd.DataFrame([dict(**{key: row[key] for key in POINT_KEYS + ['mc']}, estimator=name,
+                                   quantity=quantity, estimate=estimate, batches=batch_estimates)
+                              for row, result in zip(rows, results)
+                              for name, quantity, estimate, batch_estimates in result])
+    if estimates.empty:
+        return estimates
+
+    rng = np.random.default_rng(seed)
+    table = []
+    for key, group in estimates.groupby(POINT_KEYS + ['estimator', 'quantity'], sort=True):
+        if len(group) > 1:
+            estimate = group['estimate'].mean()
+            low, high = bootstrap(group['estimate'], rng, confidence=confidence)
+            method = 'replicas'
+        else:
+            estimate = np.nanmean(group['batches'].iloc[0]) if len(group['batches'].iloc[0]) else np.nan
+            low, high = bootstrap(group['batches'].iloc[0], rng, confidence=confidence)
+            method = 'batch_means'
+        table.append(dict(zip(POINT_KEYS + ['estimator', 'quantity'], key), lam=get_lam(key[2], key[3]),
+                          estimate=estimate, ci_low=low, ci_high=high, replicas=len(group), ci_method=method))
+    return pd.DataFrame(table)
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="service and arrival rate estimation over a sweep")
+    parser.add_argument("dates", help="dates (data directory suffixes) to estimate, all by default", nargs='*')
+    parser.add_argument("-b", help=f"batches per run for batch means ({NUM_BATCHES})", type=int, default=NUM_BATCHES)
+    parser.add_argument("-o", help="output CSV file (estimates.csv)", type=str, default='estimates.csv')
+    parser.add_argument("-p", help="number of worker processes (one per CPU)", type=int)
+    parser.add_argument("-s", help="store directory (store)", type=str, default=store.STORE_DNAME)
+    args = parser.parse_args()
+
+    catalog = store.select(store.read_catalog(args.s), date=args.dates or None)
+    table = estimate_sweep(catalog, args.s, args.b, args.p)
+    print(f"Writing {len(table)} estimates of {len(catalog)} experiments to {args.o}")
+    table.to_csv(args.o, index=False)
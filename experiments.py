@@ -6,6 +6,16 @@ import subprocess
 import inspect
 import yaml
 import argparse
+import threading
+
+import requests
+
+import metrics
+import replication
+import runner
+import sweep
+import tgi_stub
+from telemetry import Telemetry
 
 
 def print_parameters():
@@ -16,34 +26,42 @@ def print_parameters():
 
 def run_experiment(mc=1, poll_interval=5, q_fname="queue_size.csv", prom_url="http://localhost:9090/api/v1/query",
                    num_clients="1", num_requests_per_client=20_000, rt_fname="round_trips.csv", max_output_tokens=100,
-                   inf_url="http://127.0.0.1:8080/generate", mean_interarrival_micro_s=1_000_000):
+                   inf_url="http://127.0.0.1:8080/generate", mean_interarrival_micro_s=1_000_000,
+                   scrape_url=None, backfill=False, arrival=None, overload=None, telemetry=None, worker=0):
     print_parameters()
-    print(f"Starting metrics.py to {q_fname}")
-    metrics_args = ["python", "metrics.py", "-i", str(poll_interval), "-o", q_fname, "-u", prom_url]
-    metrics_process = subprocess.Popen(metrics_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    atexit.register(metrics_process.terminate)
-
     seed = mc * 100
-    sender_args = ["python", "sender.py", "-C", str(num_clients), "-n", str(num_requests_per_client), "-o", rt_fname,
-                   "-t", str(max_output_tokens), "-u", inf_url, "-w", str(mean_interarrival_micro_s), "-s", str(seed)]
-
-    try:
-        print(f"Running sender.py to {rt_fname}")
-        subprocess.run(sender_args, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"sender.py exited with an error: {e}")
-    finally:
-        print("Terminating metrics.py...")
-        metrics_process.terminate()
 
+    if backfill:
+        print(f"Running sender to {rt_fname}")
+        try:
+            runner.run_point_sync(inf_url=inf_url, num_clients=int(num_clients),
+                                  num_requests_per_client=num_requests_per_client,
+                                  mean_interarrival_micro_s=mean_interarrival_micro_s,
+                                  max_output_tokens=max_output_tokens, seed=seed, poll_interval=None,
+                                  rt_fname=rt_fname, arrival=arrival, overload=overload, telemetry=telemetry,
+                                  worker=worker)
+        except Exception as e:
+            print(f"sender exited with an error: {e}")
+            return
+        # Let prometheus ingest the last scrape of the run before querying it
+        time.sleep(2)
+        print(f"Backfilling {q_fname} from prometheus")
         try:
-            metrics_process.wait(timeout=5)  # Wait for it to terminate
-            print("metrics.py terminated successfully.")
-        except subprocess.TimeoutExpired:
-            print("metrics.py did not terminate in time, killing it forcefully.")
-            metrics_process.kill()
-            atexit.unregister(metrics_process.terminate)
+            metrics.backfill(metrics.round_trip_fnames(rt_fname, int(num_clients)), q_fname, poll_interval, prom_url)
+        except Exception as e:
+            print(f"Error backfilling {q_fname}: {e}")
+        return
+
+    print(f"Running sender to {rt_fname} and collecting metrics to {q_fname}")
+    try:
+        return runner.run_point_sync(inf_url=inf_url, num_clients=int(num_clients),
+                                     num_requests_per_client=num_requests_per_client,
+                                     mean_interarrival_micro_s=mean_interarrival_micro_s,
+                                     max_output_tokens=max_output_tokens, seed=seed, poll_interval=poll_interval,
+                                     scrape_url=scrape_url, prom_url=prom_url, rt_fname=rt_fname, q_fname=q_fname,
+                                     arrival=arrival, overload=overload, telemetry=telemetry, worker=worker)
+    except Exception as e:
+        print(f"sender exited with an error: {e}")
 
 
 def ensure_docker_network_exists(network_name):
@@ -92,12 +110,11 @@ def stop_and_remove_container(container_name):
         print(f"Error stopping or removing the container '{container_name}': {e}")
 
 
-def run_docker_container(max_batch_size=1):
+def run_docker_container(max_batch_size=1, gpu=0, port=8080, container_name="tgis"):
     """Run the Docker container."""
     model = "TheBloke/Mistral-7B-Instruct-v0.1-AWQ"
     volume = os.path.join(os.getcwd(), "data")
     docker_image = "ghcr.io/huggingface/text-generation-inference:latest"
-    container_name = "tgis"
     network = "param-est"
 
     # Ensure the Docker network exists
@@ -106,12 +123,12 @@ def run_docker_container(max_batch_size=1):
     # Build the docker command
     docker_command = [
         "docker", "run",
-        "--gpus", "\"device=0\"",
+        "--gpus", f"\"device={gpu}\"",
         "-e", "CUDA_VISIBLE_DEVICES=0",
         "-e", "MAX_CONCURRENT_REQUESTS=1000",
         "--shm-size", "1g",
         "-d",
-        "-p", "8080:80",
+        "-p", f"{port}:80",
         "-v", f"{volume}:/dat",
         "--name", container_name,
         "--network", network,
@@ -140,29 +157,121 @@ def run_docker_container(max_batch_size=1):
         return None
 
 
-def wait_for_container(container_name, check_word='Connected', timeout=120):
+def wait_for_server(base_url, timeout=120):
+    """Wait until the server's /health endpoint answers 200, which TGI does once the model is loaded."""
     start_time = time.time()
-    while True:
-        log_cmd = ["docker", "logs", container_name]
-        logs_result = subprocess.run(log_cmd, capture_output=True, text=True)
+    while time.time() - start_time < timeout:
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                print(f"{base_url} is healthy. Proceeding...")
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    print(f"Timeout waiting for {base_url} to become healthy.")
+    return False
+
+
+class TgiWorker:
+    """One inference server of the pool: a TGI container on its own GPU and port, or a local stand-in."""
+
+    def __init__(self, index, local=False, stub_config=None):
+        self.index = index
+        self.port = 8080 + index
+        self.container_name = "tgis" if index == 0 else f"tgis-{index}"
+        self.local = local
+        self.stub_config = stub_config or {}
+        self.server = None
+        self.batch_size = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, max_batch_size):
+        """Starts the server with the given max batch size and waits until it is healthy."""
+        print(f'worker {self.index}: starting server with max-batch-size={max_batch_size} on port {self.port}')
+        if self.local:
+            self.server = tgi_stub.start_server_process(port=self.port, max_batch_size=max_batch_size,
+                                                        **self.stub_config)
+        elif run_docker_container(max_batch_size, self.index, self.port, self.container_name) is None:
+            return False
+        self.batch_size = max_batch_size
+        if not wait_for_server(self.base_url):
+            self.stop()
+            return False
+        return True
+
+    def stop(self):
+        if self.batch_size is None:
+            return
+        if self.local:
+            tgi_stub.stop_server_process(self.server)
+            self.server = None
+        else:
+            stop_and_remove_container(self.container_name)
+        self.batch_size = None
 
-        if check_word in logs_result.stdout:
-            print(f"'{check_word}' found in logs. Proceeding...")
-            return True
 
-        if time.time() - start_time > timeout:
-            print(f"Timeout waiting for '{check_word}' in logs.")
-            return False
+def next_point(worker, pending, workers):
+    """Picks the next point for a worker, preferring its current batch size to avoid a server restart.
+
+    Otherwise it takes the batch size with the most pending points per worker already serving it.
+    """
+    for point in pending:
+        if point['B'] == worker.batch_size:
+            return point
+    remaining = {}
+    for point in pending:
+        remaining[point['B']] = remaining.get(point['B'], 0) + 1
+    serving = {B: sum(w.batch_size == B for w in workers) for B in remaining}
+    B = max(remaining, key=lambda B: remaining[B] / (1 + serving[B]))
+    return next(point for point in pending if point['B'] == B)
 
-        time.sleep(1)  # Check logs every second
+
+def run_worker(worker, pending, workers, lock, run_point, stop=True):
+    """Runs pending points on one worker until none are left, then stops its server unless stop is False."""
+    while True:
+        with lock:
+            if not pending:
+                break
+            point = next_point(worker, pending, workers)
+            pending.remove(point)
+        if point['B'] != worker.batch_size:
+            if worker.batch_size is not None:
+                worker.stop()
+                if not worker.local:
+                    time.sleep(10)  # cool down before the next container on this GPU
+            if not worker.start(point['B']):
+                print(f"worker {worker.index}: failed to start server, giving up")
+                with lock:
+                    pending.append(point)
+                break
+        run_point(worker, point)
+    if stop:
+        worker.stop()
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.stop()
 
 
 # Main process
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="experiment runner")
+    parser.add_argument("-l", help="run against the local TGI stand-in (tgi_stub.py) instead of the docker container",
+                        action="store_true")
+    parser.add_argument("-s", help="scrape the TGI /metrics endpoint directly instead of querying prometheus",
+                        action="store_true")
+    parser.add_argument("-b", help="backfill metrics from prometheus after each run instead of running metrics.py",
+                        action="store_true")
     parser.add_argument("-c", help="config file name (config.yaml)", type=str, default='config.yaml')
+    parser.add_argument("-d", help="data directory; an existing sweep directory is resumed (data_<date>)", type=str)
+    parser.add_argument("-g", help="number of GPUs, one TGI server per GPU (1)", type=int, default=1)
     parser.add_argument("-r", help="replica number", type=int, default=1)
-    parser.add_argument("-m", help="number of monte carlo simulations", type=int, default=1)
+    parser.add_argument("-m", help="number of monte carlo simulations; with a replication section in the config, "
+                                   "the average per point", type=int, default=1)
 
     args = parser.parse_args()
 
@@ -172,46 +281,83 @@ if __name__ == "__main__":
 
     with open(config_file, "r") as file:
         config = yaml.safe_load(file)
-
-    date_dname = f'data_{datetime.now().strftime("%d%b")}'
+    # Service model of the stand-in server (decode_seconds, decode_slope_seconds, prefill_seconds)
+    stub_config = config.get('stub', {})
+    # Arrival process of every point (see workload.generate), a Poisson process at each lambda by default
+    arrival = config.get('arrival')
+    # Deadlines and in-flight cap of the clients (see sender.Overload), none by default
+    overload = config.get('overload')
+    # Client side telemetry of every worker's clients, served for prometheus and/or snapshot to a file
+    telemetry_config = config.get('telemetry')
+    # Replicas per point until a target precision (see replication.ReplicationController), -m each by default
+    replication_config = config.get('replication')
+    if args.b and args.g > 1:
+        parser.error("backfilling from prometheus (-b) needs a single server (-g 1)")
+
+    date_dname = args.d or f'data_{datetime.now().strftime("%d%b")}'
     if not os.path.exists(date_dname):
         os.makedirs(date_dname)
 
-    batch_sizes = config.get('batch_sizes', [1])
-    num_clients = config.get('num_clients', [1])
-    max_output_tokens = config.get('max_output_tokens', [200])
-    lambdas = config.get('lambdas', [0.1, 0.7, 1.0, 1.4, 2.0])
-    ws = [int(1_000 / lam) * 1_000 for lam in lambdas]
-    deltas = config.get('deltas', [2])
-
-    atexit.register(stop_and_remove_container, 'tgis')
-
-    for B in batch_sizes:
-
-        container_name = run_docker_container(max_batch_size=B)
-        if container_name is None:
-            print('failed to start container!')
-            break
-
-        print(f'waiting for container with max-batch-size={B} to be ready...')
-        ok = wait_for_container(container_name)
-        if not ok:
-            print('failed to start tgi server')
-            break
-
-        for C in num_clients:
-            for t in max_output_tokens:
-                for w in ws:
-                    for d in deltas:
-                        for mc in range(1, MC + 1):
-                            n = max(110, 16 * 60 * 1_000_000 // w // C)
-                            name_part = f'MB_{B}_C{C}_w{w}_t{t}_n{n}_d{d}_mc_{mc}'
-                            q_fname = f'{date_dname}/queue_size_{name_part}.csv'
-                            rt_fname = f'{date_dname}/round_trips_{name_part}.csv'
-                            run_experiment(q_fname=q_fname, num_clients=C, num_requests_per_client=n,
-                                           max_output_tokens=t, poll_interval=d, mean_interarrival_micro_s=w,
-                                           rt_fname=rt_fname, mc=mc)
-
-        if container_name:
-            stop_and_remove_container(container_name)
-            time.sleep(10)
+    controller = None
+    if replication_config:
+        # Only the first replicas of each point are known up front; the controller adds the rest
+        min_replicas = replication_config.get('min_replicas', replication.MIN_REPLICAS)
+        manifest = sweep.load_manifest(date_dname, config, min_replicas)
+        controller = replication.ReplicationController(
+            date_dname, manifest, config, MC, replication_config.get('precision', replication.PRECISION),
+            min_replicas, replication_config.get('max_replicas', replication.MAX_REPLICAS))
+    else:
+        manifest = sweep.load_manifest(date_dname, config, MC)
+        groups = sweep.pending_by_batch_size(manifest, config)
+        num_points = sum(len(points) for _, points in groups)
+        print(f'{num_points} of {len(sweep.expand(config, MC))} sweep points left to run in {date_dname}')
+
+    workers = [TgiWorker(i, local=args.l, stub_config=stub_config) for i in range(args.g)]
+    atexit.register(stop_workers, workers)
+    telemetry = None
+    if telemetry_config:
+        telemetry = Telemetry(max(config.get('num_clients', [1])), workers=len(workers))
+        if telemetry_config.get('port'):
+            telemetry.serve(telemetry_config['port'])
+        if telemetry_config.get('file'):
+            telemetry.snapshot(telemetry_config['file'])
+    lock = threading.Lock()
+
+    def run_point(worker, point):
+        # Prometheus does not tell the workers' series apart, so a pool scrapes each server directly
+        scrape_url = f"{worker.base_url}/metrics" if args.s or len(workers) > 1 else None
+        run_experiment(q_fname=sweep.q_fname(date_dname, point), num_clients=point['C'],
+                       num_requests_per_client=point['n'], max_output_tokens=point['t'], poll_interval=point['d'],
+                       mean_interarrival_micro_s=point['w'], rt_fname=sweep.rt_fname(date_dname, point),
+                       mc=point['mc'], inf_url=f"{worker.base_url}/generate", scrape_url=scrape_url,
+                       backfill=args.b, arrival=arrival, overload=overload, telemetry=telemetry, worker=worker.index)
+        with lock:
+            if not sweep.mark_done(date_dname, manifest, point):
+                print(f"outputs of {point['name']} are incomplete, it will be rerun when the sweep is resumed")
+
+    def run_points(pending, stop=True):
+        threads = [threading.Thread(target=run_worker, args=(worker, pending, workers, lock, run_point, stop),
+                                    name=f'worker-{worker.index}') for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if controller is None:
+        run_points([point for _, points in groups for point in points])
+    else:
+        # Rounds of one replica per worker or more, keeping the servers up between rounds
+        while True:
+            points = controller.next_round(len(workers))
+            if not points:
+                break
+            print(f'Running {len(points)} replicas: {", ".join(point["name"] for point in points)}')
+            pending = sorted(points, key=lambda point: point['B'])
+            run_points(pending, stop=False)
+            controller.completed(points)
+            if pending:
+                print("workers gave up with replicas left to run")
+                break
+        stop_workers(workers)
+    if telemetry is not None:
+        telemetry.close()
@@ -0,0 +1,188 @@
+import argparse
+import glob
+import os.path
+
+import numpy as np
+
+# Extension of the latency histogram written alongside a round trip CSV file
+HISTOGRAM_EXT = '.hist.npz'
+
+# Values are counted in units of UNIT seconds, up to HIGHEST seconds; each power of two is split into
+# 2 ** (SUB_BITS - 1) buckets, so a bucket is within 2 ** -(SUB_BITS - 1) (0.8%) of the values in it
+UNIT = 1e-6
+HIGHEST = 3600.0
+SUB_BITS = 8
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def histogram_fname(csv_fname):
+    """Name of the latency histogram written alongside a round trip CSV file."""
+    b, _ = os.path.splitext(csv_fname)
+    return b + HISTOGRAM_EXT
+
+
+def num_buckets(highest=HIGHEST, unit=UNIT, sub_bits=SUB_BITS):
+    return bucket_index(int(highest / unit), sub_bits) + 1
+
+
+def bucket_index(v, sub_bits=SUB_BITS):
+    """Bucket of a value in units: linear below 2 ** sub_bits, then 2 ** (sub_bits - 1) buckets per power of 2."""
+    e = max(v.bit_length() - sub_bits, 0)
+    return (e << (sub_bits - 1)) + (v >> e)
+
+
+def bucket_indices(v, sub_bits=SUB_BITS):
+    """bucket_index of an array of values in units."""
+    v = np.asarray(v, dtype=np.int64)
+    # frexp gives the bit length of integers exactly, unlike log2
+    _, bit_length = np.frexp(v.astype(np.float64))
+    e = np.maximum(bit_length.astype(np.int64) - sub_bits, 0)
+    return (e << (sub_bits - 1)) + (v >> e)
+
+
+def bucket_bounds(sub_bits=SUB_BITS, n=None):
+    """Lower and upper bound in units of every bucket."""
+    index = np.arange(n if n is not None else num_buckets(sub_bits=sub_bits), dtype=np.int64)
+    half = 1 << (sub_bits - 1)
+    e = np.maximum(index // half - 1, 0)
+    m = index - (e << (sub_bits - 1))
+    return m << e, (m + 1) << e
+
+
+class LatencyHistogram:
+    """Log bucketed latency histogram in the style of HdrHistogram.
+
+    Observing a value is one bucket increment into a fixed array, whatever the number of requests.
+    Histograms with the same layout add up exactly, so the histograms of a run's clients, or of the MC
+    replicas of a sweep point, merge into the histogram of all their requests. It also keeps the count
+    of failed requests and the span from the first send to the last completion, for the throughput.
+    """
+
+    def __init__(self, unit=UNIT, highest=HIGHEST, sub_bits=SUB_BITS):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.counts = np.zeros(num_buckets(highest, unit, sub_bits), dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = 0.0
+        self.failed = 0
+        self.first_start = np.inf
+        self.last_end = -np.inf
+
+    def observe(self, value, start=None, end=None):
+        """Counts one successful request of value seconds, sent at start and completed at end (epoch seconds)."""
+        index = bucket_index(int(value / self.unit), self.sub_bits)
+        self.counts[min(index, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.observe_span(start, end)
+
+    def observe_failure(self, start=None, end=None):
+        self.failed += 1
+        self.observe_span(start, end)
+
+    def observe_span(self, start, end):
+        if start is not None and start < self.first_start:
+            self.first_start = start
+        if end is not None and end > self.last_end:
+            self.last_end = end
+
+    def observe_records(self, records):
+        """Counts an array of request records (see results.RECORD_DTYPE) at once."""
+        ok = records['ok'] == 0
+        values = records['rtt'][ok]
+        index = bucket_indices((values / self.unit).astype(np.int64), self.sub_bits)
+        self.counts += np.bincount(np.minimum(index, len(self.counts) - 1), minlength=len(self.counts))
+        self.count += len(values)
+        self.sum += values.sum()
+        if len(values):
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+        self.failed += int((~ok).sum())
+        if len(records):
+            self.observe_span(records['start'].min(), records['end'].max())
+        return self
+
+    def merge(self, other):
+        """Adds the requests of another histogram of the same layout to this one."""
+        if other.unit != self.unit or other.sub_bits != self.sub_bits or len(other.counts) != len(self.counts):
+            raise ValueError('histograms with different bucket layouts do not merge')
+        self.counts += other.counts
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.failed += other.failed
+        self.observe_span(other.first_start, other.last_end)
+        return self
+
+    def quantiles(self, quantiles=QUANTILES):
+        """Latency quantiles in seconds, each the midpoint of its bucket clipped to the observed range."""
+        if self.count == 0:
+            return np.full(len(quantiles), np.nan)
+        cumulative = np.cumsum(self.counts)
+        index = np.searchsorted(cumulative, np.ceil(np.asarray(quantiles) * self.count), side='left')
+        low, high = bucket_bounds(self.sub_bits, len(self.counts))
+        values = (low[index] + high[index]) / 2 * self.unit
+        return np.clip(values, self.min, self.max)
+
+    def summary(self, quantiles=QUANTILES):
+        """Request counts, throughput and latency statistics, as a dict."""
+        span = self.last_end - self.first_start
+        stats = {'requests': self.count, 'failed': self.failed,
+                 'throughput': self.count / span if span > 0 else np.nan,
+                 'mean': self.sum / self.count if self.count else np.nan,
+                 'min': self.min if self.count else np.nan, 'max': self.max if self.count else np.nan}
+        for q, value in zip(quantiles, self.quantiles(quantiles)):
+            stats[f'p{q * 100:g}'] = float(value)
+        return stats
+
+    def save(self, fname):
+        """Writes the non-empty buckets and the totals; the whole file is a few KB whatever the run size."""
+        nonzero = np.flatnonzero(self.counts)
+        np.savez(fname, index=nonzero, counts=self.counts[nonzero],
+                 layout=np.array([self.unit, self.sub_bits, len(self.counts)], dtype=np.float64),
+                 totals=np.array([self.count, self.sum, self.min, self.max, self.failed, self.first_start,
+                                  self.last_end], dtype=np.float64))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle=False) as f:
+            unit, sub_bits, n = f['layout']
+            histogram = cls(unit, sub_bits=int(sub_bits))
+            histogram.counts = np.zeros(int(n), dtype=np.int64)
+            histogram.counts[f['index']] = f['counts']
+            count, histogram.sum, histogram.min, histogram.max, failed, histogram.first_start, \
+                histogram.last_end = f['totals'].tolist()
+        histogram.count, histogram.failed = int(count), int(failed)
+        return histogram
+
+
+def merged(fnames):
+    """One histogram of all the requests of the given histogram files."""
+    histogram = LatencyHistogram()
+    for fname in fnames:
+        histogram.merge(LatencyHistogram.load(fname))
+    return histogram
+
+
+def format_summary(stats):
+    quantiles = ", ".join(f"{key} {value * 1e3:.1f} ms" for key, value in stats.items() if key.startswith('p'))
+    return (f"{stats['requests']} requests ({stats['failed']} failed), throughput {stats['throughput']:.2f} req/s, "
+            f"mean {stats['mean'] * 1e3:.1f} ms, {quantiles}, max {stats['max'] * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="merged latency percentiles of histogram files")
+    parser.add_argument("histograms", help=f"histogram files ({HISTOGRAM_EXT}) or glob patterns to merge",
+                        nargs='+')
+    args = parser.parse_args()
+
+    fnames = sorted(fname for pattern in args.histograms for fname in glob.glob(pattern))
+    print(f"Merged {len(fnames)} histograms: {format_summary(merged(fnames).summary())}")
@@ -1,14 +1,32 @@
 import argparse
+import asyncio
+import glob
+import os
+import re
 import time
 import csv
+import aiohttp
 import requests
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
 
 # Prometheus server details
 PROMETHEUS_URL = "http://localhost:9090/api/v1/query"
 METRICS_INTERVAL_SECONDS = 5  # Query every 5 seconds
 CSV_FILE = 'queue_size.csv'
 
+# TGI metrics endpoint, scraped directly instead of through Prometheus when set
+SCRAPE_URL = None
+
+# Histograms recorded when scraping directly, by output column prefix
+HISTOGRAMS = {
+    "queue_duration": "tgi_request_queue_duration",
+    "inference_duration": "tgi_request_inference_duration",
+    "batch_next_size": "tgi_batch_next_size",
+}
+
 # List of metrics to query
 METRICS = [
     f"tgi_queue_size",
@@ -17,6 +35,14 @@ METRICS = [
 ]
 
 
+# One sample per poll of the in-process collector; timestamp in epoch seconds
+SAMPLE_DTYPE = np.dtype([('timestamp', 'f8'), ('queue_size', 'f8'), ('batch_current_size', 'f8'),
+                         ('request_rate', 'f8')])
+
+# Prometheus returns at most 11,000 points per series from one range query
+MAX_RANGE_POINTS = 11_000
+
+
 # Function to query Prometheus for metrics
 def query_prometheus(metric_name, query_time):
     """Query Prometheus and return the latest value and timestamp for the given metric."""
@@ -87,11 +113,299 @@ def gather_metrics():
             time.sleep(METRICS_INTERVAL_SECONDS)
 
 
+def parse_exposition(text):
+    """Parses a Prometheus text exposition in one pass into {series: value}.
+
+    The series key is the metric name with its label set as exposed, e.g. 'tgi_queue_size' or
+    'tgi_request_queue_duration_bucket{le="0.001"}'.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line[0] == '#':
+            continue
+        series, _, value = line.rpartition(' ')
+        if series.endswith('}') or ' ' not in series:
+            samples[series] = float(value)
+        else:
+            # The sample carries a timestamp after the value
+            series, _, value = series.rpartition(' ')
+            samples[series] = float(value)
+    return samples
+
+
+def histogram_buckets(samples, name):
+    """Returns the (le, cumulative count) buckets of a histogram in exposition order."""
+    prefix = f'{name}_bucket{{le="'
+    return [(series[len(prefix):-2], value) for series, value in samples.items()
+            if series.startswith(prefix) and series.endswith('"}')]
+
+
+def snapshot_columns(samples):
+    """Output columns for a scrape and the series backing them.
+
+    The standard columns come first, followed by the sum, count and buckets of every histogram exposed.
+    """
+    columns = ["timestamp", "queue_size", "batch_current_size", "request_rate", "monotonic", "request_count"]
+    series = []
+    for short, name in HISTOGRAMS.items():
+        if f'{name}_count' in samples:
+            columns += [f'{short}_sum', f'{short}_count']
+            series += [f'{name}_sum', f'{name}_count']
+            for le, _ in histogram_buckets(samples, name):
+                columns.append(f'{short}_le_{le}')
+                series.append(f'{name}_bucket{{le="{le}"}}')
+    return columns, series
+
+
+def scrape_metrics():
+    """Scrapes the TGI metrics endpoint directly every METRICS_INTERVAL_SECONDS and writes them to a CSV file.
+
+    One keep-alive connection is reused for every scrape, all metrics of a row come from the same
+    scrape and scrapes are paced by absolute monotonic deadlines so the sampling interval does not drift.
+    """
+    session = requests.Session()
+    with open(CSV_FILE, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        columns, series = None, None
+        last_count, last_mono = None, None
+        t0 = time.monotonic()
+        tick = 0
+
+        while True:
+            try:
+                t_sent = time.monotonic()
+                response = session.get(SCRAPE_URL, timeout=max(METRICS_INTERVAL_SECONDS, 1))
+                t_received = time.monotonic()
+                # One timestamp per snapshot, at the midpoint of the scrape
+                mono = 0.5 * (t_sent + t_received)
+                timestamp = datetime.fromtimestamp(time.time() - (t_received - mono))
+                if response.status_code == 200:
+                    samples = parse_exposition(response.text)
+                    if columns is None:
+                        columns, series = snapshot_columns(samples)
+                        writer.writerow(columns)
+                    count = samples.get('tgi_request_count', 0.0)
+                    rate = (count - last_count) / (mono - last_mono) if last_count is not None else 0.0
+                    last_count, last_mono = count, mono
+                    row = [timestamp, samples.get('tgi_queue_size'), samples.get('tgi_batch_current_size'), rate,
+                           mono, count]
+                    writer.writerow(row + [samples.get(key) for key in series])
+                    file.flush()  # Ensure data is written immediately
+                else:
+                    print(f"Failed to scrape {SCRAPE_URL}. Status code: {response.status_code}")
+            except Exception as e:
+                print(f"Error scraping metrics: {e}")
+
+            # Sleep until the next tick, skipping ticks that were missed
+            tick = max(tick + 1, int((time.monotonic() - t0) / METRICS_INTERVAL_SECONDS) + 1)
+            time.sleep(max(0.0, t0 + tick * METRICS_INTERVAL_SECONDS - time.monotonic()))
+
+
+async def scrape_sample(session, scrape_url, last):
+    """Scrapes the TGI metrics endpoint once; last holds the (count, monotonic) of the previous scrape.
+
+    Returns the sample and the rest of its queue_size row in the scrape_metrics format (monotonic time,
+    request count and the histogram series, see snapshot_columns), keyed by column name.
+    """
+    t_sent = time.monotonic()
+    async with session.get(scrape_url) as response:
+        text = await response.text()
+        status = response.status
+    t_received = time.monotonic()
+    if status != 200:
+        print(f"Failed to scrape {scrape_url}. Status code: {status}")
+        return None
+    mono = 0.5 * (t_sent + t_received)
+    samples = parse_exposition(text)
+    count = samples.get('tgi_request_count', 0.0)
+    rate = (count - last[0]) / (mono - last[1]) if last else 0.0
+    last[:] = [count, mono]
+    sample = (time.time() - (t_received - mono), samples.get('tgi_queue_size', np.nan),
+              samples.get('tgi_batch_current_size', np.nan), rate)
+    columns, series = snapshot_columns(samples)
+    extra = dict(zip(columns[len(sample):], [mono, count] + [samples.get(key) for key in series]))
+    return sample, extra
+
+
+async def query_sample(session, prom_url):
+    """Runs the instant queries of METRICS concurrently and returns one sample, or None if any is missing."""
+
+    async def query(metric):
+        async with session.get(prom_url, params={'query': metric}) as response:
+            result = await response.json()
+        if result['status'] == 'success' and result['data']['result']:
+            timestamp, value = result['data']['result'][0]['value']
+            return float(timestamp), float(value)
+        print(f"No result for query: {metric}")
+        return None
+
+    values = await asyncio.gather(*(query(metric) for metric in METRICS))
+    if any(value is None for value in values):
+        return None
+    return (values[0][0],) + tuple(value for _, value in values)
+
+
+async def collect(stop, interval=METRICS_INTERVAL_SECONDS, scrape_url=None, prom_url=PROMETHEUS_URL, fname=None,
+                  on_sample=None):
+    """Polls the queue metrics on the running event loop until the stop event is set and returns the samples.
+
+    Metrics are scraped from scrape_url when given and queried from Prometheus otherwise. Each sample is
+    also written to fname in the queue_size CSV format when given, with the same columns as scrape_metrics
+    when scraping, and passed to on_sample as it arrives.
+    """
+    samples = []
+    last = []
+    file = open(fname, mode='w', newline='') if fname else None
+    writer = csv.writer(file) if file else None
+    columns = None
+    if writer and not scrape_url:
+        columns = ["timestamp", "queue_size", "batch_current_size", "request_rate"]
+        writer.writerow(columns)
+    timeout = aiohttp.ClientTimeout(total=max(interval, 1))
+    t0 = time.monotonic()
+    tick = 0
+    try:
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while not stop.is_set():
+                extra = {}
+                try:
+                    if scrape_url:
+                        sample, extra = await scrape_sample(session, scrape_url, last) or (None, {})
+                    else:
+                        sample = await query_sample(session, prom_url)
+                except Exception as e:
+                    print(f"Error gathering metrics: {e}")
+                    sample = None
+                if sample is not None:
+                    samples.append(sample)
+                    if writer:
+                        if columns is None:
+                            # The histogram columns are those of the first scrape, as in scrape_metrics
+                            columns = list(SAMPLE_DTYPE.names) + list(extra)
+                            writer.writerow(columns)
+                        row = [datetime.fromtimestamp(sample[0])] + list(sample[1:])
+                        writer.writerow(row + [extra.get(column) for column in columns[len(row):]])
+                        file.flush()
+                    if on_sample:
+                        on_sample(np.array(sample, dtype=SAMPLE_DTYPE))
+
+                # Wait for the next tick, skipping ticks that were missed, or until stopped
+                tick = max(tick + 1, int((time.monotonic() - t0) / interval) + 1)
+                try:
+                    await asyncio.wait_for(stop.wait(), max(0.0, t0 + tick * interval - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        if file:
+            file.close()
+    return np.array(samples, dtype=SAMPLE_DTYPE)
+
+
+def query_range(session, prom_url, query, start, end, step):
+    """Runs one Prometheus range query and returns the (timestamps, values) of its first series."""
+    range_url = prom_url.rsplit('/', 1)[0] + '/query_range'
+    response = session.get(range_url, params={'query': query, 'start': start, 'end': end, 'step': step})
+    response.raise_for_status()
+    result = response.json()['data']['result']
+    if not result:
+        print(f"No result for range query {query} between {start} and {end}")
+        return np.zeros(0), np.zeros(0)
+    values = np.array(result[0]['values'], dtype=float)
+    return values[:, 0], values[:, 1]
+
+
+def round_trip_fnames(rt_fname, num_clients):
+    """Round trip files written by sender.py for a run with num_clients clients."""
+    if num_clients > 1:
+        b, e = os.path.splitext(rt_fname)
+        return [f'{b}_{c}{e}' for c in range(1, num_clients + 1)]
+    return [rt_fname]
+
+
+def run_window(rt_fnames):
+    """First send time and last completion time, in epoch seconds, over the given round trip files."""
+    times = np.concatenate([np.loadtxt(fname, delimiter=',', usecols=(1, 2), ndmin=2) for fname in rt_fnames])
+    return times[:, 0].min(), times[:, 1].max()
+
+
+def backfill(rt_fnames, q_fname, step=METRICS_INTERVAL_SECONDS, prom_url=PROMETHEUS_URL):
+    """Rebuilds a queue_size CSV for the window of a finished run from the series Prometheus already stores.
+
+    Each metric is fetched with range queries at the given step (split into chunks Prometheus accepts),
+    all issued concurrently over one session, and the results are aligned on the common step grid.
+    """
+    start, end = run_window(rt_fnames)
+    start = np.floor(start / step) * step
+    window = max(2, int(np.ceil(step)))
+    queries = ["tgi_queue_size", "tgi_batch_current_size", f"rate(tgi_request_count[{window}s])"]
+    chunk = step * (MAX_RANGE_POINTS - 1)
+    chunks = [(t, min(t + chunk, end)) for t in np.arange(start, end, chunk)]
+
+    session = requests.Session()
+    jobs = [(j, query, a, b) for j, query in enumerate(queries) for a, b in chunks]
+    with ThreadPoolExecutor(max_workers=min(len(jobs), 8)) as pool:
+        results = list(pool.map(lambda job: query_range(session, prom_url, job[1], job[2], job[3], step), jobs))
+
+    num_steps = int(np.floor((end - start) / step)) + 1
+    table = np.full((num_steps, len(queries)), np.nan)
+    for (j, _, _, _), (timestamps, values) in zip(jobs, results):
+        index = np.rint((timestamps - start) / step).astype(int)
+        keep = (index >= 0) & (index < num_steps)
+        table[index[keep], j] = values[keep]
+
+    # Like the live collector, only keep the instants where every metric has a value
+    complete = ~np.isnan(table).any(axis=1)
+    grid = start + step * np.arange(num_steps)[complete]
+    table = table[complete]
+
+    # Timestamps are written in local time, as datetime.fromtimestamp does in gather_metrics
+    utc_offset = (datetime.fromtimestamp(start) - datetime.fromtimestamp(start, timezone.utc).replace(tzinfo=None)).total_seconds()
+    stamps = np.datetime_as_string(np.rint((grid + utc_offset) * 1e6).astype('datetime64[us]'))
+    stamps = np.char.replace(stamps, 'T', ' ')
+
+    with open(q_fname, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["timestamp", "queue_size", "batch_current_size", "request_rate"])
+        writer.writerows(zip(stamps.tolist(), *table.T.tolist()))
+    print(f"Wrote {len(grid)} rows between {datetime.fromtimestamp(start)} and {datetime.fromtimestamp(end)} "
+          f"to {q_fname}")
+
+
+def backfill_dir(dname, out_dname, step=METRICS_INTERVAL_SECONDS, prom_url=PROMETHEUS_URL):
+    """Backfills the queue_size file of every run in a sweep directory, skipping files that already exist."""
+    runs = {}
+    for fname in sorted(glob.glob(os.path.join(dname, 'round_trips_*.csv'))):
+        name_part = os.path.basename(fname)[len('round_trips_'):-len('.csv')]
+        match = re.search(r'(?:^|_)C(\d+)_', name_part)
+        if match is None:
+            print(f"Skipping {fname}: number of clients not in its name")
+            continue
+        if int(match.group(1)) > 1:
+            name_part = name_part.rsplit('_', 1)[0]
+        runs.setdefault(name_part, []).append(fname)
+
+    os.makedirs(out_dname, exist_ok=True)
+    for name_part, rt_fnames in runs.items():
+        q_fname = os.path.join(out_dname, f'queue_size_{name_part}.csv')
+        if os.path.exists(q_fname):
+            print(f"Skipping {q_fname}: already exists")
+            continue
+        try:
+            backfill(rt_fnames, q_fname, step, prom_url)
+        except Exception as e:
+            print(f"Error backfilling {q_fname}: {e}")
+
+
 # Entry point for running the script
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("prometheus metrics gathering tool")
-    parser.add_argument("-i", help="polling interval in seconds (5)", type=int)
-    parser.add_argument("-o", help="output file name (queue_size.csv)", type=str)
+    parser.add_argument("-b", help="backfill from prometheus for the round trip file(s) or data directory given",
+                        type=str, nargs='+')
+    parser.add_argument("-i", help="polling interval in seconds (5)", type=float)
+    parser.add_argument("-o", help="output file name (queue_size.csv), or directory when backfilling a directory",
+                        type=str)
+    parser.add_argument("-s", help="scrape this TGI metrics url directly, e.g. http://127.0.0.1:8080/metrics",
+                        type=str)
     parser.add_argument("-u", help="url of prometheus server (http://localhost:9090/api/v1/query)", type=str)
     args = parser.parse_args()
 
@@ -101,5 +415,14 @@ if __name__ == "__main__":
         CSV_FILE = args.o
     if args.u:
         PROMETHEUS_URL = args.u
+    if args.s:
+        SCRAPE_URL = args.s
 
-    gather_metrics()
+    if args.b and os.path.isdir(args.b[0]):
+        backfill_dir(args.b[0], args.o or args.b[0], METRICS_INTERVAL_SECONDS, PROMETHEUS_URL)
+    elif args.b:
+        backfill(args.b, CSV_FILE, METRICS_INTERVAL_SECONDS, PROMETHEUS_URL)
+    elif SCRAPE_URL:
+        scrape_metrics()
+    else:
+        gather_metrics()
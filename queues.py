@@ -0,0 +1,172 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def nanoseconds(t):
+    """Times as int64 epoch nanoseconds, from float epoch seconds, datetime64 values or nanoseconds already."""
+    if isinstance(t, (pd.Timestamp, np.datetime64)):
+        return np.int64(pd.Timestamp(t).value)
+    t = np.asarray(t)
+    if np.issubdtype(t.dtype, np.datetime64):
+        return t.astype('datetime64[ns]').view(np.int64)
+    if np.issubdtype(t.dtype, np.integer):
+        return t.astype(np.int64, copy=False)
+    return np.rint(np.multiply(t, 1e9), out=np.empty(t.shape, dtype=np.int64), casting='unsafe')
+
+
+def in_flight(starts, ends):
+    """Client side number of requests in flight as a step function.
+
+    Returns (times, q), times as datetime64[ns]: q[k] requests are in flight from times[k] until
+    times[k + 1]. Each event is encoded as 2 * time + is_end, so one stable sort of the two sorted runs
+    (send times are nearly sorted already) merges them, with starts before ends at equal times. Every
+    step works in place on the one events array.
+    """
+    starts, ends = nanoseconds(starts), nanoseconds(ends)
+    events = np.empty(len(starts) + len(ends), dtype=np.int64)
+    events[:len(starts)] = starts
+    events[len(starts):] = ends
+    events[:len(starts)].sort(kind='stable')
+    events[len(starts):].sort()
+    events <<= 1
+    events[len(starts):] |= 1
+    events.sort(kind='stable')
+    q = np.bitwise_and(events, 1, out=np.empty(len(events), dtype=np.int32), casting='unsafe')
+    q *= -2
+    q += 1
+    np.cumsum(q, out=q)
+    events >>= 1
+    return events.view('datetime64[ns]'), q
+
+
+def in_flight_at(starts, ends, at):
+    """Number of requests in flight at the given times, without building the whole step function."""
+    starts = np.sort(nanoseconds(starts), kind='stable')
+    ends = np.sort(nanoseconds(ends))
+    at = nanoseconds(at)
+    return np.searchsorted(starts, at, side='right') - np.searchsorted(ends, at, side='right')
+
+
+def resample(times, q, at):
+    """Values of the step function (times, q) at the given times, e.g. the queue_size timestamps."""
+    index = np.searchsorted(nanoseconds(times), nanoseconds(at), side='right') - 1
+    return np.where(index >= 0, q[np.maximum(index, 0)], 0)
+
+
+def durations(times, start=None, end=None):
+    """Time spent at each step of a step function within [start, end], in seconds."""
+    times = nanoseconds(times)
+    start = times[0] if start is None else nanoseconds(start)
+    end = times[-1] if end is None else nanoseconds(end)
+    if len(times) and (times[0] < start or times[-1] > end):
+        times = np.clip(times, start, end)
+    weights = np.empty(len(times))
+    np.subtract(times[1:], times[:-1], out=weights[:-1], casting='unsafe')
+    weights[-1:] = end - times[-1:]
+    weights *= 1e-9
+    return weights
+
+
+def time_weighted_mean(times, q, start=None, end=None):
+    """Time weighted mean of the step function over [start, end] (its whole span by default)."""
+    weights = durations(times, start, end)
+    return np.dot(weights, q) / weights.sum()
+
+
+def time_at_length(q, weights):
+    # Queue lengths are small integers, so the time spent at each length is one weighted bincount
+    return np.bincount(np.maximum(q, 0), weights=weights)
+
+
+def spent_quantiles(spent, quantiles):
+    cumulative = np.cumsum(spent) / spent.sum()
+    return np.searchsorted(cumulative, np.asarray(quantiles), side='left')
+
+
+def weighted_quantiles(q, weights, quantiles):
+    return spent_quantiles(time_at_length(q, weights), quantiles)
+
+
+def time_weighted_quantiles(times, q, quantiles=(0.5, 0.9, 0.99), start=None, end=None):
+    """Quantiles of the queue length seen at a uniformly random instant in [start, end]."""
+    return weighted_quantiles(q, durations(times, start, end), quantiles)
+
+
+def drift(t, y):
+    """Least squares slope of y over t and its standard error.
+
+    The error is inflated by (1 + rho) / (1 - rho), rho being the lag-1 autocorrelation of the residuals,
+    since successive polls of a queue are far from independent.
+    """
+    t = t - t.mean()
+    sxx = (t * t).sum()
+    slope = (t * (y - y.mean())).sum() / sxx
+    resid = y - y.mean() - slope * t
+    ss = (resid * resid).sum()
+    if ss == 0:
+        return slope, 0.0
+    rho = np.clip((resid[1:] * resid[:-1]).sum() / ss, 0.0, 0.95)
+    return slope, np.sqrt(ss / (len(y) - 2) / sxx * (1 + rho) / (1 - rho))
+
+
+def mean_se(y):
+    """Mean of y and its standard error, inflated for lag-1 autocorrelation like drift's."""
+    resid = y - y.mean()
+    ss = (resid * resid).sum()
+    if ss == 0:
+        return y.mean(), 0.0
+    rho = np.clip((resid[1:] * resid[:-1]).sum() / ss, 0.0, 0.95)
+    return y.mean(), np.sqrt(ss / (len(y) - 1) / len(y) * (1 + rho) / (1 - rho))
+
+
+def summary(times, q, start=None, end=None, quantiles=(0.5, 0.9, 0.99)):
+    """Time weighted mean, max and quantiles of one step function, as a dict."""
+    # The mean and the quantiles both come from the time spent at each length
+    spent = time_at_length(q, durations(times, start, end))
+    stats = {'mean': np.dot(spent, np.arange(len(spent))) / spent.sum(), 'max': int(q.max()) if len(q) else 0}
+    for p, value in zip(quantiles, spent_quantiles(spent, quantiles)):
+        stats[f'p{p * 100:g}'] = int(value)
+    return stats
+
+
+def per_client(starts, ends, clients, start=None, end=None, quantiles=(0.5, 0.9, 0.99)):
+    """Summary of the in-flight requests of each client and of all clients together, one row each."""
+    starts, ends, clients = nanoseconds(starts), nanoseconds(ends), np.asarray(clients)
+    start = starts.min() if start is None else start
+    end = ends.max() if end is None else end
+    rows = {}
+    for client in np.unique(clients):
+        mine = clients == client
+        rows[client] = summary(*in_flight(starts[mine], ends[mine]), start, end, quantiles)
+    rows['all'] = summary(*in_flight(starts, ends), start, end, quantiles)
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+
+def extract_cq_df(r_df, start, end):
+    """Drop-in replacement for the notebooks' extract_cq_df: the client side queue between start and end."""
+    times, q = in_flight(r_df['start'], r_df['end'])
+    cq_df = pd.DataFrame({'time': times, 'd': np.diff(q, prepend=0), 'q': q})
+    cq_df = cq_df.loc[(cq_df['time'] >= start) & (cq_df['time'] <= end)]
+    cq_df.index = cq_df['time']
+    return cq_df
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="in-flight queue reconstruction benchmark")
+    parser.add_argument("-n", help="number of requests (10_000_000)", type=int, default=10_000_000)
+    parser.add_argument("-s", help="randomization seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.s)
+    starts = 1.7e9 + np.cumsum(rng.exponential(1e-4, args.n))
+    ends = starts + rng.exponential(1.0, args.n)
+    t0 = time.perf_counter()
+    times, q = in_flight(starts, ends)
+    t1 = time.perf_counter()
+    stats = summary(times, q)
+    t2 = time.perf_counter()
+    print(f"{args.n} requests: step function in {t1 - t0:.3f}s, statistics in {t2 - t1:.3f}s: {stats}")
@@ -0,0 +1,225 @@
+import argparse
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import metrics
+import queues
+import store
+import sweep
+from estimation import finite_difference, get_lam
+
+SUMMARY_FNAME = 'replication.csv'
+
+# Outputs of a replica whose confidence intervals decide when its sweep point has enough replicas
+OUTPUTS = ['in_service', 'mu_hat', 'p99_rtt']
+
+# Target relative half width of the 95% confidence intervals, and bounds on the replicas of a point
+PRECISION = 0.05
+MIN_REPLICAS = 3
+MAX_REPLICAS = 30
+
+# Two-sided 95% Student t quantiles for 1..30 degrees of freedom; the normal quantile beyond
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+        2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+Z_95 = 1.96
+
+
+def replica_outputs(rt, q_fname, point):
+    """Mean in_service, mean finite difference service rate and p99 round trip time of one run.
+
+    rt is the run's round trip files as (client, file name) pairs and q_fname its queue_size file
+    (see store.scan_dir); outputs that cannot be computed from them are NaN.
+    """
+    outputs = dict.fromkeys(OUTPUTS, np.nan)
+    q = store.read_queue_size(q_fname)
+    if len(q.get('timestamp', [])) > 2:
+        q_df = pd.DataFrame(q)
+        d = point['d'] if point['d'] > 0 else np.median(np.diff(queues.nanoseconds(q_df['timestamp']))) * 1e-9
+        outputs['in_service'] = (q_df['queue_size'] + q_df['batch_current_size']).mean()
+        outputs['mu_hat'] = finite_difference(q_df, get_lam(point['C'], point['w']), d, max(point['B'], 1)).mean()
+    r = store.read_round_trips(rt)
+    if r:
+        rtt = r['rtt'][r['ok'] == 0] if 'ok' in r else r['rtt']
+        if len(rtt):
+            outputs['p99_rtt'] = float(np.quantile(rtt, 0.99))
+    return outputs
+
+
+def point_files(dname, point):
+    rt = list(enumerate(metrics.round_trip_fnames(sweep.rt_fname(dname, point), point['C']), start=1))
+    return rt, sweep.q_fname(dname, point)
+
+
+def confidence_interval(values):
+    """Mean of the replicas' values and the relative half width of its 95% confidence interval."""
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values) < 2:
+        return (values.mean() if len(values) else np.nan), np.nan
+    mean = values.mean()
+    t = T_95[len(values) - 2] if len(values) - 1 <= len(T_95) else Z_95
+    half_width = t * values.std(ddof=1) / math.sqrt(len(values))
+    return mean, half_width / abs(mean) if mean != 0 else np.inf
+
+
+def summarize(replicas, precision=PRECISION):
+    """Summary of a sweep point from the outputs of its replicas.
+
+    Its precision is the largest relative half width of its outputs, and it has converged when that is
+    at most the target precision. The number of replicas it needs is extrapolated from the 1 / sqrt(n)
+    shrinking of that half width.
+    """
+    summary = {'replicas': len(replicas)}
+    relatives = []
+    for output in OUTPUTS:
+        mean, relative = confidence_interval([outputs[output] for outputs in replicas])
+        summary[output] = mean
+        summary[f'{output}_precision'] = relative
+        if np.isfinite(mean):
+            relatives.append(relative if np.isfinite(relative) else np.inf)
+    # Without replicas, or outputs, to go by, a point is as imprecise as can be
+    worst = max(relatives, default=np.inf)
+    summary['precision'] = worst
+    summary['converged'] = bool(worst <= precision)
+    summary['replicas_needed'] = (math.ceil(len(replicas) * (worst / precision) ** 2) if np.isfinite(worst)
+                                  else np.nan)
+    return summary
+
+
+class ReplicationController:
+    """Runs each sweep point's MC replicas until its outputs reach a target relative precision.
+
+    Every point first gets min_replicas replicas. After each round, the points whose confidence intervals
+    are still too wide get further replicas, the least precise ones first and in proportion to how many
+    more they need, up to max_replicas each. The total is bounded by a budget of MC replicas per point,
+    so the replicas that converged points do not need go to the noisy ones, e.g. near saturation.
+    """
+
+    def __init__(self, dname, manifest, config, MC, precision=PRECISION, min_replicas=MIN_REPLICAS,
+                 max_replicas=MAX_REPLICAS):
+        self.dname = dname
+        self.manifest = manifest
+        self.precision = precision
+        self.min_replicas = min_replicas
+        self.max_replicas = max_replicas
+        self.bases = [sweep.base_name(point) for point in sweep.expand(config, 1)]
+        self.budget = MC * len(self.bases)
+        self.outputs = {}
+        # Replicas run in this session that did not complete; they count against the budget
+        self.failed = set()
+
+    def replicas(self):
+        """Replicas of every point of the config, by the point's base name."""
+        replicas = {base: [] for base in self.bases}
+        for point in self.manifest['points']:
+            if sweep.base_name(point) in replicas:
+                replicas[sweep.base_name(point)].append(point)
+        return replicas
+
+    def observe(self, point):
+        if point['name'] not in self.outputs:
+            self.outputs[point['name']] = replica_outputs(*point_files(self.dname, point), point)
+        return self.outputs[point['name']]
+
+    def summary(self):
+        """One row per sweep point: its parameters, replicas, output estimates and achieved precision."""
+        rows = []
+        for base, points in self.replicas().items():
+            done = [point for point in points if point['done']]
+            row = {'name': base, **{key: points[0][key] for key in ['B', 'C', 't', 'w', 'd', 'n']},
+                   'lam': get_lam(points[0]['C'], points[0]['w'])}
+            rows.append(dict(row, **summarize([self.observe(point) for point in done], self.precision)))
+        return pd.DataFrame(rows)
+
+    def write_summary(self):
+        summary = self.summary()
+        fname = os.path.join(self.dname, SUMMARY_FNAME)
+        print(f"{summary['converged'].sum()} of {len(summary)} points converged, "
+              f"{summary['replicas'].sum()} replicas; writing {fname}")
+        summary.to_csv(fname, index=False)
+        return summary
+
+    def next_round(self, size):
+        """The replicas to run next, at least size of them unless the points need fewer; none when done."""
+        replicas = self.replicas()
+        summary = self.write_summary().set_index('name')
+        spent = int(summary['replicas'].sum()) + len(self.failed)
+
+        need = {}
+        for base, points in replicas.items():
+            n = int(summary.loc[base, 'replicas'])
+            if n < self.min_replicas:
+                need[base] = self.min_replicas - n
+            elif not summary.loc[base, 'converged'] and n < self.max_replicas:
+                needed = summary.loc[base, 'replicas_needed']
+                need[base] = int(min(self.max_replicas, needed if np.isfinite(needed) else self.max_replicas)) - n
+        # Points short of min_replicas get all their missing replicas, whatever the budget
+        chosen = []
+        for base in list(need):
+            if summary.loc[base, 'replicas'] < self.min_replicas:
+                chosen += [base] * need.pop(base)
+        # Then the least precise points, one replica each in turn, as the round size and budget allow
+        order = sorted(need, key=lambda base: -summary.loc[base, 'precision'])
+        slots = min(size - len(chosen), self.budget - spent - len(chosen))
+        while slots > 0 and any(need[base] > 0 for base in order):
+            for base in order:
+                if slots > 0 and need[base] > 0:
+                    chosen.append(base)
+                    need[base] -= 1
+                    slots -= 1
+
+        points = []
+        for base in chosen:
+            points.append(self.next_replica(replicas[base], points))
+        self.failed.update(point['name'] for point in points)
+        sweep.save_manifest(self.dname, self.manifest)
+        return points
+
+    def next_replica(self, points, chosen):
+        """A replica of a point that has not run, or not completed, yet; a new one if there is none."""
+        names = {point['name'] for point in chosen}
+        for point in sorted(points, key=lambda point: point['mc']):
+            if not point['done'] and point['name'] not in self.failed and point['name'] not in names:
+                return point
+        point = sweep.replica(points[0], max(point['mc'] for point in points) + 1)
+        self.manifest['points'].append(point)
+        points.append(point)
+        return point
+
+    def completed(self, points):
+        """Replicas of a round that completed no longer count as failed."""
+        self.failed.difference_update(point['name'] for point in points if point['done'])
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MC replication precision of the sweep points of data directories")
+    parser.add_argument("dnames", help="data directories", nargs='+')
+    parser.add_argument("-p", help=f"target relative half width of the 95%% CIs ({PRECISION})", type=float,
+                        default=PRECISION)
+    parser.add_argument("-o", help="output CSV file (replication.csv)", type=str, default=SUMMARY_FNAME)
+    args = parser.parse_args()
+
+    rows = []
+    for dname in args.dnames:
+        points = {}
+        for name_part, experiment in store.scan_dir(dname).items():
+            params = experiment['params']
+            point = {'B': params['MB'], **{key: params[key] for key in ['C', 't', 'w', 'd', 'n']}}
+            base = name_part.rsplit('_mc_', 1)[0]
+            points.setdefault(base, (point, []))[1].append(replica_outputs(experiment['rt'], experiment['q'], point))
+        for base, (point, replicas) in points.items():
+            rows.append(dict(dname=dname, name=base, **point, lam=get_lam(point['C'], point['w']),
+                             **summarize(replicas, args.p)))
+    if not rows:
+        print(f"No experiments in {' '.join(args.dnames)}")
+        sys.exit(1)
+    table = pd.DataFrame(rows)
+    print(table[['name', 'lam', 'replicas', 'precision', 'replicas_needed']]
+          .to_string(index=False))
+    print(f"Writing {len(table)} points to {args.o}")
+    table.to_csv(args.o, index=False)
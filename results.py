@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import csv
+import os.path
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from histogram import LatencyHistogram, histogram_fname
+
+# One fixed-width record per request
+RECORD_DTYPE = np.dtype([
+    ('i', 'i8'),  # request number
+    ('start', 'f8'),  # wall clock send time
+    ('end', 'f8'),  # wall clock completion time
+    ('rtt', 'f8'),  # round trip time in seconds
+    ('ok', 'i1'),  # 0 on success, otherwise the kind of failure (see OUTCOMES)
+    ('intended', 'f8'),  # wall clock time the schedule intended to send the request
+    ('ttft', 'f8'),  # time to first streamed token in seconds (NaN when not streaming)
+    ('itl_mean', 'f8'),  # mean inter-token gap in seconds (NaN when not streaming)
+    ('itl_max', 'f8'),  # max inter-token gap in seconds (NaN when not streaming)
+    ('tokens', 'i4'),  # generated tokens, -1 when neither streamed nor reported by the server
+    ('queue_time', 'f8'),  # queue time reported by the server in seconds (NaN if not reported)
+    ('client_queue', 'f8'),  # seconds of rtt spent waiting for an in-flight slot or a connection (NaN if unmeasured)
+])
+
+# Outcome of a request, stored in the ok column; every failure is non-zero, so ok == 0 still selects successes
+OK = 0
+HTTP_ERROR = 1  # the server answered with an error status
+TIMEOUT = 2  # the request's deadline, or the client timeout, passed first
+CONNECTION_ERROR = 3  # the connection failed or was reset
+SHED = 4  # never sent: every in-flight slot was taken
+ERROR = 5  # any other exception
+CANCELLED = 6  # still in flight when the run was stopped
+OUTCOMES = {OK: 'ok', HTTP_ERROR: 'http_error', TIMEOUT: 'timeout', CONNECTION_ERROR: 'connection_error',
+            SHED: 'shed', ERROR: 'error', CANCELLED: 'cancelled'}
+
+# Columns of the round trip CSV files read by the notebooks and calibrate.py
+CSV_COLUMNS = ['i', 'start', 'end', 'rtt', 'ok']
+
+# Extension of the append-only record stream (a sequence of .npy chunks in one file)
+RECORDS_EXT = '.npys'
+
+RING_CAPACITY = 1 << 16
+FLUSH_INTERVAL_SECONDS = 1.0
+
+# A producer finding a SharedRing full polls for room this often
+RING_WAIT_SECONDS = 0.001
+
+
+def records_fname(csv_fname):
+    """Name of the record stream written alongside a round trip CSV file."""
+    b, _ = os.path.splitext(csv_fname)
+    return b + RECORDS_EXT
+
+
+class ResultWriter:
+    """Bounded ring buffer of request records, flushed periodically to an append-only record stream.
+
+    Recording a request is a single slot write; a background task appends the pending slots to the
+    stream as one .npy chunk every FLUSH_INTERVAL_SECONDS, so at most one interval of rows is lost
+    if the sender dies. Without a file name the chunks are kept in memory instead, or pushed to a sink
+    (a SharedRing) when given. Every record is also counted in a latency histogram, written next to the
+    stream on close, and in the telemetry of the process when metrics (a telemetry.ClientMetrics) is given.
+    """
+
+    def __init__(self, fname, capacity=RING_CAPACITY, flush_interval=FLUSH_INTERVAL_SECONDS, sink=None,
+                 metrics=None):
+        self.fname = fname
+        self.ring = np.zeros(capacity, dtype=RECORD_DTYPE)
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.head = 0  # total records written to the ring
+        self.flushed = 0  # total records appended to the file
+        self.file = open(fname, 'wb') if fname else None
+        self.chunks = []
+        self.sink = sink
+        self.metrics = metrics
+        self.task = None
+        self.histogram = LatencyHistogram()
+
+    def append(self, record):
+        """Stores one record tuple in the next ring slot."""
+        if self.head - self.flushed == self.capacity:
+            self.flush()
+        self.ring[self.head % self.capacity] = record
+        self.head += 1
+        if record[4]:
+            self.histogram.observe_failure(record[1], record[2])
+        else:
+            self.histogram.observe(record[3], record[1], record[2])
+        if self.metrics is not None:
+            self.metrics.completed(record)
+
+    def pending(self):
+        """Copies the records not yet written to the file out of the ring."""
+        first, last = self.flushed % self.capacity, self.head % self.capacity
+        if self.head - self.flushed == 0:
+            return self.ring[:0].copy()
+        if first < last:
+            return self.ring[first:last].copy()
+        return np.concatenate((self.ring[first:], self.ring[:last]))
+
+    def flush(self):
+        """Appends the pending records to the file as one chunk."""
+        chunk = self.pending()
+        self.flushed = self.head
+        if len(chunk) and self.sink is not None:
+            self.sink.push(chunk)
+        elif len(chunk) and self.file is None:
+            self.chunks.append(chunk)
+        elif len(chunk):
+            np.save(self.file, chunk, allow_pickle=False)
+            self.file.flush()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        """Starts the background flusher on the running event loop."""
+        self.task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.histogram.save(histogram_fname(self.fname))
+
+    def records(self):
+        """All records written, once the writer is closed."""
+        if self.file is not None:
+            return read_records(self.fname)
+        if not self.chunks:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.concatenate(self.chunks)
+
+
+class SharedRing:
+    """Single producer, single consumer ring of request records in shared memory.
+
+    A worker process pushes the chunks its ResultWriter flushes and the parent drains them. The header
+    holds the number of records written and read so far; each side only advances its own count, once
+    the records are copied, so no lock is needed. Created without a name, or attached to an existing
+    ring by name.
+    """
+
+    def __init__(self, capacity=RING_CAPACITY, name=None):
+        header = 2 * np.dtype(np.int64).itemsize
+        self.shm = shared_memory.SharedMemory(name, create=name is None, size=header + capacity * RECORD_DTYPE.itemsize)
+        self.capacity = capacity
+        self.counts = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.ring = np.ndarray(capacity, dtype=RECORD_DTYPE, buffer=self.shm.buf, offset=header)
+        if name is None:
+            self.counts[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def push(self, chunk):
+        """Copies records into the ring, waiting for the consumer while it is full."""
+        while len(chunk):
+            written, read = self.counts.tolist()
+            n = min(len(chunk), self.capacity - (written - read))
+            if n == 0:
+                time.sleep(RING_WAIT_SECONDS)
+                continue
+            first = written % self.capacity
+            k = min(n, self.capacity - first)
+            self.ring[first:first + k] = chunk[:k]
+            self.ring[:n - k] = chunk[k:n]
+            self.counts[0] = written + n
+            chunk = chunk[n:]
+
+    def drain(self):
+        """Copies out and releases every record pushed since the last drain."""
+        written, read = self.counts.tolist()
+        first, last = read % self.capacity, written % self.capacity
+        if written == read:
+            records = self.ring[:0].copy()
+        elif first < last:
+            records = self.ring[first:last].copy()
+        else:
+            records = np.concatenate((self.ring[first:], self.ring[:last]))
+        self.counts[1] = written
+        return records
+
+    def close(self, unlink=False):
+        # The views into the buffer must go before it is closed
+        del self.counts, self.ring
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def outcome_counts(records):
+    """Number of requests of each outcome that occurred, by outcome name."""
+    codes, counts = np.unique(records['ok'], return_counts=True)
+    return {OUTCOMES.get(code, str(code)): count for code, count in zip(codes.tolist(), counts.tolist())}
+
+
+def read_records(fname):
+    """Reads a record stream back into one structured array, ignoring a torn final chunk."""
+    chunks = []
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        while f.tell() < size:
+            try:
+                chunks.append(np.load(f, allow_pickle=False))
+            except (ValueError, EOFError):
+                print(f"Ignoring truncated chunk at offset {f.tell()} of {fname}")
+                break
+    if not chunks:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.concatenate(chunks)
+
+
+def export_csv(records, csv_fname):
+    """Writes records in the round trip CSV format (no header: i, start, end, rtt, ok)."""
+    with open(csv_fname, mode="w", newline='') as f:
+        w = csv.writer(f)
+        w.writerows(zip(*(records[col].tolist() for col in CSV_COLUMNS)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="record stream to round trip CSV converter")
+    parser.add_argument("records", help="record stream file(s)", nargs='+')
+    args = parser.parse_args()
+
+    for fname in args.records:
+        csv_fname = os.path.splitext(fname)[0] + '.csv'
+        print(f"Writing {fname} to {csv_fname}")
+        export_csv(read_records(fname), csv_fname)
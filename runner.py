@@ -0,0 +1,46 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+import sender
+from histogram import LatencyHistogram, format_summary
+
+
+async def run_point(inf_url="http://127.0.0.1:8080/generate", num_clients=1, num_requests_per_client=20_000,
+                    mean_interarrival_micro_s=1_000_000, max_output_tokens=100, seed=1, poll_interval=5,
+                    scrape_url=None, prom_url=metrics.PROMETHEUS_URL, rt_fname=None, q_fname=None, stream=False,
+                    executor=None, on_sample=None, stop=None, arrival=None, overload=None, telemetry=None, worker=0):
+    """Runs one sweep point with the sender and the metrics collector on the running event loop.
+
+    Returns the request records of every client concatenated, and the queue samples collected while
+    they ran. Round trip and queue_size files are only written when rt_fname and q_fname are given, and
+    no metrics are collected when poll_interval is None. Setting stop (e.g. from on_sample) ends the
+    run early. arrival is the arrival process of the requests (see workload.generate) and overload the
+    overload mode of the clients (see sender.Overload). With telemetry (a telemetry.Telemetry), the
+    clients update their rows of the given worker.
+    """
+    stop = stop or asyncio.Event()
+    collector = None
+    if poll_interval is not None:
+        collector = asyncio.create_task(metrics.collect(stop, poll_interval, scrape_url, prom_url, q_fname,
+                                                        on_sample))
+    try:
+        records = await sender.run_clients(num_clients, seed, num_requests_per_client,
+                                           mean_interarrival_micro_s * 1e-6, max_output_tokens, None, inf_url,
+                                           stream, rt_fname, executor, stop, arrival, overload, telemetry, worker)
+    finally:
+        stop.set()
+        samples = await collector if collector else np.zeros(0, dtype=metrics.SAMPLE_DTYPE)
+    records = np.concatenate(records)
+    print(f"All {num_clients} clients: {format_summary(LatencyHistogram().observe_records(records).summary())}")
+    return records, samples
+
+
+def run_point_sync(executor=None, **kwargs):
+    """Runs run_point on a fresh event loop, creating a process pool for the other clients when needed."""
+    if executor is None and kwargs.get('num_clients', 1) > 1:
+        with ProcessPoolExecutor(kwargs['num_clients'] - 1) as executor:
+            return asyncio.run(run_point(executor=executor, **kwargs))
+    return asyncio.run(run_point(executor=executor, **kwargs))
@@ -1,15 +1,22 @@
 import argparse
-import atexit
-import csv
-import itertools
+import json
+import math
+import multiprocessing
 import os.path
-import statistics
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import Process
 
 import aiohttp
 import asyncio
 import time
 import numpy as np
+import yaml
+
+import workload
+from histogram import LatencyHistogram, format_summary, histogram_fname, merged
+from telemetry import ClientMetrics, Telemetry
+from results import (CANCELLED, CONNECTION_ERROR, ERROR, HTTP_ERROR, OK, RECORD_DTYPE, RING_CAPACITY, SHED, TIMEOUT,
+                     ResultWriter, SharedRing, export_csv, outcome_counts, records_fname)
 
 # Inference server details
 INFERENCE_URL = "http://127.0.0.1:8080/generate"
@@ -20,11 +27,6 @@ NUM_REQUESTS = 20_000  # 20,000 requests
 # Mean wait time in microseconds (100 microseconds)
 MEAN_WAIT_TIME_SECONDS = 100e-6
 
-# Zipf distribution parameters
-ZIPF_PARAM = 2.0  # Zipf distribution parameter
-MAX_TOKENS_RANGE = 8000  # Maximum range of tokens
-MIN_TOKENS = 5  # Minimum number of tokens
-
 CSV_FILE="round_trips.csv"
 
 NUM_CLIENTS=1
@@ -34,112 +36,551 @@ SEED_BASE=1
 
 MAX_TOKENS = None
 
-# List of 100 tourist points of interest
-POINTS_OF_INTEREST = [
-    "Eiffel Tower, Paris", "Statue of Liberty, New York", "Great Wall of China",
-    "Colosseum, Rome", "Machu Picchu, Peru", "Sydney Opera House, Sydney",
-    "Taj Mahal, India", "Mount Fuji, Japan", "Christ the Redeemer, Rio de Janeiro",
-    "Big Ben, London", "Grand Canyon, Arizona", "Santorini, Greece",
-    "Niagara Falls, Canada/USA", "The Louvre, Paris", "Forbidden City, Beijing",
-    "Burj Khalifa, Dubai", "Golden Gate Bridge, San Francisco", "Mount Kilimanjaro, Tanzania",
-    "Pyramids of Giza, Egypt", "Acropolis, Athens", "Table Mountain, South Africa",
-    # (more points can be added as needed up to 100)
-]
+# Workload trace file prefix to replay instead of generating the workload (see workload.py)
+TRACE_FILE = None
 
-# Pre-compute max_tokens using Zipf distribution for all requests
-# precomputed_max_tokens = [max(np.random.zipf(ZIPF_PARAM), MIN_TOKENS) for _ in range(NUM_REQUESTS)]
-precomputed_max_tokens = None
-# Pre-compute sleep times using exponential distribution with mean 100 microseconds for all requests
-precomputed_sleep_times = None
+NAN = math.nan
 
-next_no = 0
-rtts = []
+# Stream tokens from /generate_stream and record token level timings
+STREAM = False
 
+# Arrival process of the requests (see workload.generate), a Poisson process by default
+ARRIVAL = None
 
-# Function to send a request to the inference server
-async def send_request(session, prompt, max_tokens):
-    global next_no, rtts
-    """Sends a POST request to the Hugging Face inference server."""
-    payload = {
-        "inputs": prompt,
-        "parameters": {
-            "max_new_tokens": max_tokens
-        }
-    }
+# Overload mode (see Overload): a dict of deadline, max_in_flight and policy, None for no overload mode
+OVERLOAD = None
+
+# Port to serve the clients' telemetry on (see telemetry.py) and file to snapshot it to, None for neither
+TELEMETRY_PORT = None
+TELEMETRY_FILE = None
+TELEMETRY = None
+
+# Worker processes a client's requests are split over (see run_sharded), 1 to send them from this process
+SHARDS = 1
+
+# Shards start this long after they are all ready, and their records are drained this often
+SHARD_START_LEAD_SECONDS = 0.2
+SHARD_FLUSH_INTERVAL_SECONDS = 0.1
+DRAIN_INTERVAL_SECONDS = 0.05
+BARRIER_TIMEOUT_SECONDS = 60
+
+
+# Request bodies are JSON, written once per distinct (prompt, max_new_tokens) by encode_payloads
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Responses are read in chunks of up to this many bytes and dropped
+DISCARD_CHUNK = 1 << 16
+
+
+def encode_payloads(trace):
+    """Request body of every request of a trace, as bytes.
+
+    A workload only has a few distinct (prompt, max_new_tokens) pairs, so each is JSON encoded once
+    and the requests share the encoded bodies; nothing is built or encoded per request.
+    """
+    keys = trace['prompt'].astype(np.int64) << 32 | trace['max_tokens'].astype(np.int64)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    bodies = [json.dumps({"inputs": workload.PROMPTS[key >> 32],
+                          "parameters": {"max_new_tokens": key & 0xffffffff}}).encode() for key in unique.tolist()]
+    return [bodies[j] for j in inverse.tolist()]
 
+
+def generated_tokens(response):
+    """Generated tokens from TGI's x-generated-tokens header, -1 if absent."""
+    value = response.headers.get('x-generated-tokens')
+    return int(value) if value is not None else -1
+
+
+async def discard_body(response):
+    """Reads the response body to the end without decoding or keeping it."""
+    async for _ in response.content.iter_chunked(DISCARD_CHUNK):
+        pass
+
+
+def queue_time(response):
+    """Server side queue time in seconds from TGI's x-queue-time header (milliseconds), NaN if absent."""
+    value = response.headers.get('x-queue-time')
+    return float(value) * 1e-3 if value is not None else NAN
+
+
+async def read_stream(response, t_start):
+    """Consumes TGI's server-sent events line by line, timing the tokens as they arrive.
+
+    Returns (ttft, mean inter-token gap, max inter-token gap, tokens, ok), times in seconds.
+    Every "data:" event carries one generated token, so only the error event is ever decoded.
+    """
+    tokens = 0
+    t_first = t_prev = 0
+    gap_max = 0
+    async for line in response.content:
+        if not line.startswith(b'data:'):
+            continue
+        t = time.perf_counter_ns()
+        if line.startswith(b'data:{"error"'):
+            print(f"Stream failed with: {json.loads(line[5:]).get('error')}")
+            return NAN, NAN, NAN, tokens, 1
+        if tokens == 0:
+            t_first = t
+        else:
+            gap_max = max(gap_max, t - t_prev)
+        t_prev = t
+        tokens += 1
+    if tokens == 0:
+        return NAN, NAN, NAN, 0, 1
+    gap_mean = (t_prev - t_first) / (tokens - 1) * 1e-9 if tokens > 1 else NAN
+    return (t_first - t_start) * 1e-9, gap_mean, gap_max * 1e-9 if tokens > 1 else NAN, tokens, 0
+
+
+class Overload:
+    """Overload mode of a client: a deadline per request and an explicit cap on the requests in flight.
+
+    When every one of the max_in_flight slots is taken, the 'queue' policy makes a request wait for a
+    slot and the 'shed' policy drops it, recorded as shed. The deadline runs from the request's intended
+    send time and covers that wait, so a request sent late has less of it left. The connection pool is
+    sized to the cap, so it never queues requests silently; time spent waiting for a slot or a pooled
+    connection is the request's client_queue.
+    """
+
+    def __init__(self, max_in_flight=None, policy='queue', deadline=None):
+        if policy not in ('queue', 'shed'):
+            raise ValueError(f"unknown in-flight policy {policy}, not queue or shed")
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.deadline = deadline
+        self.slots = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    def shed(self):
+        """Whether a request due now is dropped."""
+        return self.policy == 'shed' and self.slots is not None and self.slots.locked()
+
+    async def post(self, session, url, stream, body, t_start, waits):
+        if self.slots is None:
+            return await post(session, url, stream, body, t_start, waits)
+        t = time.perf_counter_ns()
+        async with self.slots:
+            waits['ns'] += time.perf_counter_ns() - t
+            return await post(session, url, stream, body, t_start, waits)
+
+
+def pool_wait_trace_config():
+    """aiohttp tracing that adds the time a request waits for a pooled connection to its waits['ns']."""
+    async def queued_start(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['queued'] = time.perf_counter_ns()
+
+    async def queued_end(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['ns'] += time.perf_counter_ns() - context.trace_request_ctx['queued']
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(queued_start)
+    trace_config.on_connection_queued_end.append(queued_end)
+    return trace_config
+
+
+async def post(session, url, stream, body, t_start, waits=None):
+    """POSTs a pre-encoded request body and reads the response.
+
+    Returns the outcome and the token timings (ttft, mean and max inter-token gap, tokens, queue time).
+    The generated text of a /generate response is never used, so its body is read and dropped unparsed;
+    the number of tokens comes from the response headers.
+    """
+    async with session.post(url, data=body, headers=JSON_HEADERS, trace_request_ctx=waits) as response:
+        if response.status == 200 and stream:
+            ttft, itl_mean, itl_max, tokens, failed = await read_stream(response, t_start)
+            return (HTTP_ERROR if failed else OK), ttft, itl_mean, itl_max, tokens, queue_time(response)
+        if response.status == 200:
+            await discard_body(response)
+            return OK, NAN, NAN, NAN, generated_tokens(response), queue_time(response)
+        print(f"Request failed with status: {response.status}")
+        return HTTP_ERROR, NAN, NAN, NAN, -1, NAN
+
+
+# Function to send a request to the inference server
+async def send_request(session, url, stream, results, req_no, body, intended, overload=None):
+    """Sends a pre-encoded POST request body to the Hugging Face inference server and records it in results.
+
+    Every outcome is recorded, failures included, with the kind of failure in the ok column (see
+    results.OUTCOMES), so the slowest requests of an overloaded run do not vanish from its results.
+    With overload (see Overload), the request may be shed or wait for a slot first and ends at its deadline.
+    A request cancelled in flight, as when the run is stopped, is recorded as cancelled before the
+    cancellation propagates.
+    """
+    start = time.time()
+    t_start = time.perf_counter_ns()
+    waits = {'ns': 0, 'queued': 0} if overload is not None else None
     try:
-        start = time.time()
-        req_no = next_no
-        next_no += 1
-        async with session.post(INFERENCE_URL, json=payload) as response:
-            if response.status == 200:
-                data = await response.json()
-                end = time.time()
-                rtts.append([req_no, start, end, end - start, 0])
-                # print(f"Response: {data}")
-            else:
-                end = time.time()
-                rtts.append([req_no, start, end, end - start, 1])
-                print(f"Request failed with status: {response.status}")
+        if overload is None:
+            outcome = await post(session, url, stream, body, t_start)
+        elif overload.shed():
+            outcome = SHED, NAN, NAN, NAN, -1, NAN
+        else:
+            timeout = overload.deadline - (start - intended) if overload.deadline else None
+            if timeout is not None and timeout <= 0:
+                raise asyncio.TimeoutError
+            outcome = await asyncio.wait_for(overload.post(session, url, stream, body, t_start, waits), timeout)
+    except asyncio.TimeoutError:
+        outcome = TIMEOUT, NAN, NAN, NAN, -1, NAN
+    except asyncio.CancelledError:
+        rtt = (time.perf_counter_ns() - t_start) * 1e-9
+        results.append((req_no, start, start + rtt, rtt, CANCELLED, intended, NAN, NAN, NAN, -1, NAN,
+                        waits['ns'] * 1e-9 if waits is not None else NAN))
+        raise
+    except (aiohttp.ClientConnectionError, OSError) as e:
+        print(f"Connection failed: {e!r}")
+        outcome = CONNECTION_ERROR, NAN, NAN, NAN, -1, NAN
     except Exception as e:
-        conn = session.connector
-        print(f"An error occurred: {e}")
+        print(f"An error occurred: {e!r}")
+        outcome = ERROR, NAN, NAN, NAN, -1, NAN
+    rtt = (time.perf_counter_ns() - t_start) * 1e-9 if outcome[0] != SHED else 0.0
+    results.append((req_no, start, start + rtt, rtt, outcome[0], intended, *outcome[1:],
+                    waits['ns'] * 1e-9 if waits is not None else NAN))
+
+
+async def release_schedule(offsets, t0):
+    """Yields (first, last) index ranges of requests that are due, paced by absolute monotonic deadlines.
+
+    Deadlines are offsets from the monotonic start time t0, so a late wake-up does not push back the
+    requests that follow it; when the loop falls behind, every request already due is released at once.
+    """
+    i, n = 0, len(offsets)
+    while i < n:
+        j = int(np.searchsorted(offsets, time.monotonic() - t0, side='right'))
+        if j > i:
+            yield i, j
+            i = j
+        if i < n:
+            await asyncio.sleep(max(0.0, offsets[i] - (time.monotonic() - t0)))
+
+
+def client_trace(c, C, seed=SEED_BASE, num_requests=NUM_REQUESTS, mean_wait_time_seconds=MEAN_WAIT_TIME_SECONDS,
+                 max_tokens=MAX_TOKENS, trace_file=TRACE_FILE, arrival=ARRIVAL):
+    """Workload of client c of C, replayed from trace_file when given, otherwise generated from the seed."""
+    if trace_file:
+        fname = workload.trace_fname(trace_file, c, C)
+        print(f"Replaying workload trace {fname}")
+        return workload.load_trace(fname)
+    return workload.generate_client(seed, c, C, num_requests, mean_wait_time_seconds, max_tokens, arrival)
+
+
+async def run_users(session, url, stream, results, trace, bodies, users, stop=None, overload=None, metrics=None):
+    """Sends the requests of a trace from a fixed population of closed loop users.
+
+    Each user sends a request, waits for its response, then thinks for the request's sleep_time before
+    taking the next request of the trace. Setting the stop event cancels the users and their requests,
+    which are recorded as cancelled.
+    """
+    sleep_times = trace['sleep_time'].tolist()
+    # Shared by the users, so every request of the trace is sent exactly once
+    next_request = iter(range(len(trace)))
+
+    async def user():
+        for i in next_request:
+            if metrics is not None:
+                metrics.dispatched(0.0)
+            await send_request(session, url, stream, results, i, bodies[i], time.time(), overload)
+            await asyncio.sleep(sleep_times[i])
+
+    tasks = [asyncio.create_task(user()) for _ in range(min(users, len(trace)))]
+    everyone = asyncio.gather(*tasks)
+    if stop is None:
+        await everyone
+        return
+    stopped = asyncio.create_task(stop.wait())
+    await asyncio.wait([everyone, stopped], return_when=asyncio.FIRST_COMPLETED)
+    if stop.is_set():
+        print(f"Stopped {users} users")
+        everyone.cancel()
+        await asyncio.gather(everyone, return_exceptions=True)
+    stopped.cancel()
+
+
+def client_fname(fname, c, C):
+    """Round trip file of client c of C."""
+    if C > 1:
+        b, e = os.path.splitext(fname)
+        return f'{b}_{c}{e}'
+    return fname
+
+
+async def run_client(trace, url=INFERENCE_URL, stream=False, fname=None, stop=None, users=None, epoch=None,
+                     offset=0.0, sink=None, overload=None, telemetry=None):
+    """Sends the requests of a workload trace on the running event loop and returns their records.
+
+    With fname, records are also streamed to its record stream file and exported to fname as round trip CSV.
+    Setting the stop event ends the run early: no more requests are sent and those in flight are cancelled
+    (recorded as cancelled, see send_request).
+    With users, the trace is sent by that many closed loop users (see run_users) instead of on its schedule.
+    The schedule starts at the monotonic time epoch (now by default), its first request due offset seconds
+    later; with a sink (see results.SharedRing) the records are pushed there instead of returned.
+    overload holds the arguments of Overload (deadline, max_in_flight and policy) to run in overload mode,
+    and telemetry the address of this process's row of client telemetry (see telemetry.Telemetry.address).
+    """
+    sleep_times = trace['sleep_time']
+    bodies = encode_payloads(trace)
+    metrics = ClientMetrics(telemetry) if telemetry else None
+    if sink is not None:
+        results = ResultWriter(None, flush_interval=SHARD_FLUSH_INTERVAL_SECONDS, sink=sink, metrics=metrics)
+    else:
+        results = ResultWriter(records_fname(fname) if fname else None,
+                               capacity=RING_CAPACITY if fname else len(trace) + 1, metrics=metrics)
+    results.start()
+    if metrics is not None:
+        metrics.start()
+    trace_configs = []
+    if overload is not None:
+        overload = Overload(**overload)
+        # The cap is the only limit on the requests in flight, and the deadline the only timeout
+        conn = aiohttp.connector.TCPConnector(limit=overload.max_in_flight or 0, limit_per_host=0)
+        timeout = aiohttp.ClientTimeout(total=None if overload.deadline else 1200)
+        trace_configs.append(pool_wait_trace_config())
+    else:
+        conn = aiohttp.connector.TCPConnector(limit=1000, limit_per_host=1000)
+        timeout = aiohttp.ClientTimeout(total=1200)
+    t0 = time.monotonic() if epoch is None else epoch
+    try:
+        async with aiohttp.ClientSession(connector=conn, timeout=timeout, trace_configs=trace_configs) as session:
+            if users:
+                await asyncio.sleep(max(0.0, t0 - time.monotonic()))
+                await run_users(session, url, stream, results, trace, bodies, users, stop, overload, metrics)
+            else:
+                tasks = []
+                # Wall clock time of the epoch, for the intended send times
+                start_time = time.time() - (time.monotonic() - t0)
+                # Absolute send offsets: request i is due once the gaps before it have elapsed
+                offsets = offset + np.concatenate(([0.0], np.cumsum(sleep_times[:-1])))[:len(trace)]
+
+                async for first, last in release_schedule(offsets, t0):
+                    # Checked before sending, so every task cancelled here has a request in flight to record
+                    if stop is not None and stop.is_set():
+                        print(f"Stopped after {first} of {len(trace)} requests")
+                        for task in tasks:
+                            task.cancel()
+                        break
+                    if metrics is not None:
+                        now = time.monotonic() - t0
+                        for i in range(first, last):
+                            metrics.dispatched(now - offsets[i])
+                    for i in range(first, last):
+                        # Schedule the request
+                        task = asyncio.create_task(send_request(session, url, stream, results, i, bodies[i],
+                                                                start_time + offsets[i], overload))
+                        tasks.append(task)
+
+                # Wait for all tasks to complete
+                await asyncio.gather(*tasks, return_exceptions=stop is not None)
+    finally:
+        # Whatever happens, everything recorded so far ends up in the record stream
+        await results.close()
+        if metrics is not None:
+            await metrics.close()
+
+    records = results.records()
+    if fname:
+        print(f"Writing requests to {fname}")
+        export_csv(records, fname)
+    return records
+
+
+def run_client_process(c, C, seed, num_requests, mean_wait_time_seconds, max_tokens, trace_file, url, stream, fname,
+                       arrival=None, overload=None, telemetry=None):
+    """Runs one client in a worker process on its own event loop."""
+    trace = client_trace(c, C, seed, num_requests, mean_wait_time_seconds, max_tokens, trace_file, arrival)
+    return asyncio.run(run_client(trace, url, stream, client_fname(fname, c, C) if fname else None,
+                                  users=workload.closed_users(arrival), overload=overload, telemetry=telemetry))
+
+
+def run_shard(trace, url, stream, users, offset, ring_name, barrier, epoch, cpu, overload=None, telemetry=None):
+    """Runs one shard of run_sharded in a worker process, pinned to a core, pushing its records to a ring."""
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    ring = SharedRing(name=ring_name)
+    # Once for every shard to be ready, once more for the epoch the parent sets in between
+    barrier.wait(BARRIER_TIMEOUT_SECONDS)
+    barrier.wait(BARRIER_TIMEOUT_SECONDS)
+    try:
+        asyncio.run(run_client(trace, url, stream, users=users, epoch=epoch.value, offset=offset, sink=ring,
+                               overload=overload, telemetry=telemetry))
+    finally:
+        ring.close()
+
+
+def run_sharded(trace, num_shards, url=INFERENCE_URL, stream=False, fname=None, users=None, seed=SEED_BASE,
+                first_cpu=0, overload=None, telemetry=None, c=1, epoch=None):
+    """Sends the requests of a workload trace from num_shards worker processes and returns their records.
+
+    The trace is split into shards that superpose to its schedule (see workload.split_shards), so one
+    aggregate rate is generated by several event loops. The workers are pinned to consecutive cores from
+    first_cpu, start on a barrier at a common monotonic epoch and push their records into shared memory
+    rings, which this process drains into one record stream and latency histogram. The records, numbered
+    as in trace and sorted by send time, are exported to fname as one round trip CSV. Closed loop users
+    and the in-flight cap of overload are divided among the shards. With telemetry (a telemetry.Telemetry
+    with at least num_shards shards), each shard updates its row of client c. The shards start at the
+    monotonic time epoch when given, else SHARD_START_LEAD_SECONDS after they are all ready.
+    """
+    start_at = epoch
+    shards = workload.split_shards(np.random.default_rng(seed), trace, num_shards, closed=bool(users))
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_setaffinity') else None
+    barrier = multiprocessing.Barrier(num_shards + 1)
+    epoch = multiprocessing.Value('d', 0.0, lock=False)
+    rings = [SharedRing() for _ in shards]
+    procs = []
+    for k, ((indices, offset, part), ring) in enumerate(zip(shards, rings)):
+        shard_users = users // num_shards + (k < users % num_shards) if users else None
+        shard_overload = overload
+        if overload and overload.get('max_in_flight'):
+            cap = overload['max_in_flight']
+            shard_overload = dict(overload, max_in_flight=max(1, cap // num_shards + (k < cap % num_shards)))
+        cpu = cpus[(first_cpu + k) % len(cpus)] if cpus else None
+        p = Process(target=run_shard, args=(part, url, stream, shard_users, offset, ring.name, barrier, epoch, cpu,
+                                            shard_overload, telemetry.address(c, k) if telemetry else None),
+                    name=f'shard-{k + 1}')
+        p.start()
+        procs.append(p)
+
+    histogram = LatencyHistogram()
+    chunks = []
+    file = open(records_fname(fname), 'wb') if fname else None
+    try:
+        barrier.wait(BARRIER_TIMEOUT_SECONDS)
+        epoch.value = start_at if start_at is not None else time.monotonic() + SHARD_START_LEAD_SECONDS
+        barrier.wait(BARRIER_TIMEOUT_SECONDS)
+        print(f"Started {num_shards} shards")
+        while True:
+            # Whatever a shard pushed before it exited is in its ring by the drain that follows
+            running = any(p.is_alive() for p in procs)
+            for (indices, _, _), ring in zip(shards, rings):
+                chunk = ring.drain()
+                if not len(chunk):
+                    continue
+                chunk['i'] = indices[chunk['i']]
+                histogram.observe_records(chunk)
+                chunks.append(chunk)
+                if file is not None:
+                    np.save(file, chunk, allow_pickle=False)
+                    file.flush()
+            if not running:
+                break
+            time.sleep(DRAIN_INTERVAL_SECONDS)
+    finally:
+        for p in procs:
+            p.join()
+        for ring in rings:
+            ring.close(unlink=True)
+        if file is not None:
+            file.close()
+
+    records = np.concatenate(chunks) if chunks else np.zeros(0, dtype=RECORD_DTYPE)
+    records = records[np.argsort(records['start'], kind='stable')]
+    if fname:
+        histogram.save(histogram_fname(fname))
+        print(f"Writing requests of {num_shards} shards to {fname}")
+        export_csv(records, fname)
+    return records
+
+
+async def run_clients(C=NUM_CLIENTS, seed=SEED_BASE, num_requests=NUM_REQUESTS,
+                      mean_wait_time_seconds=MEAN_WAIT_TIME_SECONDS, max_tokens=MAX_TOKENS, trace_file=TRACE_FILE,
+                      url=INFERENCE_URL, stream=False, fname=None, executor=None, stop=None, arrival=None,
+                      overload=None, telemetry=None, worker=0):
+    """Runs C clients and returns their records, one array per client.
+
+    Client 1 runs on the running event loop; clients 2..C run in worker processes of executor
+    (a concurrent.futures.ProcessPoolExecutor that can be reused across runs). Without an executor, a
+    pool of C - 1 processes is created for the run and shut down after it. The stop event of run_client
+    only reaches client 1. With telemetry (a telemetry.Telemetry), every client updates its row of the
+    given worker.
+    """
+
+    def address(c):
+        return telemetry.address(c, worker=worker) if telemetry else None
+
+    own_executor = executor is None and C > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(C - 1)
+    try:
+        loop = asyncio.get_running_loop()
+        others = [loop.run_in_executor(executor, run_client_process, c, C, seed, num_requests,
+                                       mean_wait_time_seconds, max_tokens, trace_file, url, stream, fname, arrival,
+                                       overload, address(c))
+                  for c in range(2, C + 1)]
+        trace = client_trace(1, C, seed, num_requests, mean_wait_time_seconds, max_tokens, trace_file, arrival)
+        first = await run_client(trace, url, stream, client_fname(fname, 1, C) if fname else None, stop,
+                                 workload.closed_users(arrival), overload=overload, telemetry=address(1))
+        return [first] + list(await asyncio.gather(*others))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 # Function to run the requests with precomputed max tokens and sleep times
 async def run_requests(c, C):
     """Runs the loop to send requests with precomputed delays and max tokens."""
-    np.random.seed(SEED_BASE + c)
-    global CSV_FILE
-    conn = aiohttp.connector.TCPConnector(limit=1000, limit_per_host=1000)
-    timeout = aiohttp.ClientTimeout(total=1200)
-    async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
-        print(f"running client {c} of {C}")
-        tasks = []
-        start_time = time.time()  # Track the start time
-
-        for i in range(NUM_REQUESTS):
-            max_tokens = precomputed_max_tokens[i]
-            prompt = f"Tell me more about {np.random.choice(POINTS_OF_INTEREST)}."
-
-            # Schedule the request
-            task = asyncio.create_task(send_request(session, prompt, max_tokens))
-            tasks.append(task)
-
-            # Wait for the precomputed sleep time
-            await asyncio.sleep(precomputed_sleep_times[i])
-
-        # Wait for all tasks to complete
-        await asyncio.gather(*tasks)
-
-        end_time = time.time()  # Track the end time
-        total_time_taken = end_time - start_time
-        print(f"Total number of requests sent: {NUM_REQUESTS}")
-        print(f"Total time taken: {total_time_taken:.2f} seconds")
-        print(f"Mean time taken: {statistics.mean(itertools.chain.from_iterable(rtts)):.2f} seconds")
-        if C > 1:
-            b, e = os.path.splitext(CSV_FILE)
-            fname = f'{b}_{c}{e}'
-        else:
-            fname = CSV_FILE
-        with open(fname, mode="w") as f:
-            print(f"Writing requests to {fname}")
-            w = csv.writer(f)
-            w.writerows(rtts)
+    trace = client_trace(c, C, SEED_BASE, NUM_REQUESTS, MEAN_WAIT_TIME_SECONDS, MAX_TOKENS, TRACE_FILE, ARRIVAL)
+    num_requests = len(trace)
+    print(f"running client {c} of {C}")
+    start_time = time.time()  # Track the start time
+    fname = client_fname(CSV_FILE, c, C)
+    if SHARDS > 1:
+        records = run_sharded(trace, SHARDS, INFERENCE_URL, STREAM, fname, workload.closed_users(ARRIVAL),
+                              [SEED_BASE, c], first_cpu=(c - 1) * SHARDS, overload=OVERLOAD, telemetry=TELEMETRY, c=c)
+    else:
+        records = await run_client(trace, INFERENCE_URL, STREAM, fname, users=workload.closed_users(ARRIVAL),
+                                   overload=OVERLOAD, telemetry=TELEMETRY.address(c) if TELEMETRY else None)
+    end_time = time.time()  # Track the end time
+    total_time_taken = end_time - start_time
+
+    lateness = records['start'] - records['intended']
+    send_span = records['start'].max() - records['start'].min() if len(records) else 0
+    print(f"Total number of requests sent: {num_requests}")
+    if num_requests > 1 and send_span > 0 and workload.closed_users(ARRIVAL):
+        # Closed loop users send as fast as the responses come back, there is no target
+        print(f"Achieved send rate of {workload.closed_users(ARRIVAL)} users: "
+              f"{(len(records) - 1) / send_span:.2f} req/s")
+    elif num_requests > 1 and send_span > 0:
+        print(f"Target send rate: {(num_requests - 1) / trace['sleep_time'][:-1].sum():.2f} req/s, "
+              f"achieved send rate: {(len(records) - 1) / send_span:.2f} req/s")
+    if len(records):
+        print(f"Send lateness: mean {lateness.mean() * 1e3:.3f} ms, max {lateness.max() * 1e3:.3f} ms")
+        print(f"Client {c}: {format_summary(LatencyHistogram.load(histogram_fname(fname)).summary())}")
+        print("Outcomes: " + ", ".join(f"{name} {count}" for name, count in outcome_counts(records).items()))
+    if OVERLOAD and len(records):
+        print(f"Client queueing delay: mean {np.nanmean(records['client_queue']) * 1e3:.3f} ms, "
+              f"max {np.nanmax(records['client_queue']) * 1e3:.3f} ms")
+    if STREAM and len(records):
+        print(f"Mean time to first token: {np.nanmean(records['ttft']):.3f} seconds, "
+              f"mean inter-token latency: {np.nanmean(records['itl_mean']) * 1e3:.3f} ms")
+    print(f"Total time taken: {total_time_taken:.2f} seconds")
 
 
 # Main function to run requests
 async def main():
-    global precomputed_max_tokens, precomputed_sleep_times
     global INFERENCE_URL, NUM_REQUESTS, MEAN_WAIT_TIME_SECONDS, CSV_FILE
-    global NUM_CLIENTS, CLIENT, MAX_TOKENS
+    global NUM_CLIENTS, CLIENT, MAX_TOKENS, SEED_BASE, TRACE_FILE, STREAM, ARRIVAL, SHARDS, OVERLOAD
+    global TELEMETRY_PORT, TELEMETRY_FILE, TELEMETRY
     parser = argparse.ArgumentParser(description="request sender")
+    parser.add_argument("-A", help="arrival process as a YAML mapping, e.g. '{process: closed, users: 50}' "
+                                   "(poisson, see workload.py)", type=yaml.safe_load)
     parser.add_argument("-C", help="number of clients (1)", type=int)
+    parser.add_argument("-D", help="overload mode: deadline in seconds of every request, from when it is due",
+                        type=float)
+    parser.add_argument("-E", help="export the clients' telemetry for Prometheus on this port, e.g. 9400 "
+                                   "(scraped by prometheus.yml)", type=int)
+    parser.add_argument("-F", help="write a snapshot of the clients' telemetry to this file every 5 seconds",
+                        type=str)
+    parser.add_argument("-M", help="overload mode: max requests in flight per client", type=int)
     parser.add_argument("-c", help="client number (1)", type=int)
+    parser.add_argument("-N", help="split each client's requests over this many worker processes pinned to cores, "
+                                   "merged into one output (1)", type=int)
     parser.add_argument("-n", help="number of requests (20_000)", type=int)
     parser.add_argument("-o", help="output file name (round_trips.csv)", type=str)
+    parser.add_argument("-P", help="overload mode: at max requests in flight, queue or shed new requests (queue)",
+                        choices=['queue', 'shed'])
     parser.add_argument("-s", help="randomization seed", type=int, default=1)
     parser.add_argument("-t", help="max output tokens (RANDOM)", type=int)
+    parser.add_argument("-S", help="stream tokens from /generate_stream and record TTFT and inter-token latency",
+                        action="store_true")
+    parser.add_argument("-T", help="workload trace file to replay (generate from seed)", type=str)
     parser.add_argument("-u", help="url of inference server (http://127.0.0.1:8080/generate)", type=str)
     parser.add_argument("-w", help="mean wait time in microseconds between requests", type=int)
     args = parser.parse_args()
@@ -155,18 +596,33 @@ async def main():
         SEED_BASE = args.s
     if args.t:
         MAX_TOKENS = args.t
+    if args.T:
+        TRACE_FILE = args.T
     if args.u:
         INFERENCE_URL = args.u
+    if args.S:
+        STREAM = True
+        if INFERENCE_URL.endswith('/generate'):
+            INFERENCE_URL += '_stream'
     if args.w:
         MEAN_WAIT_TIME_SECONDS = args.w * 1e-6
-
-    # Pre-compute max_tokens using Zipf distribution for all requests
-    if MAX_TOKENS:
-        precomputed_max_tokens = [MAX_TOKENS] * NUM_REQUESTS
-    else:
-        precomputed_max_tokens = [max(np.random.zipf(ZIPF_PARAM), MIN_TOKENS) for _ in range(NUM_REQUESTS)]
-
-    precomputed_sleep_times = [np.random.exponential(MEAN_WAIT_TIME_SECONDS) for _ in range(NUM_REQUESTS)]
+    if args.A:
+        ARRIVAL = args.A
+    if args.N:
+        SHARDS = args.N
+    if args.D or args.M or args.P:
+        OVERLOAD = {'deadline': args.D, 'max_in_flight': args.M, 'policy': args.P or 'queue'}
+    if args.E:
+        TELEMETRY_PORT = args.E
+    if args.F:
+        TELEMETRY_FILE = args.F
+    if TELEMETRY_PORT or TELEMETRY_FILE:
+        # Created before the client processes, which update their rows of it
+        TELEMETRY = Telemetry(NUM_CLIENTS, SHARDS)
+        if TELEMETRY_PORT:
+            TELEMETRY.serve(TELEMETRY_PORT)
+        if TELEMETRY_FILE:
+            TELEMETRY.snapshot(TELEMETRY_FILE)
 
     def run_proc(c, C):
         print(f'About to asynchronously run client {c} of {C}')
@@ -181,13 +637,18 @@ async def main():
 
     """Runs the requests."""
     print(f'About to create process {CLIENT} of {NUM_CLIENTS}')
-    await run_requests(CLIENT, NUM_CLIENTS)
-
-    def cleanup(procs):
+    try:
+        await run_requests(CLIENT, NUM_CLIENTS)
         for p in procs:
             p.join()
-
-    atexit.register(cleanup, procs)
+    finally:
+        if TELEMETRY is not None:
+            TELEMETRY.close()
+    if NUM_CLIENTS > 1:
+        # Each client wrote its own histogram; together they cover every request of the run
+        fnames = [histogram_fname(client_fname(CSV_FILE, c, NUM_CLIENTS)) for c in range(1, NUM_CLIENTS + 1)]
+        fnames = [fname for fname in fnames if os.path.exists(fname)]
+        print(f"All {len(fnames)} clients: {format_summary(merged(fnames).summary())}")
 
 
 # Entry point for running the async requests
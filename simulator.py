@@ -0,0 +1,363 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import yaml
+
+import queues
+import results
+import sender
+import store
+import tgi_stub
+from estimation import POINT_KEYS
+
+# Requests whose round trip time is within this fraction of the 90th percentile of the unqueued requests
+# of their experiment are taken to have generated all their max_output_tokens
+FULL_LENGTH_TOLERANCE = 0.1
+
+# Quantiles of the generated fraction of max_output_tokens kept by a fit
+NUM_LENGTH_QUANTILES = 101
+
+# The concurrency limit of a max batch size is this quantile of the batch_current_size samples of its
+# experiments, so a few outlying samples do not set it
+CONCURRENCY_QUANTILE = 0.999
+
+# A fitted model whose simulated mean or p99 round trip time is off by more than this fraction on any
+# of the points it was fitted to does not explain them, and is not used
+FIT_TOLERANCE = 0.25
+
+
+def client_arrivals(seed, C, num_requests, mean_interarrival_micro_s, max_tokens=None, trace_file=None):
+    """Arrival offsets, max_new_tokens and client of every request of one run, merged in arrival order.
+
+    Each client's workload is the one sender.py generates (or replays) for the same seed, so a simulated
+    replica sees exactly the requests of the corresponding real run.
+    """
+    offsets, tokens, clients = [], [], []
+    for c in range(1, C + 1):
+        trace = sender.client_trace(c, C, seed, num_requests, mean_interarrival_micro_s * 1e-6, max_tokens,
+                                    trace_file)
+        offsets.append(np.concatenate(([0.0], np.cumsum(trace['sleep_time'][:-1]))))
+        tokens.append(trace['max_tokens'])
+        clients.append(np.full(len(trace), c, dtype=np.int16))
+    offsets, tokens, clients = np.concatenate(offsets), np.concatenate(tokens), np.concatenate(clients)
+    order = np.argsort(offsets, kind='stable')
+    return offsets[order], tokens[order], clients[order]
+
+
+def simulate(arrivals, tokens, max_batch_size=tgi_stub.MAX_BATCH_SIZE, decode_seconds=tgi_stub.DECODE_SECONDS,
+             decode_slope_seconds=tgi_stub.DECODE_SLOPE_SECONDS, prefill_seconds=tgi_stub.PREFILL_SECONDS):
+    """Simulates the continuous batching server of tgi_stub.py for R replicas at once.
+
+    arrivals [R, N] holds each replica's sorted arrival times and tokens [R, N] their max_new_tokens.
+    Queued requests join the batch in a prefill step whenever a slot is free and every request in the
+    batch gets one token per decode step, whose time grows with the batch size. Between events (an
+    admission or a request finishing) a replica advances over all its decode steps in one go, so the
+    loop runs about twice per request, each time over all replicas. Returns the admission and end
+    times [R, N] of every request.
+    """
+    R, N = arrivals.shape
+    B = max_batch_size
+    pending = np.concatenate((arrivals, np.full((R, B), np.inf)), axis=1)
+    admit = np.full((R, N), np.nan)
+    end = np.full((R, N), np.nan)
+    t = arrivals[:, 0].astype(float)
+    head = np.zeros(R, dtype=np.int64)  # next request to admit
+    slot = np.full((R, B), -1, dtype=np.int64)  # request in each batch slot
+    remaining = np.zeros((R, B), dtype=np.int64)  # decode steps left per slot
+    active = np.arange(R)
+
+    while len(active):
+        r = active
+        occupied = slot[r] >= 0
+        # An idle server waits for the next arrival
+        idle = ~occupied.any(axis=1)
+        t[r[idle]] = np.maximum(t[r[idle]], pending[r[idle], head[r[idle]]])
+
+        # Admit the requests that arrived into the free slots, in FIFO order
+        free = ~occupied
+        candidates = head[r, None] + np.arange(B)
+        arrived = (pending[r[:, None], candidates] <= t[r, None]).sum(axis=1)
+        num_admit = np.minimum(arrived, free.sum(axis=1))
+        rank = np.cumsum(free, axis=1) - 1
+        i, j = np.nonzero(free & (rank < num_admit[:, None]))
+        rows, requests = r[i], head[r[i]] + rank[i, j]
+        slot[rows, j] = requests
+        admit[rows, requests] = t[rows]
+        remaining[rows, j] = tokens[rows, requests] - 1  # the prefill step produces the first token
+        head[r] += num_admit
+        t[r[num_admit > 0]] += prefill_seconds
+
+        # Decode until the next request finishes or, with a free slot, until the next request arrives
+        occupied = slot[r] >= 0
+        batch_size = occupied.sum(axis=1)
+        step = decode_seconds + decode_slope_seconds * np.maximum(batch_size - 1, 0)
+        steps = np.where(occupied, remaining[r], np.iinfo(np.int64).max).min(axis=1).astype(float)
+        with np.errstate(invalid='ignore'):
+            to_arrival = np.maximum(1, np.ceil((pending[r, head[r]] - t[r]) / step))
+        steps = np.where(batch_size < B, np.minimum(steps, to_arrival), steps)
+        steps = np.where(batch_size > 0, steps, 0).astype(np.int64)
+        t[r] += steps * step
+        remaining[r] -= np.where(occupied, steps[:, None], 0)
+
+        i, j = np.nonzero(occupied & (remaining[r] <= 0))
+        end[r[i], slot[r[i], j]] = t[r[i]]
+        slot[r[i], j] = -1
+        active = r[(head[r] < N) | (slot[r] >= 0).any(axis=1)]
+    return admit, end
+
+
+def queue_samples(arrivals, admit, end, poll_interval):
+    """The queue_size series a collector polling every poll_interval seconds would have recorded."""
+    at = np.arange(arrivals[0], end.max() + poll_interval, poll_interval)
+    queue_size = queues.in_flight_at(arrivals, admit, at)
+    batch_current_size = queues.in_flight_at(admit, end, at)
+    arrived = np.searchsorted(arrivals, at, side='right')
+    request_rate = np.diff(arrived, prepend=0) / poll_interval
+    return at, queue_size, batch_current_size, request_rate
+
+
+def write_run(dname, name_part, start_time, arrivals, admit, end, clients, poll_interval):
+    """Writes one simulated replica in the round_trips/queue_size format of experiments.py."""
+    rt_fname = os.path.join(dname, f'round_trips_{name_part}.csv')
+    C = clients.max()
+    for c in range(1, C + 1):
+        mine = clients == c
+        records = np.zeros(mine.sum(), dtype=results.RECORD_DTYPE)
+        records['i'] = np.arange(len(records))
+        records['start'] = start_time + arrivals[mine]
+        records['end'] = start_time + end[mine]
+        records['rtt'] = end[mine] - arrivals[mine]
+        results.export_csv(records, sender.client_fname(rt_fname, c, C))
+
+    at, queue_size, batch_current_size, request_rate = queue_samples(arrivals, admit, end, poll_interval)
+    with open(os.path.join(dname, f'queue_size_{name_part}.csv'), mode='w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["timestamp", "queue_size", "batch_current_size", "request_rate"])
+        writer.writerows(zip((datetime.fromtimestamp(start_time + s) for s in at), queue_size.tolist(),
+                             batch_current_size.tolist(), request_rate.tolist()))
+
+
+def fitted_experiments(catalog):
+    """The experiments a service model can be fitted to: a known max batch size and max_output_tokens.
+
+    Experiments run without a max batch size (MB stored as 0, or -1 when the file name has none) had no
+    cap on the batch at all, so they do not tell what a given max batch size serves.
+    """
+    return catalog[(catalog['t'] > 0) & (catalog['MB'] > 0)]
+
+
+def concurrency_limits(catalog, store_dname=store.STORE_DNAME):
+    """Requests the server served at once for each max batch size, by MB as stored.
+
+    TGI's max-batch-size does not cap the batch at that many requests, so the cap of the simulated server
+    is the CONCURRENCY_QUANTILE of the batch_current_size samples of its experiments, and at least MB.
+    """
+    sizes = {}
+    for _, row in fitted_experiments(catalog).iterrows():
+        q = store.columns(row, 'q', store=store_dname)
+        if 'batch_current_size' in q:
+            sizes.setdefault(int(row['MB']), []).append(np.asarray(q['batch_current_size']))
+    limits = {}
+    for MB, samples in sizes.items():
+        samples = np.concatenate(samples)
+        samples = samples[np.isfinite(samples)]
+        observed = int(np.ceil(np.quantile(samples, CONCURRENCY_QUANTILE))) if len(samples) else 0
+        limits[MB] = max(MB, observed)
+    return limits
+
+
+def fit_service_model(catalog, store_dname=store.STORE_DNAME, prefill_seconds=tgi_stub.PREFILL_SECONDS):
+    """Fits the stand-in's service model (the 'stub' section of the configs) to stored experiments.
+
+    Requests sent while the server had room in its batch did not queue, so their round trip time is
+    prefill + (n - 1) * (decode + slope * (b - 1)), n the tokens they generated and b the mean number in
+    flight over their lifetime. Only their max_output_tokens t is known, but most stop at t, so the
+    requests within FULL_LENGTH_TOLERANCE of the slowest of their experiment are taken to have generated
+    t tokens; a least squares fit over those gives the three parameters. With a single t, prefill cannot
+    be told apart from t - 1 decode steps and is held at prefill_seconds instead. The tokens the other
+    requests generated then follow from their round trip times, as quantiles of the fraction of t.
+
+    Only experiments with a max batch size are fitted (see fitted_experiments). Returns the service model,
+    the concurrency limit of every max batch size (see concurrency_limits), the length_fractions quantiles
+    and whether prefill was identified.
+    """
+    catalog = fitted_experiments(catalog)
+    limits = concurrency_limits(catalog, store_dname)
+    full, unqueued = [], []
+    for _, row in catalog.iterrows():
+        _, r_df, raw_r_df = store.load_row(row, store_dname)
+        if 'start' not in raw_r_df or len(r_df) < 2:
+            continue
+        limit = limits.get(int(row['MB']), int(row['MB']))
+        starts = queues.nanoseconds(raw_r_df['start'])
+        ends = queues.nanoseconds(raw_r_df['end'])
+        times, q = queues.in_flight(starts, ends)
+        # Integral of min(q, limit) up to each event, to average the batch size over any interval
+        event_times = queues.nanoseconds(times)
+        batch = np.minimum(q, limit)
+        area = np.concatenate(([0.0], np.cumsum(np.diff(event_times) * 1e-9 * batch[:-1])))
+
+        def integral(at):
+            k = np.maximum(np.searchsorted(event_times, at, side='right') - 1, 0)
+            return area[k] + (at - event_times[k]) * 1e-9 * batch[k]
+
+        r_starts, r_ends = queues.nanoseconds(r_df['start']), queues.nanoseconds(r_df['end'])
+        rtt = r_df['rtt'].to_numpy()
+        # In flight just before the request was sent
+        ahead = queues.in_flight_at(starts, ends, r_starts) - 1
+        b = (integral(r_ends) - integral(r_starts)) / np.maximum(rtt, 1e-9)
+        mask = ahead < limit
+        if not mask.any():
+            continue
+        requests = np.column_stack((np.full(mask.sum(), row['t']), rtt[mask], np.maximum(b[mask], 1)))
+        unqueued.append(requests)
+        full.append(requests[requests[:, 1] >= (1 - FULL_LENGTH_TOLERANCE) * np.quantile(rtt[mask], 0.9)])
+    if not full:
+        raise ValueError('no stored experiment with round trip times and a fixed max_output_tokens')
+    full, unqueued = np.concatenate(full), np.concatenate(unqueued)
+
+    t, rtt, b = full.T
+    identified = len(np.unique(t)) > 1
+    if identified:
+        (prefill, decode, slope), *_ = np.linalg.lstsq(np.column_stack((np.ones(len(t)), t - 1, (t - 1) * (b - 1))),
+                                                       rtt, rcond=None)
+    else:
+        prefill = prefill_seconds
+        (decode, slope), *_ = np.linalg.lstsq(np.column_stack((t - 1, (t - 1) * (b - 1))), rtt - prefill, rcond=None)
+    # The fastest request still took a prefill
+    prefill = float(np.clip(prefill, 0.0, unqueued[:, 1].min()))
+    decode, slope = float(max(decode, 1e-6)), float(max(slope, 0.0))
+
+    t, rtt, b = unqueued.T
+    tokens = 1 + (rtt - prefill) / (decode + slope * (b - 1))
+    fractions = np.clip(tokens / t, 1 / t, 1.0)
+    return {'model': {'decode_seconds': decode, 'decode_slope_seconds': slope, 'prefill_seconds': prefill},
+            'concurrency': limits, 'prefill_identified': identified,
+            'length_fractions': np.quantile(fractions, np.linspace(0, 1, NUM_LENGTH_QUANTILES))}
+
+
+def generated_tokens(rng, max_tokens, length_fractions):
+    """Tokens requests with the given max_new_tokens generate, drawn from the fitted length_fractions."""
+    fractions = rng.choice(length_fractions, size=np.shape(max_tokens))
+    return np.maximum(1, np.round(fractions * max_tokens)).astype(np.int64)
+
+
+def check_fit(catalog, fit, store_dname=store.STORE_DNAME, seed=1):
+    """Simulates the sweep points a model was fitted to (see fitted_experiments) and compares them with the
+    observations.
+
+    Each point's MC replicas are replayed with their observed send times, cut to the shortest replica, and
+    their max_output_tokens drawn through the fitted length fractions. Returns one row per point with the
+    observed and simulated mean and p99 round trip times and their relative errors.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for key, group in fitted_experiments(catalog).groupby(POINT_KEYS, sort=True):
+        point = dict(zip(POINT_KEYS, key))
+        arrivals, observed = [], []
+        for _, row in group.iterrows():
+            _, _, raw_r_df = store.load_row(row, store_dname)
+            if 'start' not in raw_r_df or len(raw_r_df) < 2:
+                continue
+            order = np.argsort(queues.nanoseconds(raw_r_df['start']), kind='stable')
+            starts = queues.nanoseconds(raw_r_df['start'])[order] * 1e-9
+            arrivals.append(starts - starts[0])
+            observed.append(raw_r_df['rtt'].to_numpy()[order])
+        if not arrivals:
+            continue
+        N = min(len(a) for a in arrivals)
+        arrivals = np.stack([a[:N] for a in arrivals])
+        observed = np.concatenate([rtt[:N] for rtt in observed])
+        tokens = generated_tokens(rng, np.full(arrivals.shape, point['t']), fit['length_fractions'])
+        _, end = simulate(arrivals, tokens, fit['concurrency'].get(point['MB'], point['MB']), **fit['model'])
+        simulated = (end - arrivals).ravel()
+        row = dict(point, lam=point['C'] * 1e6 / point['w'], replicas=len(arrivals),
+                   observed_mean=observed.mean(), simulated_mean=np.nanmean(simulated),
+                   observed_p99=np.quantile(observed, 0.99), simulated_p99=np.nanquantile(simulated, 0.99))
+        row['mean_error'] = row['simulated_mean'] / row['observed_mean'] - 1
+        row['p99_error'] = row['simulated_p99'] / row['observed_p99'] - 1
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="continuous batching queue simulator")
+    parser.add_argument("-b", help="max batch size (1); with -k, the server runs as many requests at once as the "
+                                   "fitted experiments of that max batch size did", type=int, default=1)
+    parser.add_argument("-c", help="config file whose 'stub' section holds the service model", type=str)
+    parser.add_argument("-C", help="number of clients (1)", type=int, default=1)
+    parser.add_argument("-D", help="with -k, only fit the experiments of these dates (data directory suffixes)",
+                        nargs='+')
+    parser.add_argument("-d", help="poll interval in seconds of the simulated queue_size files (2)", type=float,
+                        default=2)
+    parser.add_argument("-k", help="fit the service model to the experiments of this store (see store.py)",
+                        type=str)
+    parser.add_argument("-m", help="number of replicas (1)", type=int, default=1)
+    parser.add_argument("-n", help="number of requests per client (1000)", type=int, default=1000)
+    parser.add_argument("-o", help="write the replicas to this data directory", type=str)
+    parser.add_argument("-s", help="randomization seed of the first replica (100, as experiments.py mc=1)",
+                        type=int, default=100)
+    parser.add_argument("-t", help="max output tokens (RANDOM, t0 in the file names)", type=int)
+    parser.add_argument("-T", help="replay this workload trace prefix (see workload.py) instead", type=str)
+    parser.add_argument("-w", help="mean wait time in microseconds between requests per client (1_000_000)",
+                        type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    model = {}
+    fit = None
+    if args.c:
+        with open(args.c) as f:
+            model = yaml.safe_load(f).get('stub', {})
+    if args.k:
+        catalog = store.select(store.read_catalog(args.k), date=args.D)
+        fit = fit_service_model(catalog, args.k, model.get('prefill_seconds', tgi_stub.PREFILL_SECONDS))
+        model = fit['model']
+        print(f"Fitted service model: {model}, concurrency limits {fit['concurrency']}, median generated "
+              f"fraction of max tokens {np.median(fit['length_fractions']):.2f}"
+              + ("" if fit['prefill_identified'] else " (prefill held fixed: a single max_output_tokens)"))
+        table = check_fit(catalog, fit, args.k)
+        if table.empty:
+            print("No experiment to check the fitted model against, not simulating with it")
+            sys.exit(1)
+        print(table[['MB', 'C', 'w', 't', 'lam', 'replicas', 'observed_mean', 'simulated_mean', 'mean_error',
+                     'observed_p99', 'simulated_p99', 'p99_error']].to_string(index=False))
+        worst = table[['mean_error', 'p99_error']].abs().max().max()
+        if not worst <= FIT_TOLERANCE:
+            print(f"The fitted model is off by {worst:.0%} on the experiments it was fitted to "
+                  f"(more than {FIT_TOLERANCE:.0%}), not simulating with it")
+            sys.exit(1)
+
+    # Replica mc uses the seed experiments.py gives MC replica mc
+    runs = [client_arrivals(args.s * mc, args.C, args.n, args.w, args.t, args.T) for mc in range(1, args.m + 1)]
+    arrivals = np.stack([offsets for offsets, _, _ in runs])
+    tokens = np.stack([tokens for _, tokens, _ in runs])
+    max_batch_size = args.b
+    if fit is not None:
+        tokens = generated_tokens(np.random.default_rng(args.s), tokens, fit['length_fractions'])
+        max_batch_size = fit['concurrency'].get(args.b, args.b)
+    t0 = time.perf_counter()
+    admit, end = simulate(arrivals, tokens, max_batch_size, **model)
+    elapsed = time.perf_counter() - t0
+
+    rtt = end - arrivals
+    busy = np.nansum(end - admit, axis=1) / (np.nanmax(end, axis=1) - arrivals[:, 0]) / max_batch_size
+    print(f"Simulated {args.m} replicas of {arrivals.shape[1]} requests in {elapsed:.3f}s: "
+          f"mean rtt {np.nanmean(rtt):.3f}s (replica sd {np.nanstd(np.nanmean(rtt, axis=1)):.3f}s), "
+          f"p99 rtt {np.nanquantile(rtt, 0.99):.3f}s, mean slot utilization {busy.mean():.3f}")
+
+    if args.o:
+        os.makedirs(args.o, exist_ok=True)
+        t = args.t or 0
+        start_time = time.time()
+        for mc in range(1, args.m + 1):
+            name_part = f'MB_{args.b}_C{args.C}_w{args.w}_t{t}_n{args.n}_d{args.d:g}_mc_{mc}'
+            write_run(args.o, name_part, start_time, arrivals[mc - 1], admit[mc - 1], end[mc - 1], runs[mc - 1][2],
+                      args.d)
+        print(f"Wrote {args.m} replicas to {args.o}")
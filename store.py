@@ -0,0 +1,265 @@
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+STORE_DNAME = 'store'
+CATALOG_FNAME = 'catalog.csv'
+
+# One row per experiment; parameters missing from older file names are -1
+CATALOG_COLUMNS = ['date', 'name', 'MB', 'C', 'w', 't', 'n', 'd', 'mc', 'clients', 'rt_rows', 'q_rows',
+                   'source_size', 'source_mtime']
+PARAMETERS = ['MB', 'C', 'w', 't', 'n', 'd', 'mc']
+
+# Name parts written by experiments.py and calibrate.py, e.g. MB_1_C1_w793000_t200_n1210_d2_mc_10,
+# and by the earliest sweeps, e.g. C1_w100000_t100_n480_d5 or 1a_1c_500us_20000r_bs1
+NAME_PATTERNS = [
+    re.compile(r'^(?:MB_(?P<MB>\d+)_)?C(?P<C>\d+)_w(?P<w>\d+)_t(?P<t>\d+)_n(?P<n>\d+)(?:_d(?P<d>\d+))?'
+               r'(?:_mc_(?P<mc>\d+))?$'),
+    re.compile(r'^\d+a_(?P<C>\d+)c_(?P<w>\d+)us_(?P<n>\d+)r(?:_bs(?P<MB>\d+))?$'),
+]
+
+RT_COLUMNS = ['i', 'start', 'end', 'rtt', 'ok']
+
+
+def parse_name(name_part):
+    """Experiment parameters encoded in a file name part, or None if it follows no known convention."""
+    for pattern in NAME_PATTERNS:
+        match = pattern.match(name_part)
+        if match:
+            return {key: int(match.groupdict().get(key) or -1) for key in PARAMETERS}
+    return None
+
+
+def scan_dir(dname):
+    """Groups the round trip and queue_size files of a data directory by experiment.
+
+    Returns {name_part: {'params': ..., 'rt': [(client, fname), ...], 'q': fname or None}}. Record
+    streams, traces and manifests are ignored; only the CSV files are the record of an experiment.
+    """
+    experiments = {}
+
+    def experiment(name_part):
+        if name_part not in experiments:
+            experiments[name_part] = {'params': parse_name(name_part), 'rt': [], 'q': None}
+        return experiments[name_part]
+
+    for fname in sorted(glob.glob(os.path.join(dname, 'round_trips_*.csv'))):
+        name_part = os.path.basename(fname)[len('round_trips_'):-len('.csv')]
+        client = 1
+        if parse_name(name_part) is None:
+            # Runs with several clients write one file per client, with the client number appended
+            name_part, _, suffix = name_part.rpartition('_')
+            if not suffix.isdigit() or parse_name(name_part) is None:
+                print(f"Skipping {fname}: unknown file name convention")
+                continue
+            client = int(suffix)
+        experiment(name_part)['rt'].append((client, fname))
+
+    for fname in sorted(glob.glob(os.path.join(dname, 'queue_size_*.csv'))):
+        name_part = os.path.basename(fname)[len('queue_size_'):-len('.csv')]
+        if parse_name(name_part) is None:
+            print(f"Skipping {fname}: unknown file name convention")
+            continue
+        experiment(name_part)['q'] = fname
+    return experiments
+
+
+def source_signature(experiment):
+    """Total size and latest modification time of an experiment's source files."""
+    fnames = [fname for _, fname in experiment['rt']] + ([experiment['q']] if experiment['q'] else [])
+    stats = [os.stat(fname) for fname in fnames]
+    return sum(st.st_size for st in stats), max(st.st_mtime for st in stats)
+
+
+def read_round_trips(rt):
+    """Reads the round trip files of one experiment into typed columns, with the client of every request."""
+    dfs = []
+    for client, fname in rt:
+        if os.path.getsize(fname) == 0:
+            continue
+        df = pd.read_csv(fname, header=None).apply(pd.to_numeric, errors='coerce')
+        # Clients of the earliest sweeps shared a file and sometimes interleaved their lines
+        torn = df.isna().any(axis=1)
+        if torn.any():
+            print(f"Dropping {torn.sum()} unparsable rows of {fname}")
+            df = df[~torn]
+        if df.shape[1] == 1:
+            # The earliest sweeps only wrote the round trip time of each request
+            df.columns = ['rtt']
+            df['i'] = np.arange(len(df))
+        else:
+            df.columns = RT_COLUMNS
+        df['client'] = client
+        dfs.append(df)
+    if not dfs:
+        return {}
+    df = pd.concat(dfs, ignore_index=True)
+    columns = {'i': df['i'].to_numpy(np.int64)}
+    if 'start' in df:
+        columns['start'] = pd.to_datetime(df['start'], unit="s").to_numpy()
+        columns['end'] = pd.to_datetime(df['end'], unit="s").to_numpy()
+    columns['rtt'] = df['rtt'].to_numpy(np.float64)
+    if 'ok' in df:
+        columns['ok'] = df['ok'].to_numpy(np.int8)
+    columns['client'] = df['client'].to_numpy(np.int16)
+    return columns
+
+
+def read_queue_size(fname):
+    """Reads a queue_size file into typed columns; timestamps stay in the local time they were written in."""
+    if fname is None or os.path.getsize(fname) == 0:
+        return {}
+    df = pd.read_csv(fname)
+    columns = {'timestamp': pd.to_datetime(df['timestamp'], format='mixed').to_numpy()}
+    for col in df.columns[1:]:
+        columns[col] = df[col].to_numpy(np.float64)
+    return columns
+
+
+def partition_dname(store, date, name):
+    return os.path.join(store, date, name)
+
+
+def write_partition(dname, prefix, columns):
+    """Writes each column as its own .npy file, so loaders can memory map just the columns they need."""
+    os.makedirs(dname, exist_ok=True)
+    for fname in glob.glob(os.path.join(dname, f'{prefix}_*.npy')):
+        os.remove(fname)
+    for col, values in columns.items():
+        np.save(os.path.join(dname, f'{prefix}_{col}.npy'), values, allow_pickle=False)
+
+
+def read_catalog(store=STORE_DNAME):
+    fname = os.path.join(store, CATALOG_FNAME)
+    if not os.path.exists(fname):
+        return pd.DataFrame(columns=CATALOG_COLUMNS)
+    # The source mtimes must read back exactly, or unchanged experiments would be ingested again
+    return pd.read_csv(fname, float_precision='round_trip')
+
+
+def save_catalog(store, catalog):
+    """Writes the catalog atomically, so an interrupted ingest leaves the previous one in place."""
+    fname = os.path.join(store, CATALOG_FNAME)
+    catalog.to_csv(fname + '.tmp', index=False)
+    os.replace(fname + '.tmp', fname)
+
+
+def ingest(dnames, store=STORE_DNAME, force=False):
+    """Adds the experiments of the given data directories to the store.
+
+    Experiments whose source files have the same total size and modification time as when they were
+    last ingested are skipped, so re-running over all data_* directories only processes new or changed runs.
+    """
+    os.makedirs(store, exist_ok=True)
+    catalog = read_catalog(store)
+    known = {(row.date, row.name): (row.source_size, row.source_mtime) for row in catalog.itertuples()}
+    rows = {key: row for key, row in zip(known, catalog.to_dict('records'))}
+
+    for dname in dnames:
+        date = os.path.basename(os.path.normpath(dname))
+        date = date[len('data_'):] if date.startswith('data_') else date
+        ingested = 0
+        for name_part, experiment in scan_dir(dname).items():
+            signature = source_signature(experiment)
+            if not force and known.get((date, name_part)) == signature:
+                continue
+            rt_columns = read_round_trips(experiment['rt'])
+            q_columns = read_queue_size(experiment['q'])
+            pdname = partition_dname(store, date, name_part)
+            write_partition(pdname, 'rt', rt_columns)
+            write_partition(pdname, 'q', q_columns)
+            rows[(date, name_part)] = dict(date=date, name=name_part, **experiment['params'],
+                                           clients=len(experiment['rt']),
+                                           rt_rows=len(rt_columns.get('i', [])),
+                                           q_rows=len(q_columns.get('timestamp', [])),
+                                           source_size=signature[0], source_mtime=signature[1])
+            ingested += 1
+        print(f"Ingested {ingested} experiments from {dname}")
+        # Save after every directory, so an interrupted ingest keeps the directories already done
+        catalog = pd.DataFrame(list(rows.values()), columns=CATALOG_COLUMNS)
+        save_catalog(store, catalog.sort_values(['date', 'name'], ignore_index=True))
+    return read_catalog(store)
+
+
+def select(catalog, **filters):
+    """Catalog rows matching every filter: a value, a list of values or a predicate on the column."""
+    mask = np.ones(len(catalog), dtype=bool)
+    for col, value in filters.items():
+        if value is None:
+            continue
+        if callable(value):
+            mask &= catalog[col].map(value).to_numpy(bool)
+        elif isinstance(value, (list, tuple, set)):
+            mask &= catalog[col].isin(value).to_numpy()
+        else:
+            mask &= (catalog[col] == value).to_numpy()
+    return catalog[mask]
+
+
+def columns(row, table='rt', names=None, store=STORE_DNAME):
+    """Memory maps the columns of one experiment's round trips ('rt') or queue sizes ('q')."""
+    dname = partition_dname(store, row['date'], row['name'])
+    if names is None:
+        fnames = sorted(glob.glob(os.path.join(dname, f'{table}_*.npy')))
+        names = [os.path.basename(fname)[len(table) + 1:-len('.npy')] for fname in fnames]
+    return {name: np.load(os.path.join(dname, f'{table}_{name}.npy'), mmap_mode='r') for name in names}
+
+
+def load(table='rt', names=None, store=STORE_DNAME, **filters):
+    """Loads one table of every experiment matching the filters into one DataFrame.
+
+    Filtering happens on the catalog, so only the partitions selected are ever opened. Each row carries
+    the date, name and parameters of its experiment.
+    """
+    dfs = []
+    for _, row in select(read_catalog(store), **filters).iterrows():
+        df = pd.DataFrame(columns(row, table, names, store))
+        for key in ['date', 'name'] + PARAMETERS:
+            df[key] = row[key]
+        dfs.append(df)
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def load_row(row, store=STORE_DNAME):
+    """(q_df, r_df, raw_r_df) of one catalog row, trimmed to the middle 80% of sends like the notebooks do."""
+    raw_r_df = pd.DataFrame(columns(row, 'rt', store=store))
+    q_df = pd.DataFrame(columns(row, 'q', store=store))
+    if 'start' in raw_r_df:
+        first, last = raw_r_df['start'].min(), raw_r_df['start'].max()
+        interval = last - first
+        start, end = first + 0.1 * interval, first + 0.9 * interval
+        r_df = raw_r_df.loc[(raw_r_df['start'] >= start) & (raw_r_df['start'] <= end)]
+        if 'timestamp' in q_df:
+            q_df = q_df.loc[(q_df['timestamp'] >= start) & (q_df['timestamp'] <= end)]
+    else:
+        r_df = raw_r_df
+    if 'timestamp' in q_df:
+        q_df.index = q_df['timestamp']
+    return q_df, r_df, raw_r_df
+
+
+def load_dfs(date, MB, C, w, t, n, d, mc=-1, store=STORE_DNAME):
+    """The notebooks' load_dfs from the store: (q_df, r_df, raw_r_df), trimmed to the middle 80% of sends."""
+    rows = select(read_catalog(store), date=date, MB=MB, C=C, w=w, t=t, n=n, d=d, mc=mc)
+    if len(rows) != 1:
+        raise KeyError(f'{len(rows)} experiments match {date} MB={MB} C={C} w={w} t={t} n={n} d={d} mc={mc}')
+    return load_row(rows.iloc[0], store)
+
+
+# Entry point for running the script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="experiment store ingest")
+    parser.add_argument("data", help="data directories to ingest (data_*)", nargs='*')
+    parser.add_argument("-f", help="re-ingest experiments even if their files are unchanged", action="store_true")
+    parser.add_argument("-o", help="store directory (store)", type=str, default=STORE_DNAME)
+    args = parser.parse_args()
+
+    dnames = args.data or sorted(d for d in glob.glob('data_*') if os.path.isdir(d))
+    catalog = ingest(dnames, args.o, args.f)
+    print(f"{len(catalog)} experiments in {args.o}")
@@ -0,0 +1,128 @@
+import itertools
+import json
+import os
+
+import metrics
+
+MANIFEST_FNAME = 'manifest.json'
+
+# A run counts as complete when at least this fraction of its requests have a round trip row
+MIN_COMPLETE_FRACTION = 0.99
+
+
+def expand(config, MC=1):
+    """Expands an experiments config into the list of sweep points, in execution order.
+
+    Points are ordered by batch size first, so each container is started once per sweep.
+    """
+    batch_sizes = config.get('batch_sizes', [1])
+    num_clients = config.get('num_clients', [1])
+    max_output_tokens = config.get('max_output_tokens', [200])
+    lambdas = config.get('lambdas', [0.1, 0.7, 1.0, 1.4, 2.0])
+    ws = [int(1_000 / lam) * 1_000 for lam in lambdas]
+    deltas = config.get('deltas', [2])
+
+    points = []
+    for B, C, t, w, d, mc in itertools.product(batch_sizes, num_clients, max_output_tokens, ws, deltas,
+                                               range(1, MC + 1)):
+        n = max(110, 16 * 60 * 1_000_000 // w // C)
+        points.append(make_point(B, C, t, w, d, n, mc))
+    return points
+
+
+def make_point(B, C, t, w, d, n, mc):
+    name_part = f'MB_{B}_C{C}_w{w}_t{t}_n{n}_d{d}_mc_{mc}'
+    return {'name': name_part, 'B': B, 'C': C, 't': t, 'w': w, 'd': d, 'mc': mc, 'n': n, 'done': False}
+
+
+def base_name(point):
+    """Name of the sweep point a MC replica belongs to, the same for all its replicas."""
+    return point['name'].rsplit('_mc_', 1)[0]
+
+
+def replica(point, mc):
+    """MC replica mc of the sweep point of another replica."""
+    return make_point(point['B'], point['C'], point['t'], point['w'], point['d'], point['n'], mc)
+
+
+def q_fname(dname, point):
+    return os.path.join(dname, f'queue_size_{point["name"]}.csv')
+
+
+def rt_fname(dname, point):
+    return os.path.join(dname, f'round_trips_{point["name"]}.csv')
+
+
+def count_rows(fname):
+    with open(fname, 'rb') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def is_complete(dname, point):
+    """Checks that a point's outputs exist and hold a complete run."""
+    try:
+        for fname in metrics.round_trip_fnames(rt_fname(dname, point), point['C']):
+            if count_rows(fname) < MIN_COMPLETE_FRACTION * point['n']:
+                return False
+        # A header and at least two samples
+        return count_rows(q_fname(dname, point)) >= 3
+    except OSError:
+        return False
+
+
+def save_manifest(dname, manifest):
+    """Writes the manifest atomically, so an interruption never leaves a torn file behind."""
+    fname = os.path.join(dname, MANIFEST_FNAME)
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def load_manifest(dname, config, MC=1):
+    """Loads the sweep manifest of a data directory, creating or extending it from the config.
+
+    Points already recorded keep their state, but only count as done if their outputs are still
+    complete; points whose outputs are complete but were never recorded (e.g. from a sweep run
+    before the manifest existed) are marked done as well.
+    """
+    fname = os.path.join(dname, MANIFEST_FNAME)
+    recorded = {}
+    if os.path.exists(fname):
+        with open(fname) as f:
+            recorded = {point['name']: point for point in json.load(f)['points']}
+
+    points = []
+    for point in expand(config, MC):
+        point = recorded.pop(point['name'], point)
+        point['done'] = is_complete(dname, point)
+        points.append(point)
+    # Keep points of an earlier config so their state is not lost
+    points += list(recorded.values())
+
+    manifest = {'config': config, 'mc': MC, 'points': points}
+    save_manifest(dname, manifest)
+    return manifest
+
+
+def mark_done(dname, manifest, point):
+    """Records a point as done if its outputs are complete; returns whether it was."""
+    point['done'] = is_complete(dname, point)
+    save_manifest(dname, manifest)
+    return point['done']
+
+
+def pending_by_batch_size(manifest, config):
+    """Groups the pending points of the current config by batch size, in config order.
+
+    Batch sizes with nothing left to run are skipped entirely, so resuming a sweep does not restart
+    containers (and pay their cool-down) for blocks that are already finished.
+    """
+    current = {point['name'] for point in expand(config, manifest['mc'])}
+    groups = {}
+    for point in manifest['points']:
+        if point['name'] in current and not point['done']:
+            groups.setdefault(point['B'], []).append(point)
+    return list(groups.items())
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from results import OUTCOMES
+
+TELEMETRY_PORT = 9400
+
+# Counters and gauges of one sending process, a row of float64 in shared memory
+FIELDS = ['sent', 'completed'] + [f'outcome_{name}' for name in OUTCOMES.values()] + [
+    'rtt_sum', 'client_queue_sum', 'lateness_sum', 'lateness_max', 'loop_lag', 'loop_lag_max']
+FIELD = {name: i for i, name in enumerate(FIELDS)}
+
+# The event loop lag probe wakes up this often
+LAG_INTERVAL_SECONDS = 0.1
+SNAPSHOT_INTERVAL_SECONDS = 5.0
+
+
+class ClientMetrics:
+    """The telemetry row of one sending process, updated in O(1) from the request path.
+
+    Attached by the (shared memory name, row) address a Telemetry hands out; only this process writes
+    the row, so no lock is needed.
+    """
+
+    def __init__(self, address):
+        name, row = address
+        self.shm = shared_memory.SharedMemory(name)
+        self.row = np.ndarray(len(FIELDS), dtype=np.float64, buffer=self.shm.buf,
+                              offset=row * len(FIELDS) * np.dtype(np.float64).itemsize)
+        self.task = None
+
+    def dispatched(self, lateness):
+        """Counts a request handed to the event loop lateness seconds after its due time."""
+        row = self.row
+        row[0] += 1
+        row[FIELD['lateness_sum']] += lateness
+        if lateness > row[FIELD['lateness_max']]:
+            row[FIELD['lateness_max']] = lateness
+
+    def completed(self, record):
+        """Counts a request record (see results.RECORD_DTYPE) as it is written."""
+        row = self.row
+        row[1] += 1
+        row[2 + record[4]] += 1
+        row[FIELD['rtt_sum']] += record[3]
+        if record[11] == record[11]:  # not NaN
+            row[FIELD['client_queue_sum']] += record[11]
+
+    async def _probe_loop_lag(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL_SECONDS)
+            lag = time.perf_counter() - t - LAG_INTERVAL_SECONDS
+            self.row[FIELD['loop_lag']] = lag
+            if lag > self.row[FIELD['loop_lag_max']]:
+                self.row[FIELD['loop_lag_max']] = lag
+
+    def start(self):
+        """Starts the event loop lag probe on the running event loop."""
+        self.task = asyncio.create_task(self._probe_loop_lag())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        del self.row
+        self.shm.close()
+
+
+class Telemetry:
+    """Client side telemetry of every process of a run, exported in the Prometheus text format.
+
+    Each sending process, in a client process or a shard of one (see sender.run_sharded), and for a
+    sweep on several servers of each worker, gets a row of counters in one shared memory block, so a
+    single endpoint covers all of them. The exposition sums the shards of a client, and labels the series
+    with the client (and the worker when there are several), so that Prometheus can aggregate the clients
+    with sum. It is served from a background thread, so scrapes do not delay the clients' event loops,
+    and optionally written to a snapshot file every interval (e.g. for node_exporter's textfile collector).
+    """
+
+    def __init__(self, clients=1, shards=1, workers=1):
+        self.clients, self.shards, self.workers = clients, shards, workers
+        size = workers * clients * shards * len(FIELDS) * np.dtype(np.float64).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.rows = np.ndarray((workers, clients, shards, len(FIELDS)), dtype=np.float64, buffer=self.shm.buf)
+        self.rows[:] = 0
+        self.server = None
+        self.stop = threading.Event()
+        self.threads = []
+
+    def address(self, c=1, shard=0, worker=0):
+        """Address of the row of client c (1-based), shard and worker, for ClientMetrics."""
+        return self.shm.name, (worker * self.clients + c - 1) * self.shards + shard
+
+    def exposition(self):
+        rows = self.rows.copy()
+        counts = rows.sum(axis=2)
+        maxima = rows.max(axis=2)
+        series = {}
+
+        def add(name, kind, help_text, values):
+            series[name] = (kind, help_text, values)
+
+        sent, completed = counts[..., FIELD['sent']], counts[..., FIELD['completed']]
+        add('sender_requests_sent_total', 'counter', 'Requests handed to the event loop', sent)
+        add('sender_requests_in_flight', 'gauge', 'Requests sent and not completed', sent - completed)
+        add('sender_request_duration_seconds_sum', 'counter', 'Sum of the round trip times of completed requests',
+            counts[..., FIELD['rtt_sum']])
+        add('sender_request_duration_seconds_count', 'counter', 'Completed requests', completed)
+        add('sender_client_queue_seconds_total', 'counter',
+            'Time requests waited for an in-flight slot or a pooled connection', counts[..., FIELD['client_queue_sum']])
+        add('sender_schedule_lateness_seconds_sum', 'counter', 'Sum of the delays of requests past their due time',
+            counts[..., FIELD['lateness_sum']])
+        add('sender_schedule_lateness_seconds_count', 'counter', 'Requests handed to the event loop', sent)
+        add('sender_schedule_lateness_max_seconds', 'gauge', 'Largest delay of a request past its due time',
+            maxima[..., FIELD['lateness_max']])
+        add('sender_event_loop_lag_seconds', 'gauge', 'Latest oversleep of the event loop lag probe',
+            maxima[..., FIELD['loop_lag']])
+        add('sender_event_loop_lag_max_seconds', 'gauge', 'Largest oversleep of the event loop lag probe',
+            maxima[..., FIELD['loop_lag_max']])
+
+        lines = []
+        for name, (kind, help_text, values) in series.items():
+            if not name.endswith('_count'):
+                lines += [f"# HELP {name.removesuffix('_sum')} {help_text}",
+                          f"# TYPE {name.removesuffix('_sum')} {'summary' if name.endswith('_sum') else kind}"]
+            lines += [f"{name}{{{self.labels(w, c)}}} {values[w, c]:.9g}" for w, c in np.ndindex(values.shape)]
+        lines += ["# HELP sender_requests_completed_total Completed requests by outcome",
+                  "# TYPE sender_requests_completed_total counter"]
+        for outcome in OUTCOMES.values():
+            values = counts[..., FIELD[f'outcome_{outcome}']]
+            lines += [f'sender_requests_completed_total{{{self.labels(w, c)},outcome="{outcome}"}} {values[w, c]:.9g}'
+                      for w, c in np.ndindex(values.shape)]
+        return ("\n".join(lines) + "\n").encode()
+
+    def labels(self, worker, c):
+        return f'client="{c + 1}"' + (f',worker="{worker}"' if self.workers > 1 else '')
+
+    def serve(self, port=TELEMETRY_PORT):
+        """Serves /metrics on port from a background thread."""
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        self.server.daemon_threads = True
+        self.threads.append(threading.Thread(target=self.server.serve_forever, name='telemetry', daemon=True))
+        self.threads[-1].start()
+        print(f"Serving client telemetry on port {port}")
+
+    def write_snapshot(self, fname):
+        """Writes the exposition to fname atomically."""
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            f.write(self.exposition())
+        os.replace(tmp_fname, fname)
+
+    def snapshot(self, fname, interval=SNAPSHOT_INTERVAL_SECONDS):
+        """Writes a snapshot to fname every interval seconds from a background thread, and once more on close."""
+        def run():
+            while not self.stop.wait(interval):
+                self.write_snapshot(fname)
+            self.write_snapshot(fname)
+
+        self.threads.append(threading.Thread(target=run, name='telemetry-snapshot', daemon=True))
+        self.threads[-1].start()
+
+    def close(self):
+        self.stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        del self.rows
+        self.shm.close()
+        self.shm.unlink()
+
@@ -0,0 +1,62 @@
+import threading
+from statistics import NormalDist
+
+import numpy as np
+
+import calibrate
+from metrics import SAMPLE_DTYPE
+
+
+def feed(test, in_service, rate, seed=1):
+    """Feeds a run sampled every second until the test reaches a verdict."""
+    noise = np.random.default_rng(seed).normal(0, 0.5, len(in_service))
+    for k, (value, e) in enumerate(zip(in_service, noise)):
+        test.on_sample(np.array((1000.0 + k, max(value + e, 0.0), 0.0, rate), dtype=SAMPLE_DTYPE))
+        if test.verdict:
+            break
+    return test.verdict
+
+
+def test_over_capacity():
+    lam, mu = 10.0, 7.0
+    test = calibrate.LiveTest(lam, threading.Event(), min_samples=10, max_samples=60)
+    assert feed(test, (lam - mu) * np.arange(60), lam) == 'over'
+    assert test.stop.is_set()
+    assert abs(test.mu - mu) < 3 * test.mu_se + 0.1
+
+
+def test_under_capacity():
+    test = calibrate.LiveTest(10.0, threading.Event(), min_samples=10, max_samples=60)
+    assert feed(test, np.full(60, 5.0), 10.0) == 'under'
+
+
+def test_no_verdict_before_min_samples():
+    test = calibrate.LiveTest(10.0, threading.Event(), min_samples=30, max_samples=60)
+    assert feed(test, 3 * np.arange(29), 10.0) is None
+    assert not test.stop.is_set()
+
+
+def test_spending_reaches_the_error_rate_of_z_at_full_length():
+    test = calibrate.LiveTest(1.0, threading.Event(), z=2.58)
+    spent = [test.spending(fraction) for fraction in (0.1, 0.5, 1.0, 2.0)]
+    assert np.all(np.diff(spent) >= 0)
+    assert np.isclose(spent[2], 1 - NormalDist().cdf(2.58)) and spent[3] == spent[2]
+    # Early looks are held to a much stricter z
+    test.samples = [None] * 3
+    assert test.look_z() > 4
+
+
+def test_next_lambda_moves_away_from_the_verdict_within_the_bracket():
+    assert calibrate.next_lambda(10.0, 'over', 1, [], 5.0, 20.0) < 10.0
+    assert calibrate.next_lambda(10.0, 'under', 1, [], 5.0, 20.0) > 10.0
+    assert calibrate.next_lambda(10.0, 'under', 1, [], 9.0, 10.5) <= 10.5 / 1.05
+    assert calibrate.next_lambda(10.0, 'over', 1, [], 10.0, 10.1) is None
+    # Steps shrink with k and start from the saturation estimate when there is one
+    assert calibrate.next_lambda(10.0, 'over', 4, [], 5.0, 20.0) > calibrate.next_lambda(10.0, 'over', 1, [], 5.0, 20.0)
+    assert calibrate.next_lambda(10.0, 'over', 1, [(8.0, 0.1)], 5.0, 20.0) < 8.0
+
+
+def test_saturation_estimate_weights_by_inverse_variance():
+    mean, low, high = calibrate.saturation_estimate([(8.0, 0.1), (12.0, 1.0)])
+    assert np.isclose(mean, (8.0 * 100 + 12.0) / 101)
+    assert low < mean < high
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+import capacity
+
+MODEL = {'mu1': 2.0, 'kappa': 0.3, 'S1': 0.5, 'c': 1.0, 'tail': 1.5}
+
+
+def sweep_points(batch_sizes, date='23Dec'):
+    """Points of a sweep whose latencies follow the model exactly, with one overloaded run per batch size."""
+    rows = []
+    for B in batch_sizes:
+        mu = capacity.capacity(MODEL['mu1'], MODEL['kappa'], B)
+        for rho in (0.1, 0.3, 0.5, 0.7, 0.85):
+            predicted = capacity.predict(MODEL, rho * mu, B)
+            rows.append(dict(date=date, name=f'MB_{B}_rho{rho}', MB=B, t=200, lam=rho * mu, W=predicted['W'],
+                             W99=predicted['Wp'], overloaded=False))
+        rows.append(dict(date=date, name=f'MB_{B}_over', MB=B, t=200, lam=1.5 * mu, W=100.0, W99=200.0,
+                         overloaded=True))
+    return pd.DataFrame(rows)
+
+
+def test_capacity_and_predict():
+    assert capacity.capacity(2.0, 0.0, 4) == 8.0 and capacity.capacity(2.0, 1.0, 4) == 2.0
+    # B = 1 with exponential service is the M/M/1 queue
+    model = dict(MODEL, kappa=0.0, S1=0.5)
+    predicted = capacity.predict(model, 1.5, 1)
+    assert np.isclose(predicted['W'], 1 / (2.0 - 1.5)) and np.isclose(predicted['rho'], 0.75)
+    assert np.isinf(capacity.predict(model, 2.5, 1)['W'])
+
+
+def test_fit_recovers_the_model():
+    models, points = capacity.fit(sweep_points([1, 4, 16]))
+    assert len(models) == 1
+    model = models.iloc[0]
+    for key in ('mu1', 'kappa', 'S1'):
+        assert np.isclose(model[key], MODEL[key], rtol=0.05), key
+    assert np.isclose(model['mu_4'], capacity.capacity(MODEL['mu1'], MODEL['kappa'], 4), rtol=0.05)
+    assert set(points['flag']) == {''}
+    assert np.allclose(points['W_fit'][~points['overloaded']], points['W'][~points['overloaded']], rtol=0.05)
+
+
+def test_a_single_batch_size_does_not_identify_kappa():
+    models, _ = capacity.fit(sweep_points([2]))
+    model = models.iloc[0]
+    assert np.isnan(model['kappa'])
+    assert np.isclose(model['mu_2'], capacity.capacity(MODEL['mu1'], MODEL['kappa'], 2), rtol=0.05)
+    assert np.isnan(model['mu_1']) and np.isnan(model['mu_4'])
+
+
+def test_recommend_stays_within_the_observed_batch_sizes():
+    models, _ = capacity.fit(pd.concat([sweep_points([1, 4]), sweep_points([1], date='24Dec')],
+                                       ignore_index=True))
+    table = capacity.recommend(models, slo=5.0).set_index('date')
+    assert table.loc['23Dec', 'MB'] == 4 and table.loc['24Dec', 'MB'] == 1
+    assert table.loc['24Dec', ['max_rate_2', 'max_rate_4']].isna().all()
+    rate = table.loc['23Dec', 'max_rate']
+    assert capacity.predict(dict(models.iloc[0][capacity.MODEL_KEYS]), rate, 4)['Wp'] <= 5.0 + 1e-6
+    assert rate < models.iloc[0]['mu_4']
+
+
+def test_points_without_a_batch_size_are_not_fitted():
+    points = sweep_points([1, 4])
+    points.loc[0, 'MB'] = -1
+    models, points = capacity.fit(points)
+    assert points.loc[0, 'flag'] == 'unknown_batch' and np.isnan(points.loc[0, 'W_fit'])
@@ -0,0 +1,20 @@
+import numpy as np
+
+from distributed import estimate_offset
+
+
+def test_estimate_offset_uses_the_least_delayed_sample():
+    offset = 2.5
+    samples = []
+    for t1, out, back in [(0.0, 0.010, 0.030), (1.0, 0.001, 0.001), (2.0, 0.050, 0.002)]:
+        t2 = t1 + out + offset
+        t3 = t2 + 0.0001
+        samples.append((t1, t2, t3, t3 - offset + back))
+    estimate, delay = estimate_offset(samples)
+    assert np.isclose(estimate, offset) and np.isclose(delay, 0.002)
+
+
+def test_estimate_offset_is_exact_for_symmetric_legs():
+    samples = [(t1, t1 + 0.02 - 1.0, t1 + 0.021 - 1.0, t1 + 0.041) for t1 in (0.0, 0.5)]
+    estimate, delay = estimate_offset(samples)
+    assert np.isclose(estimate, -1.0) and np.isclose(delay, 0.04)
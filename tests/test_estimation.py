@@ -0,0 +1,57 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import estimation
+import store
+
+T0 = 1_703_325_600.0
+
+
+def write_run(dname, name_part, period=0.1, rtt=0.05, num_requests=200):
+    """A run sending every period seconds, each request taking rtt, with an empty server queue."""
+    starts = T0 + period * np.arange(num_requests)
+    with open(os.path.join(dname, f'round_trips_{name_part}.csv'), 'w') as f:
+        f.writelines(f"{k},{start!r},{start + rtt!r},{rtt},0\n" for k, start in enumerate(starts.tolist()))
+    with open(os.path.join(dname, f'queue_size_{name_part}.csv'), 'w') as f:
+        f.write("timestamp,queue_size,batch_current_size,request_rate\n")
+        f.writelines(f"{datetime.fromtimestamp(T0 + k)},0,0,{1 / period}\n" for k in range(int(period * num_requests)))
+
+
+def test_get_lam_and_finite_difference():
+    assert estimation.get_lam(2, 100_000) == 20.0
+    q_df = pd.DataFrame({'queue_size': [0, 2, 3], 'batch_current_size': [1, 1, 1]})
+    # in_service grows by 2 then 1 over d = 2 s polls at lambda = 5
+    assert list(estimation.finite_difference(q_df, 5.0, 2.0, 1)) == [4.0, 4.5]
+    assert list(estimation.finite_difference(q_df, 5.0, 2.0, 2)) == [2.0, 2.25]
+
+
+def test_bootstrap():
+    rng = np.random.default_rng(1)
+    values = rng.normal(10, 1, 100)
+    low, high = estimation.bootstrap(values, rng)
+    assert low < values.mean() < high and high - low < 1
+    assert np.isnan(estimation.bootstrap([1.0, np.nan], rng)).all()
+
+
+def test_estimate_sweep(tmp_path):
+    dname = tmp_path / 'data_23Dec'
+    dname.mkdir()
+    for mc in (1, 2):
+        write_run(str(dname), f'MB_1_C1_w100000_t10_n200_d1_mc_{mc}')
+    write_run(str(dname), 'MB_2_C1_w100000_t10_n200_d1_mc_1')
+    out = str(tmp_path / 'store')
+    catalog = store.ingest([str(dname)], out)
+    table = estimation.estimate_sweep(catalog, out, num_batches=4, workers=1).set_index(['MB', 'estimator',
+                                                                                          'quantity'])
+    assert set(table['ci_method']) == {'replicas', 'batch_means'}
+    assert table.loc[(1, 'little', 'lambda'), 'replicas'] == 2
+    assert (table['lam'] == 10.0).all()
+    # Requests every 0.1 s taking 0.05 s: lambda = 10, and 20 completions per busy second per batch slot
+    assert np.isclose(table.loc[(1, 'little', 'lambda'), 'estimate'], 10.0, rtol=0.02)
+    assert np.isclose(table.loc[(1, 'departures', 'lambda'), 'estimate'], 10.0, rtol=0.02)
+    assert np.isclose(table.loc[(1, 'departures', 'mu'), 'estimate'], 20.0, rtol=0.05)
+    assert np.isclose(table.loc[(2, 'departures', 'mu'), 'estimate'], 10.0, rtol=0.05)
+    assert np.isclose(table.loc[(1, 'finite_difference', 'mu'), 'estimate'], 10.0)
@@ -0,0 +1,68 @@
+import numpy as np
+
+from histogram import LatencyHistogram
+from results import RECORD_DTYPE
+
+
+def test_quantiles_are_within_the_bucket_precision():
+    values = np.random.default_rng(1).lognormal(-1, 1, 100_000)
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.observe(value)
+    quantiles = (0.5, 0.9, 0.99)
+    # 2 ** (SUB_BITS - 1) buckets per power of two bound the relative error by about 0.8%
+    assert np.allclose(histogram.quantiles(quantiles), np.quantile(values, quantiles), rtol=0.01)
+    assert histogram.summary()['max'] == values.max()
+
+
+def test_merge_equals_the_histogram_of_all_requests():
+    rng = np.random.default_rng(2)
+    parts = [rng.exponential(0.5, 1000) for _ in range(3)]
+    merged = LatencyHistogram()
+    for part in parts:
+        histogram = LatencyHistogram()
+        for value in part:
+            histogram.observe(value)
+        merged.merge(histogram)
+    whole = LatencyHistogram()
+    for value in np.concatenate(parts):
+        whole.observe(value)
+    assert np.array_equal(merged.counts, whole.counts)
+    assert merged.count == whole.count and np.isclose(merged.sum, whole.sum)
+    assert np.array_equal(merged.quantiles(), whole.quantiles())
+
+
+def test_merge_rejects_another_layout():
+    try:
+        LatencyHistogram().merge(LatencyHistogram(sub_bits=4))
+    except ValueError:
+        return
+    raise AssertionError('merged histograms of different layouts')
+
+
+def test_observe_records_counts_failures_and_span():
+    records = np.zeros(4, dtype=RECORD_DTYPE)
+    records['rtt'] = [0.1, 0.2, 0.3, 5.0]
+    records['ok'] = [0, 0, 0, 2]
+    records['start'] = [10.0, 11.0, 12.0, 13.0]
+    records['end'] = records['start'] + records['rtt']
+    stats = LatencyHistogram().observe_records(records).summary()
+    assert stats['requests'] == 3 and stats['failed'] == 1
+    assert np.isclose(stats['throughput'], 3 / 8.0)
+    assert np.isclose(stats['max'], 0.3)
+
+
+def test_save_and_load(tmp_path):
+    histogram = LatencyHistogram()
+    for value in (0.001, 0.5, 2.0):
+        histogram.observe(value, 1.0, 3.0)
+    histogram.observe_failure()
+    fname = str(tmp_path / 'round_trips.hist.npz')
+    histogram.save(fname)
+    loaded = LatencyHistogram.load(fname)
+    assert np.array_equal(loaded.counts, histogram.counts)
+    assert loaded.summary() == histogram.summary()
+
+
+def test_empty_quantiles_are_nan():
+    assert np.isnan(LatencyHistogram().quantiles()).all()
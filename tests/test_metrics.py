@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+import metrics
+import tgi_stub
+
+EXPOSITION = """# HELP tgi_queue_size Queue size
+# TYPE tgi_queue_size gauge
+tgi_queue_size 3
+tgi_request_count 42 1700000000000
+tgi_request_queue_duration_bucket{le="0.01"} 5
+tgi_request_queue_duration_bucket{le="+Inf"} 7
+tgi_request_queue_duration_sum 0.25
+tgi_request_queue_duration_count 7
+"""
+
+
+def test_parse_exposition():
+    samples = metrics.parse_exposition(EXPOSITION)
+    assert samples['tgi_queue_size'] == 3.0
+    # The value, not the trailing timestamp
+    assert samples['tgi_request_count'] == 42.0
+    assert samples['tgi_request_queue_duration_bucket{le="+Inf"}'] == 7.0
+    assert metrics.histogram_buckets(samples, 'tgi_request_queue_duration') == [('0.01', 5.0), ('+Inf', 7.0)]
+
+
+def test_snapshot_columns():
+    columns, series = metrics.snapshot_columns(metrics.parse_exposition(EXPOSITION))
+    assert columns[:6] == ['timestamp', 'queue_size', 'batch_current_size', 'request_rate', 'monotonic',
+                           'request_count']
+    assert columns[6:] == ['queue_duration_sum', 'queue_duration_count', 'queue_duration_le_0.01',
+                           'queue_duration_le_+Inf']
+    assert series == ['tgi_request_queue_duration_sum', 'tgi_request_queue_duration_count',
+                      'tgi_request_queue_duration_bucket{le="0.01"}', 'tgi_request_queue_duration_bucket{le="+Inf"}']
+
+
+def test_parse_the_stub_exposition():
+    batcher = tgi_stub.Batcher(4, 0.02, 0.0, 0.05)
+    batcher.queue_duration.observe(0.003)
+    samples = metrics.parse_exposition(batcher.metrics().decode())
+    assert samples['tgi_queue_size'] == 0.0 and samples['tgi_batch_current_size'] == 0.0
+    columns, series = metrics.snapshot_columns(samples)
+    assert 'queue_duration_count' in columns and len(columns) == len(series) + 6
+    assert samples['tgi_request_queue_duration_count'] == 1.0
+
+
+def write_round_trips(fname, start, end):
+    with open(fname, 'w') as f:
+        f.write(f"0,{start},{start + 1},1.0,0\n1,{end - 1},{end},1.0,0\n")
+
+
+def fake_query_range(missing):
+    """Stands in for Prometheus: a constant per query, with no tgi_queue_size value at the missing time."""
+    values = {'tgi_queue_size': 1.0, 'tgi_batch_current_size': 2.0}
+
+    def query_range(session, prom_url, query, start, end, step):
+        timestamps = np.arange(start, end + step / 2, step)
+        timestamps = timestamps[timestamps != missing] if query == 'tgi_queue_size' else timestamps
+        return timestamps, np.full(len(timestamps), values.get(query, 3.0))
+
+    return query_range
+
+
+def test_backfill_aligns_the_series_on_the_step_grid(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'query_range', fake_query_range(missing=1000.0 + 10))
+    rt_fnames = [str(tmp_path / 'round_trips_1.csv'), str(tmp_path / 'round_trips_2.csv')]
+    write_round_trips(rt_fnames[0], 1002.0, 1020.0)
+    write_round_trips(rt_fnames[1], 1003.0, 1031.0)
+    assert metrics.run_window(rt_fnames) == (1002.0, 1031.0)
+    q_fname = str(tmp_path / 'queue_size.csv')
+    metrics.backfill(rt_fnames, q_fname, step=5)
+    table = pd.read_csv(q_fname)
+    assert list(table.columns) == ['timestamp', 'queue_size', 'batch_current_size', 'request_rate']
+    # 1000, 1005, ..., 1030 without 1010, where one series has no value
+    assert len(table) == 6
+    assert (table['queue_size'] == 1).all() and (table['request_rate'] == 3).all()
+    steps = pd.to_datetime(table['timestamp']).diff().dt.total_seconds().dropna()
+    assert sorted(steps.unique()) == [5.0, 10.0]
+
+
+def test_backfill_dir_groups_the_clients_of_a_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'query_range', fake_query_range(missing=None))
+    dname, out_dname = tmp_path / 'data', tmp_path / 'out'
+    dname.mkdir()
+    for c in (1, 2):
+        write_round_trips(str(dname / f'round_trips_C2_w1000_{c}.csv'), 1000.0, 1010.0)
+    write_round_trips(str(dname / 'round_trips_C1_w1000.csv'), 1000.0, 1010.0)
+    metrics.backfill_dir(str(dname), str(out_dname), step=5)
+    assert sorted(p.name for p in out_dname.iterdir()) == ['queue_size_C1_w1000.csv', 'queue_size_C2_w1000.csv']
+    assert metrics.round_trip_fnames('rt.csv', 2) == ['rt_1.csv', 'rt_2.csv']
@@ -0,0 +1,60 @@
+import numpy as np
+
+import queues
+
+
+def test_in_flight_counts_starts_before_ends():
+    starts = np.array([0.0, 1.0, 2.0])
+    ends = np.array([3.0, 2.0, 4.0])
+    times, q = queues.in_flight(starts, ends)
+    assert np.array_equal(queues.nanoseconds(times), queues.nanoseconds([0.0, 1.0, 2.0, 2.0, 3.0, 4.0]))
+    assert np.array_equal(q, [1, 2, 3, 2, 1, 0])
+
+
+def test_in_flight_at_matches_the_step_function():
+    rng = np.random.default_rng(1)
+    starts = np.sort(rng.uniform(0, 100, 1000))
+    ends = starts + rng.exponential(2, 1000)
+    times, q = queues.in_flight(starts, ends)
+    at = rng.uniform(0, 100, 500)
+    assert np.array_equal(queues.in_flight_at(starts, ends, at), queues.resample(times, q, at))
+
+
+def test_in_flight_accepts_datetimes_without_changing_them():
+    starts = np.array(['2024-01-01T00:00:02', '2024-01-01T00:00:00'], dtype='datetime64[ns]')
+    ends = starts + np.timedelta64(5, 's')
+    kept = starts.copy()
+    times, q = queues.in_flight(starts, ends)
+    assert np.array_equal(starts, kept)
+    assert times[0] == kept[1] and np.array_equal(q, [1, 2, 1, 0])
+
+
+def test_time_weighted_statistics():
+    times = queues.nanoseconds(np.array([0.0, 1.0, 3.0, 4.0]))
+    q = np.array([1, 3, 0, 0])
+    assert np.allclose(queues.durations(times), [1.0, 2.0, 1.0, 0.0])
+    assert np.isclose(queues.time_weighted_mean(times, q), 7 / 4)
+    # A window inside the step function clips its first and last steps
+    assert np.allclose(queues.durations(times, 0.5, 2.0), [0.5, 1.0, 0.0, 0.0])
+    stats = queues.summary(times, q)
+    assert np.isclose(stats['mean'], 7 / 4) and stats['max'] == 3
+    assert (stats['p50'], stats['p90']) == (1, 3)
+    assert list(queues.time_weighted_quantiles(times, q, (0.2, 0.6))) == [0, 3]
+
+
+def test_per_client_summaries():
+    starts = np.array([0.0, 1.0, 2.0, 3.0])
+    ends = starts + 1.5
+    table = queues.per_client(starts, ends, np.array([1, 2, 1, 2]))
+    assert list(table.index) == [1, 2, 'all']
+    assert table.loc['all', 'max'] == 2 and table.loc[1, 'max'] == 1
+
+
+def test_drift_and_mean_se():
+    rng = np.random.default_rng(1)
+    t = np.arange(200.0)
+    slope, se = queues.drift(t, 0.5 * t + rng.normal(0, 1, len(t)))
+    assert abs(slope - 0.5) < 3 * se and se > 0
+    assert queues.drift(t, 2 * t) == (2.0, 0.0)
+    mean, se = queues.mean_se(3 + rng.normal(0, 1, 10_000))
+    assert abs(mean - 3) < 3 * se and np.isclose(se, 0.01, rtol=0.2)
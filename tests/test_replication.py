@@ -0,0 +1,38 @@
+import math
+
+import numpy as np
+
+from replication import OUTPUTS, T_95, confidence_interval, summarize
+
+
+def test_confidence_interval():
+    mean, relative = confidence_interval([9.0, 10.0, 11.0, np.nan])
+    assert mean == 10.0
+    assert np.isclose(relative, T_95[1] * 1.0 / math.sqrt(3) / 10.0)
+
+
+def test_confidence_interval_of_too_few_values():
+    mean, relative = confidence_interval([5.0])
+    assert mean == 5.0 and np.isnan(relative)
+    mean, relative = confidence_interval([])
+    assert np.isnan(mean) and np.isnan(relative)
+
+
+def test_summarize_converges_on_precise_outputs():
+    replicas = [dict.fromkeys(OUTPUTS, value) for value in (100.0, 100.1, 99.9)]
+    summary = summarize(replicas, precision=0.05)
+    assert summary['replicas'] == 3 and summary['converged']
+    assert summary['replicas_needed'] <= 3
+
+
+def test_summarize_extrapolates_the_replicas_needed():
+    replicas = [dict.fromkeys(OUTPUTS, value) for value in (80.0, 100.0, 120.0)]
+    summary = summarize(replicas, precision=0.05)
+    assert not summary['converged']
+    assert summary['replicas_needed'] == math.ceil(3 * (summary['precision'] / 0.05) ** 2)
+
+
+def test_summarize_without_replicas():
+    summary = summarize([])
+    assert summary['replicas'] == 0 and not summary['converged']
+    assert np.isnan(summary['replicas_needed'])
@@ -0,0 +1,87 @@
+import asyncio
+
+import numpy as np
+
+from results import CSV_COLUMNS, RECORD_DTYPE, ResultWriter, SharedRing, export_csv, read_records
+
+
+def records(first, n):
+    chunk = np.zeros(n, dtype=RECORD_DTYPE)
+    chunk['i'] = np.arange(first, first + n)
+    chunk['rtt'] = 0.1
+    return chunk
+
+
+def record(i, ok=0):
+    return i, 1.0 * i, 1.0 * i + 0.1, 0.1, ok, 1.0 * i, np.nan, np.nan, np.nan, -1, np.nan, np.nan
+
+
+def test_shared_ring_wraps_around():
+    ring = SharedRing(capacity=8)
+    try:
+        drained = []
+        for first in range(0, 60, 5):
+            ring.push(records(first, 5))
+            drained.append(ring.drain())
+        assert np.array_equal(np.concatenate(drained)['i'], np.arange(60))
+        assert len(ring.drain()) == 0
+    finally:
+        ring.close(unlink=True)
+
+
+def test_shared_ring_attaches_by_name():
+    ring = SharedRing(capacity=8)
+    try:
+        producer = SharedRing(capacity=8, name=ring.name)
+        producer.push(records(0, 6))
+        producer.close()
+        assert np.array_equal(ring.drain()['i'], np.arange(6))
+    finally:
+        ring.close(unlink=True)
+
+
+def test_result_writer_flushes_when_the_ring_is_full():
+    writer = ResultWriter(None, capacity=4)
+    for i in range(10):
+        writer.append(record(i, ok=int(i == 3)))
+    asyncio.run(writer.close())
+    assert np.array_equal(writer.records()['i'], np.arange(10))
+    assert writer.histogram.count == 9 and writer.histogram.failed == 1
+
+
+def test_result_writer_pending_wraps_around():
+    writer = ResultWriter(None, capacity=4)
+    for i in range(3):
+        writer.append(record(i))
+    writer.flush()
+    for i in range(3, 6):
+        writer.append(record(i))
+    assert np.array_equal(writer.pending()['i'], [3, 4, 5])
+
+
+def test_result_writer_stream_round_trip(tmp_path):
+    fname = str(tmp_path / 'round_trips.npys')
+    writer = ResultWriter(fname, capacity=4)
+    for i in range(7):
+        writer.append(record(i))
+    asyncio.run(writer.close())
+    assert np.array_equal(read_records(fname)['i'], np.arange(7))
+
+
+def test_read_records_ignores_a_torn_chunk(tmp_path):
+    fname = str(tmp_path / 'round_trips.npys')
+    with open(fname, 'wb') as f:
+        np.save(f, records(0, 3), allow_pickle=False)
+        np.save(f, records(3, 3), allow_pickle=False)
+    with open(fname, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 10)
+    assert np.array_equal(read_records(fname)['i'], np.arange(3))
+
+
+def test_export_csv_writes_the_round_trip_columns(tmp_path):
+    fname = str(tmp_path / 'round_trips.csv')
+    export_csv(records(0, 3), fname)
+    with open(fname) as f:
+        rows = [line.strip().split(',') for line in f]
+    assert len(rows) == 3 and all(len(row) == len(CSV_COLUMNS) for row in rows)
+    assert [int(row[0]) for row in rows] == [0, 1, 2]
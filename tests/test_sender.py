@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+import sender
+import workload
+from results import CANCELLED, OK, SHED, TIMEOUT
+
+
+async def serve(seconds, hits):
+    """A server on a free local port that answers every request after seconds."""
+    async def generate(request):
+        hits.append(time.time())
+        await asyncio.sleep(seconds)
+        return web.Response(text='{}', headers={'x-generated-tokens': '3'})
+
+    app = web.Application()
+    app.router.add_post('/generate', generate)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/generate'
+
+
+def send_all(seconds, overload, intended_ago=(0.0, 0.0), cancel_after=None):
+    """Sends a request per entry of intended_ago, due that many seconds ago, and returns the records and hits."""
+    records, hits = [], []
+
+    async def run():
+        runner, url = await serve(seconds, hits)
+        try:
+            async with aiohttp.ClientSession() as session:
+                now = time.time()
+                tasks = [asyncio.create_task(sender.send_request(session, url, False, records, i, b'{}',
+                                                                 now - ago, overload))
+                         for i, ago in enumerate(intended_ago)]
+                if cancel_after is not None:
+                    await asyncio.sleep(cancel_after)
+                    for task in tasks:
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    return sorted(records), hits
+
+
+def test_overload_queues_for_a_slot_within_the_deadline():
+    records, hits = send_all(0.2, sender.Overload(max_in_flight=1, deadline=0.3))
+    assert [record[4] for record in records] == [OK, TIMEOUT] and len(hits) == 2
+    assert records[0][9] == 3
+    # The second request waited for the slot, which left it too little of its deadline
+    assert 0.25 < records[1][3] < 0.4 and 0.15 < records[1][11] < 0.3
+
+
+def test_overload_sheds_when_every_slot_is_taken():
+    records, hits = send_all(0.1, sender.Overload(max_in_flight=1, policy='shed'))
+    assert [record[4] for record in records] == [OK, SHED] and len(hits) == 1
+    assert records[1][3] == 0.0
+
+
+def test_the_deadline_runs_from_the_intended_send_time():
+    records, hits = send_all(0.2, sender.Overload(deadline=0.5), intended_ago=(0.0, 0.4, 1.0))
+    assert [record[4] for record in records] == [OK, TIMEOUT, TIMEOUT]
+    # The request due a second ago is past its deadline and never sent
+    assert len(hits) == 2 and records[1][3] < 0.15 and records[2][3] < 0.05
+
+
+def test_cancelled_requests_are_recorded():
+    records, hits = send_all(1.0, None, cancel_after=0.1)
+    assert [record[4] for record in records] == [CANCELLED, CANCELLED] and len(hits) == 2
+    assert all(0.05 < record[3] < 0.5 for record in records)
+
+
+def test_overload_rejects_an_unknown_policy():
+    try:
+        sender.Overload(max_in_flight=1, policy='drop')
+    except ValueError:
+        return
+    raise AssertionError('accepted an unknown in-flight policy')
+
+
+def test_stopping_a_run_records_the_requests_in_flight():
+    trace = workload.generate(np.random.default_rng(1), 50, 0.01)
+    hits = []
+
+    async def run():
+        runner, url = await serve(1.0, hits)
+        try:
+            stop = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.15, stop.set)
+            return await sender.run_client(trace, url, stop=stop)
+        finally:
+            await runner.cleanup()
+
+    records = asyncio.run(run())
+    # Every request sent gets a row, including any still connecting when the run stopped
+    assert 0 < len(records) < len(trace) and len(hits) <= len(records)
+    assert np.array_equal(np.sort(records['i']), np.arange(len(records)))
+    assert np.all(records['ok'] == CANCELLED)
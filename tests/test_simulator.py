@@ -0,0 +1,68 @@
+import numpy as np
+
+import simulator
+import store
+
+MODEL = {'decode_seconds': 0.02, 'decode_slope_seconds': 0.005, 'prefill_seconds': 0.1}
+
+
+def test_simulate_a_single_request():
+    admit, end = simulator.simulate(np.array([[1.0]]), np.array([[11]]), 1, **MODEL)
+    assert admit[0, 0] == 1.0 and np.isclose(end[0, 0], 1.0 + 0.1 + 10 * 0.02)
+
+
+def test_simulate_queues_behind_a_full_batch():
+    arrivals, tokens = np.array([[0.0, 0.0]]), np.array([[6, 6]])
+    admit, end = simulator.simulate(arrivals, tokens, 1, **MODEL)
+    assert np.isclose(end[0, 0], 0.2) and admit[0, 1] == end[0, 0]
+    assert np.isclose(end[0, 1], 0.4)
+    # With room for both, they share the batch and every decode step is slower
+    admit, end = simulator.simulate(arrivals, tokens, 2, **MODEL)
+    assert np.allclose(admit, 0.0) and np.allclose(end, 0.1 + 5 * 0.025)
+
+
+def test_simulate_replicas_independently():
+    rng = np.random.default_rng(1)
+    arrivals = np.sort(rng.uniform(0, 10, (3, 50)), axis=1)
+    tokens = rng.integers(1, 30, (3, 50))
+    admit, end = simulator.simulate(arrivals, tokens, 4, **MODEL)
+    for r in range(3):
+        one_admit, one_end = simulator.simulate(arrivals[r:r + 1], tokens[r:r + 1], 4, **MODEL)
+        assert np.allclose(one_admit[0], admit[r]) and np.allclose(one_end[0], end[r])
+    assert np.all(admit >= arrivals) and np.all(end > admit)
+
+
+def test_generated_tokens():
+    tokens = simulator.generated_tokens(np.random.default_rng(1), np.full(1000, 100), np.array([0.001, 0.5, 1.0]))
+    assert set(np.unique(tokens)) == {1, 50, 100}
+
+
+def test_fit_recovers_the_model_of_simulated_runs(tmp_path):
+    dname = tmp_path / 'data_23Dec'
+    dname.mkdir()
+    rng = np.random.default_rng(1)
+    for t in (50, 200):
+        for mc in (1, 2):
+            arrivals = np.cumsum(rng.exponential(4.0, 200))
+            tokens = np.full(200, t)
+            admit, end = simulator.simulate(arrivals[None], tokens[None], 2, **MODEL)
+            simulator.write_run(str(dname), f'MB_2_C1_w4000000_t{t}_n200_d1_mc_{mc}', 1_703_325_600.0,
+                                arrivals, admit[0], end[0], np.ones(200, dtype=np.int16), 1.0)
+    # A run without a max batch size, far busier than any capped one, is left out
+    arrivals = np.cumsum(rng.exponential(0.01, 200))
+    admit, end = simulator.simulate(arrivals[None], np.full((1, 200), 50), 100, **MODEL)
+    simulator.write_run(str(dname), 'C1_w10000_t50_n200_d1', 1_703_325_600.0, arrivals, admit[0], end[0],
+                        np.ones(200, dtype=np.int16), 1.0)
+    out = str(tmp_path / 'store')
+    catalog = store.ingest([str(dname)], out)
+
+    fit = simulator.fit_service_model(catalog, out)
+    assert fit['prefill_identified'] and fit['concurrency'] == {2: 2}
+    assert np.isclose(fit['model']['decode_seconds'], MODEL['decode_seconds'], rtol=0.1)
+    assert np.isclose(fit['model']['decode_slope_seconds'], MODEL['decode_slope_seconds'], rtol=0.3)
+    # The prefills of the requests admitted while a request runs stall it too, and the fit charges them to
+    # its own prefill
+    assert MODEL['prefill_seconds'] <= fit['model']['prefill_seconds'] < 2 * MODEL['prefill_seconds']
+    table = simulator.check_fit(catalog, fit, out)
+    assert list(table['MB']) == [2, 2]
+    assert table[['mean_error', 'p99_error']].abs().max().max() < simulator.FIT_TOLERANCE
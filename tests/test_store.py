@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+
+import store
+
+QUEUE_SIZE = "timestamp,queue_size,batch_current_size,request_rate\n" + "".join(
+    f"2024-12-23 10:00:{k:02d},{k % 3},1,0.5\n" for k in range(10))
+
+
+def write_experiment(dname, name_part, clients=1, rows=10):
+    for c in range(1, clients + 1):
+        suffix = f'_{c}' if clients > 1 else ''
+        with open(os.path.join(dname, f'round_trips_{name_part}{suffix}.csv'), 'w') as f:
+            f.writelines(f"{k},{1703325600 + k},{1703325600.5 + k},0.5,0\n" for k in range(rows))
+    with open(os.path.join(dname, f'queue_size_{name_part}.csv'), 'w') as f:
+        f.write(QUEUE_SIZE)
+
+
+def test_parse_name():
+    assert store.parse_name('MB_4_C2_w50000_t100_n960_d5_mc_3') == dict(MB=4, C=2, w=50000, t=100, n=960, d=5, mc=3)
+    assert store.parse_name('C1_w100000_t100_n480_d5') == dict(MB=-1, C=1, w=100000, t=100, n=480, d=5, mc=-1)
+    assert store.parse_name('1a_2c_500us_20000r_bs1') == dict(MB=1, C=2, w=500, t=-1, n=20000, d=-1, mc=-1)
+    assert store.parse_name('notes') is None
+
+
+def test_scan_dir_groups_the_clients_of_a_run(tmp_path):
+    write_experiment(str(tmp_path), 'MB_1_C2_w1000_t10_n10_d2_mc_1', clients=2)
+    (tmp_path / 'round_trips_scratch.csv').write_text('')
+    experiments = store.scan_dir(str(tmp_path))
+    assert list(experiments) == ['MB_1_C2_w1000_t10_n10_d2_mc_1']
+    experiment = experiments['MB_1_C2_w1000_t10_n10_d2_mc_1']
+    assert [c for c, _ in experiment['rt']] == [1, 2] and experiment['q'].endswith('.csv')
+
+
+def test_ingest_load_and_skip_unchanged(tmp_path, capsys):
+    dname, out = tmp_path / 'data_23Dec', str(tmp_path / 'store')
+    dname.mkdir()
+    write_experiment(str(dname), 'MB_1_C2_w1000_t10_n10_d2_mc_1', clients=2)
+    write_experiment(str(dname), 'MB_4_C1_w1000_t10_n10_d2_mc_1', rows=20)
+    catalog = store.ingest([str(dname)], out)
+    assert list(catalog['rt_rows']) == [20, 20] and list(catalog['clients']) == [2, 1]
+    assert set(catalog['date']) == {'23Dec'}
+
+    rt = store.load('rt', ['rtt', 'client'], store=out, MB=[1])
+    assert len(rt) == 20 and sorted(set(rt['client'])) == [1, 2] and (rt['MB'] == 1).all()
+    assert len(store.load('q', store=out, MB=lambda MB: MB > 1)) == 10
+    assert store.load(store=out, MB=8).empty
+
+    q_df, r_df, raw_r_df = store.load_dfs('23Dec', 4, 1, 1000, 10, 10, 2, 1, store=out)
+    assert len(raw_r_df) == 20 and len(r_df) < len(raw_r_df)
+    assert np.issubdtype(q_df.index.dtype, np.datetime64)
+
+    capsys.readouterr()
+    store.ingest([str(dname)], out)
+    assert 'Ingested 0 experiments' in capsys.readouterr().out
+
+
+def test_read_round_trips_drops_torn_rows(tmp_path):
+    fname = tmp_path / 'round_trips_C1_w1000_t10_n3.csv'
+    fname.write_text("0,1.0,1.5,0.5,0\n1,2.0,2.5\n2,3.0,3.5,0.5,0\n")
+    columns = store.read_round_trips([(1, str(fname))])
+    assert list(columns['i']) == [0, 2] and np.issubdtype(columns['start'].dtype, np.datetime64)
@@ -0,0 +1,64 @@
+import json
+import os
+
+import sweep
+
+CONFIG = {'batch_sizes': [1, 4], 'num_clients': [2], 'max_output_tokens': [100], 'lambdas': [1.0, 2.0],
+          'deltas': [2]}
+
+
+def complete_run(dname, point, rows=None):
+    """Writes outputs that make a point complete, or short of it with fewer rows."""
+    for fname in sweep.metrics.round_trip_fnames(sweep.rt_fname(dname, point), point['C']):
+        with open(fname, 'w') as f:
+            f.write('0,1.0,2.0,1.0,0\n' * (point['n'] if rows is None else rows))
+    with open(sweep.q_fname(dname, point), 'w') as f:
+        f.write('timestamp,queue_size,batch_current_size,request_rate\n' + 't,0,0,0\n' * 2)
+
+
+def test_expand_orders_points_by_batch_size():
+    points = sweep.expand(CONFIG, MC=2)
+    assert len(points) == 8
+    assert [point['B'] for point in points] == [1] * 4 + [4] * 4
+    assert points[0]['name'] == 'MB_1_C2_w1000000_t100_n480_d2_mc_1'
+    assert sweep.base_name(points[1]) == sweep.base_name(points[0]) and points[1]['mc'] == 2
+    assert sweep.replica(points[0], 7)['name'].endswith('_mc_7')
+
+
+def test_load_manifest_resumes_from_complete_outputs(tmp_path):
+    dname = str(tmp_path)
+    points = sweep.expand(CONFIG)
+    complete_run(dname, points[0])
+    complete_run(dname, points[1], rows=10)
+    manifest = sweep.load_manifest(dname, CONFIG)
+    assert [point['done'] for point in manifest['points']] == [True, False, False, False]
+    with open(os.path.join(dname, sweep.MANIFEST_FNAME)) as f:
+        assert json.load(f) == manifest
+    assert not os.path.exists(os.path.join(dname, sweep.MANIFEST_FNAME + '.tmp'))
+
+
+def test_load_manifest_keeps_points_of_an_earlier_config(tmp_path):
+    dname = str(tmp_path)
+    sweep.load_manifest(dname, CONFIG)
+    manifest = sweep.load_manifest(dname, dict(CONFIG, batch_sizes=[4]))
+    assert len(manifest['points']) == 4
+    assert {point['B'] for point in manifest['points'][:2]} == {4}
+
+
+def test_outputs_that_disappear_are_no_longer_done(tmp_path):
+    dname = str(tmp_path)
+    manifest = sweep.load_manifest(dname, CONFIG)
+    point = manifest['points'][2]
+    complete_run(dname, point)
+    assert sweep.mark_done(dname, manifest, point)
+    os.remove(sweep.q_fname(dname, point))
+    assert not sweep.load_manifest(dname, CONFIG)['points'][2]['done']
+
+
+def test_pending_by_batch_size_skips_finished_blocks(tmp_path):
+    dname = str(tmp_path)
+    for point in sweep.expand(CONFIG)[:2]:
+        complete_run(dname, point)
+    manifest = sweep.load_manifest(dname, CONFIG)
+    groups = sweep.pending_by_batch_size(manifest, CONFIG)
+    assert [B for B, _ in groups] == [4] and len(groups[0][1]) == 2
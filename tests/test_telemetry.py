@@ -0,0 +1,67 @@
+import asyncio
+import urllib.request
+
+import numpy as np
+
+from metrics import parse_exposition
+from results import TIMEOUT
+from telemetry import ClientMetrics, Telemetry
+
+
+def record(rtt, ok=0, client_queue=np.nan):
+    return 0, 0.0, rtt, rtt, ok, 0.0, np.nan, np.nan, np.nan, -1, np.nan, client_queue
+
+
+def test_exposition_sums_the_shards_of_a_client():
+    telemetry = Telemetry(clients=2, shards=2)
+    try:
+        shards = [ClientMetrics(telemetry.address(1, shard)) for shard in range(2)]
+        for shard, lateness in zip(shards, (0.5, 1.5)):
+            shard.dispatched(lateness)
+            shard.dispatched(0.0)
+        shards[0].completed(record(0.25, client_queue=0.125))
+        shards[1].completed(record(2.0, ok=TIMEOUT))
+        for shard in shards:
+            asyncio.run(shard.close())
+        samples = parse_exposition(telemetry.exposition().decode())
+    finally:
+        telemetry.close()
+    assert samples['sender_requests_sent_total{client="1"}'] == 4
+    assert samples['sender_requests_in_flight{client="1"}'] == 2
+    assert samples['sender_request_duration_seconds_sum{client="1"}'] == 2.25
+    assert samples['sender_client_queue_seconds_total{client="1"}'] == 0.125
+    assert samples['sender_schedule_lateness_seconds_sum{client="1"}'] == 2.0
+    assert samples['sender_schedule_lateness_max_seconds{client="1"}'] == 1.5
+    assert samples['sender_requests_completed_total{client="1",outcome="ok"}'] == 1
+    assert samples['sender_requests_completed_total{client="1",outcome="timeout"}'] == 1
+    assert samples['sender_requests_sent_total{client="2"}'] == 0
+
+
+def test_exposition_labels_workers_only_when_there_are_several():
+    telemetry = Telemetry(clients=1, workers=2)
+    try:
+        metrics = ClientMetrics(telemetry.address(1, worker=1))
+        metrics.dispatched(0.0)
+        asyncio.run(metrics.close())
+        samples = parse_exposition(telemetry.exposition().decode())
+    finally:
+        telemetry.close()
+    assert samples['sender_requests_sent_total{client="1",worker="1"}'] == 1
+    assert samples['sender_requests_sent_total{client="1",worker="0"}'] == 0
+
+
+def test_serve_and_snapshot(tmp_path):
+    telemetry = Telemetry()
+    fname = str(tmp_path / 'sender.prom')
+    try:
+        telemetry.serve(port=0)
+        telemetry.snapshot(fname, interval=60)
+        port = telemetry.server.server_address[1]
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            served = response.read()
+    finally:
+        telemetry.close()
+    assert parse_exposition(served.decode())['sender_requests_sent_total{client="1"}'] == 0
+    # The snapshot thread writes once more on close
+    with open(fname, 'rb') as f:
+        assert f.read() == served
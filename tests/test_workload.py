@@ -0,0 +1,109 @@
+import numpy as np
+
+import workload
+
+
+def test_generate_client_is_reproducible_and_independent_of_the_client_count():
+    first = workload.generate_client(1, 1, 4, 1000, 0.01)
+    assert np.array_equal(first, workload.generate_client(1, 1, 4, 1000, 0.01))
+    assert not np.array_equal(first['sleep_time'], workload.generate_client(1, 2, 4, 1000, 0.01)['sleep_time'])
+
+
+def test_generate_columns():
+    trace = workload.generate(np.random.default_rng(1), 100_000, 0.01)
+    assert trace.dtype == workload.WORKLOAD_DTYPE
+    assert abs(trace['sleep_time'].mean() / 0.01 - 1) < 0.02
+    assert trace['max_tokens'].min() >= workload.MIN_TOKENS
+    assert trace['max_tokens'].max() <= workload.MAX_TOKENS_RANGE
+    assert np.all((trace['prompt'] >= 0) & (trace['prompt'] < len(workload.PROMPTS)))
+    assert np.all(workload.generate(np.random.default_rng(1), 10, 0.01, max_tokens=7)['max_tokens'] == 7)
+
+
+def test_generate_rejects_an_unknown_arrival_process():
+    try:
+        workload.generate(np.random.default_rng(1), 10, 0.01, arrival={'process': 'bursty'})
+    except ValueError:
+        return
+    raise AssertionError('generated an unknown arrival process')
+
+
+def test_trace_round_trip(tmp_path):
+    trace = workload.generate(np.random.default_rng(1), 100, 0.01)
+    fname = str(tmp_path / workload.trace_fname('trace', 2, 3))
+    assert fname.endswith('trace_2.npy')
+    workload.save_trace(fname, trace)
+    assert np.array_equal(workload.load_trace(fname), trace)
+
+
+def test_load_trace_rejects_other_arrays(tmp_path):
+    fname = str(tmp_path / 'other.npy')
+    np.save(fname, np.zeros(3))
+    try:
+        workload.load_trace(fname)
+    except ValueError:
+        return
+    raise AssertionError('loaded a plain array as a trace')
+
+
+def test_thinning_follows_the_rate_profile():
+    rng = np.random.default_rng(3)
+    multiplier, max_multiplier = workload.rate_profile({'process': 'step', 'times': [0, 10], 'factors': [1, 3]})
+    times = workload.thinning(rng, 20_000, 100.0, multiplier, max_multiplier)
+    assert len(times) == 20_000 and np.all(np.diff(times) >= 0)
+    assert abs(np.sum(times < 10) / 1000 - 1) < 0.1
+    assert abs(np.sum((times >= 10) & (times < 20)) / 3000 - 1) < 0.1
+
+
+def test_mmpp_profile_has_the_base_mean_rate():
+    arrival = {'process': 'mmpp', 'factors': [1, 4], 'mean_durations': [3, 1]}
+    multiplier, max_multiplier = workload.mmpp_profile(np.random.default_rng(4), arrival)
+    factors = multiplier(np.linspace(0, 20_000, 200_001))
+    assert max_multiplier == factors.max()
+    assert abs(factors.mean() - 1) < 0.05
+
+
+def test_rate_profile_rejects_invalid_arrivals():
+    for arrival in ({'process': 'sine', 'amplitude': 1.5, 'period': 10}, {'process': 'poisson'},
+                    {'process': 'mmpp', 'factors': [1], 'mean_durations': [1]}):
+        try:
+            if arrival['process'] == 'mmpp':
+                workload.mmpp_profile(np.random.default_rng(1), arrival)
+            else:
+                workload.rate_profile(arrival)
+        except ValueError:
+            continue
+        raise AssertionError(f'accepted {arrival}')
+
+
+def test_closed_loop_think_times():
+    arrival = {'process': 'closed', 'users': 4, 'think': 'constant'}
+    assert workload.closed_users(arrival) == 4 and workload.closed_users({'process': 'poisson'}) is None
+    trace = workload.generate(np.random.default_rng(1), 100, 0.01, arrival=arrival)
+    assert np.allclose(trace['sleep_time'], 0.04)
+    think = workload.think_times(np.random.default_rng(1), 100_000, 2.0, 'lognormal', cv=0.5)
+    assert abs(think.mean() / 2.0 - 1) < 0.02 and abs(think.std() / think.mean() / 0.5 - 1) < 0.05
+
+
+def test_split_shards_superpose_to_the_schedule():
+    rng = np.random.default_rng(1)
+    trace = workload.generate(rng, 1000, 0.01)
+    shards = workload.split_shards(np.random.default_rng(2), trace, 4)
+    times = np.concatenate(([0.0], np.cumsum(trace['sleep_time'][:-1])))
+    indices = np.concatenate([indices for indices, _, _ in shards])
+    assert np.array_equal(np.sort(indices), np.arange(len(trace)))
+    for indices, offset, part in shards:
+        assert np.array_equal(part['max_tokens'], trace['max_tokens'][indices])
+        shard_times = offset + np.concatenate(([0.0], np.cumsum(part['sleep_time'][:-1])))
+        assert np.allclose(shard_times, times[indices])
+
+
+def test_split_shards_keeps_closed_loop_think_times():
+    trace = workload.generate(np.random.default_rng(1), 100, 0.01, arrival={'process': 'closed', 'users': 4})
+    for indices, _, part in workload.split_shards(np.random.default_rng(2), trace, 3, closed=True):
+        assert np.array_equal(part['sleep_time'], trace['sleep_time'][indices])
+
+
+def test_split_shards_allows_empty_shards():
+    trace = workload.generate(np.random.default_rng(1), 2, 0.01)
+    shards = workload.split_shards(np.random.default_rng(2), trace, 8)
+    assert sum(len(part) for _, _, part in shards) == 2
@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import bisect
+import collections
+import functools
+import heapq
+import json
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Simulated server parameters
+PORT = 8080
+MAX_BATCH_SIZE = 1
+DECODE_SECONDS = 0.02  # time of one decode step (one token for every request in the batch) at batch size 1
+DECODE_SLOPE_SECONDS = 0.0  # extra decode step time per additional request in the batch
+PREFILL_SECONDS = 0.05  # time of the prefill step that admits new requests into the batch
+MAX_CONCURRENT_REQUESTS = 1000
+
+DURATION_BUCKETS = [0.001 * 2 ** k for k in range(20)]
+TOKEN_BUCKETS = [2 ** k for k in range(15)]
+
+CONTENT_LENGTH = re.compile(rb'(?i)\r\ncontent-length:\s*(\d+)')
+
+REASONS = {200: 'OK', 404: 'Not Found', 422: 'Unprocessable Entity', 429: 'Too Many Requests'}
+
+
+class Histogram:
+    """Cumulative Prometheus histogram."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def exposition(self, name):
+        lines = [f"# TYPE {name} histogram"]
+        cumulative = 0
+        for le, n in zip(self.buckets, self.counts):
+            cumulative += n
+            lines.append(f'{name}_bucket{{le="{le:g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class Request:
+    __slots__ = ('max_tokens', 'generated', 'stream', 'done', 't_arrival', 't_admit', 'finish_step')
+
+    def __init__(self, max_tokens, stream):
+        self.max_tokens = max_tokens
+        self.generated = 0
+        self.stream = stream  # asyncio.Queue receiving one item per token, or None
+        self.done = asyncio.get_running_loop().create_future()
+        self.t_arrival = time.monotonic()
+        self.t_admit = None
+        self.finish_step = None
+
+
+class Batcher:
+    """Continuous batching: requests join the running batch at prefill and leave as soon as they finish."""
+
+    def __init__(self, max_batch_size, decode_seconds, decode_slope_seconds, prefill_seconds):
+        self.max_batch_size = max_batch_size
+        self.decode_seconds = decode_seconds
+        self.decode_slope_seconds = decode_slope_seconds
+        self.prefill_seconds = prefill_seconds
+        self.queue = collections.deque()
+        self.batch_size = 0
+        self.batch_max_tokens = 0  # sum of the max tokens of the requests in the batch
+        self.step = 0
+        self.finishing = []  # heap of (finish step, sequence, request)
+        self.streaming = set()
+        self.sequence = 0
+        self.wake = None
+        self.request_count = 0
+        self.request_success = 0
+        self.queue_duration = Histogram(DURATION_BUCKETS)
+        self.inference_duration = Histogram(DURATION_BUCKETS)
+        self.request_duration = Histogram(DURATION_BUCKETS)
+        self.generated_tokens = Histogram(TOKEN_BUCKETS)
+
+    def queue_size(self):
+        return len(self.queue)
+
+    def in_flight(self):
+        return self.queue_size() + self.batch_size
+
+    def submit(self, request):
+        self.request_count += 1
+        self.queue.append(request)
+        if self.wake is not None and not self.wake.done():
+            self.wake.set_result(None)
+
+    def admit(self):
+        """Moves queued requests into the batch up to the maximum batch size."""
+        admitted = []
+        while self.queue and self.batch_size < self.max_batch_size:
+            admitted.append(self.queue.popleft())
+            self.batch_size += 1
+            self.batch_max_tokens += admitted[-1].max_tokens
+        return admitted
+
+    def finish(self, request, now):
+        self.batch_size -= 1
+        self.batch_max_tokens -= request.max_tokens
+        self.request_success += 1
+        self.streaming.discard(request)
+        self.queue_duration.observe(request.t_admit - request.t_arrival)
+        self.inference_duration.observe(now - request.t_admit)
+        self.request_duration.observe(now - request.t_arrival)
+        self.generated_tokens.observe(request.max_tokens)
+        if request.stream is not None:
+            request.stream.put_nowait(None)
+        request.done.set_result(now)
+
+    def emit_tokens(self):
+        """Advances every request in the batch by one token, then retires the finished ones."""
+        self.step += 1
+        for request in self.streaming:
+            request.generated += 1
+            request.stream.put_nowait(request.generated)
+        now = time.monotonic()
+        while self.finishing and self.finishing[0][0] <= self.step:
+            _, _, request = heapq.heappop(self.finishing)
+            self.finish(request, now)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic()
+        while True:
+            if self.in_flight() == 0:
+                self.wake = loop.create_future()
+                await self.wake
+                deadline = time.monotonic()
+
+            admitted = self.admit()
+            if admitted:
+                # The prefill step produces the first token of the admitted requests
+                deadline = await self.sleep_until(max(deadline, time.monotonic()) + self.prefill_seconds)
+                now = time.monotonic()
+                for request in admitted:
+                    request.t_admit = now
+                    request.finish_step = self.step + request.max_tokens - 1
+                    if request.stream is not None:
+                        request.generated = 1
+                        request.stream.put_nowait(1)
+                    if request.max_tokens <= 1:
+                        self.finish(request, now)
+                        continue
+                    if request.stream is not None:
+                        self.streaming.add(request)
+                    self.sequence += 1
+                    heapq.heappush(self.finishing, (request.finish_step, self.sequence, request))
+
+            if self.batch_size > 0:
+                step = self.decode_seconds + self.decode_slope_seconds * (self.batch_size - 1)
+                deadline = await self.sleep_until(deadline + step)
+                self.emit_tokens()
+
+    @staticmethod
+    async def sleep_until(deadline):
+        """Sleeps until an absolute monotonic deadline so that step times do not drift.
+
+        Returns the deadline to schedule the next step from; after a stall of more than 100 ms the
+        schedule restarts from now instead of bursting through the missed steps.
+        """
+        delay = deadline - time.monotonic()
+        await asyncio.sleep(delay if delay > 0 else 0)
+        return deadline if delay > -0.1 else time.monotonic()
+
+    def metrics(self):
+        lines = [
+            "# TYPE tgi_request_count counter", f"tgi_request_count {self.request_count}",
+            "# TYPE tgi_request_success counter", f"tgi_request_success {self.request_success}",
+            "# TYPE tgi_queue_size gauge", f"tgi_queue_size {self.queue_size()}",
+            "# TYPE tgi_batch_current_size gauge", f"tgi_batch_current_size {self.batch_size}",
+            "# TYPE tgi_batch_current_max_tokens gauge", f"tgi_batch_current_max_tokens {self.batch_max_tokens}",
+        ]
+        lines += self.queue_duration.exposition("tgi_request_queue_duration")
+        lines += self.inference_duration.exposition("tgi_request_inference_duration")
+        lines += self.request_duration.exposition("tgi_request_duration")
+        lines += self.generated_tokens.exposition("tgi_request_generated_tokens")
+        return ("\n".join(lines) + "\n").encode()
+
+
+class FixedDelay(Batcher):
+    """Answers every request delay seconds after it arrives, however many are in flight.
+
+    Not a model of TGI: a sink with a known service time, to benchmark the load generator against.
+    """
+
+    def __init__(self, delay):
+        super().__init__(MAX_CONCURRENT_REQUESTS, delay, 0.0, 0.0)
+        self.delay = delay
+
+    def submit(self, request):
+        self.request_count += 1
+        self.batch_size += 1
+        self.batch_max_tokens += request.max_tokens
+        request.t_admit = request.t_arrival
+        asyncio.get_running_loop().call_later(self.delay, lambda: self.finish(request, time.monotonic()))
+
+    async def run(self):
+        await asyncio.get_running_loop().create_future()
+
+
+@functools.lru_cache(maxsize=None)
+def generated_text(tokens):
+    """/generate response body for a request of the given length."""
+    return json.dumps({"generated_text": " token" * tokens}).encode()
+
+
+class HttpProtocol(asyncio.Protocol):
+    """Minimal HTTP/1.1 server with keep-alive, enough for aiohttp, requests and Prometheus clients."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.transport = None
+        self.buffer = b''
+        self.busy = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.busy:
+            self.parse()
+
+    def parse(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            return
+        head = self.buffer[:end]
+        method, path, _ = head[:head.find(b'\r\n')].decode('latin-1').split(' ', 2)
+        match = CONTENT_LENGTH.search(head)
+        length = int(match.group(1)) if match else 0
+        if len(self.buffer) < end + 4 + length:
+            return
+        body = self.buffer[end + 4:end + 4 + length]
+        self.buffer = self.buffer[end + 4 + length:]
+        self.busy = True
+        self.handle(method, path.split('?', 1)[0], body)
+
+    def respond(self, status, body, content_type='application/json', headers=()):
+        if self.transport is None:
+            return
+        extra = ''.join(f'{name}: {value}\r\n' for name, value in headers)
+        self.transport.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\n{extra}\r\n'.encode() + body)
+        self.done()
+
+    def done(self):
+        self.busy = False
+        if self.buffer and self.transport is not None:
+            self.parse()
+
+    def handle(self, method, path, body):
+        """Dispatches a request; generate responses are written from callbacks rather than per-request tasks."""
+        if path == '/metrics':
+            self.respond(200, self.batcher.metrics(), 'text/plain; version=0.0.4')
+        elif path == '/health':
+            self.respond(200, b'')
+        elif method == 'POST' and path in ('/generate', '/generate_stream'):
+            self.generate(body, stream=path == '/generate_stream')
+        else:
+            self.respond(404, b'{"error":"not found"}')
+
+    def generate(self, body, stream):
+        try:
+            max_tokens = int(json.loads(body).get('parameters', {}).get('max_new_tokens') or 20)
+        except (ValueError, AttributeError):
+            self.respond(422, b'{"error":"invalid request","error_type":"validation"}')
+            return
+        if self.batcher.in_flight() >= MAX_CONCURRENT_REQUESTS:
+            self.respond(429, b'{"error":"Model is overloaded","error_type":"overloaded"}')
+            return
+
+        request = Request(max(1, max_tokens), asyncio.Queue() if stream else None)
+        self.batcher.submit(request)
+        if stream:
+            asyncio.ensure_future(self.stream_tokens(request))
+        else:
+            request.done.add_done_callback(lambda done: self.generated(request, done.result()))
+
+    def generated(self, request, end):
+        queue_ms = (request.t_admit - request.t_arrival) * 1e3
+        inference_ms = (end - request.t_admit) * 1e3
+        body = generated_text(request.max_tokens)
+        self.respond(200, body, headers=[
+            ('x-queue-time', f'{queue_ms:.0f}'), ('x-inference-time', f'{inference_ms:.0f}'),
+            ('x-time-per-token', f'{inference_ms / request.max_tokens:.0f}'),
+            ('x-generated-tokens', request.max_tokens)])
+
+    async def stream_tokens(self, request):
+        """Writes one server-sent event per token using chunked transfer encoding."""
+        if self.transport is not None:
+            self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                                 b'Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n')
+        while True:
+            index = await request.stream.get()
+            if index is None:
+                break
+            if self.transport is None:
+                continue
+            last = index == request.max_tokens
+            event = {"index": index, "token": {"id": 1, "text": " token", "logprob": 0.0, "special": False},
+                     "generated_text": " token" * request.max_tokens if last else None,
+                     "details": {"finish_reason": "length", "generated_tokens": index, "seed": None} if last else None}
+            data = b'data:' + json.dumps(event).encode() + b'\n\n'
+            self.transport.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        if self.transport is not None:
+            self.transport.write(b'0\r\n\r\n')
+        self.done()
+
+
+async def serve(port=PORT, max_batch_size=MAX_BATCH_SIZE, decode_seconds=DECODE_SECONDS,
+                decode_slope_seconds=DECODE_SLOPE_SECONDS, prefill_seconds=PREFILL_SECONDS, fixed_delay=None):
+    """Serves the simulated TGI endpoints until cancelled; with fixed_delay, as a FixedDelay sink."""
+    if fixed_delay is not None:
+        batcher = FixedDelay(fixed_delay)
+    else:
+        batcher = Batcher(max_batch_size, decode_seconds, decode_slope_seconds, prefill_seconds)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: HttpProtocol(batcher), '0.0.0.0', port, backlog=4096)
+    if fixed_delay is not None:
+        print(f"Fixed delay sink listening on port {port} with delay={fixed_delay}s")
+    else:
+        print(f"TGI stand-in listening on port {port} with max-batch-size={max_batch_size} "
+              f"decode={decode_seconds}s(+{decode_slope_seconds}s/request) prefill={prefill_seconds}s")
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+
+def start_server_process(port=PORT, max_batch_size=MAX_BATCH_SIZE, decode_seconds=DECODE_SECONDS,
+                         decode_slope_seconds=DECODE_SLOPE_SECONDS, prefill_seconds=PREFILL_SECONDS, fixed_delay=None):
+    """Starts the stand-in server in its own process, in place of the TGI container."""
+    args = [sys.executable, "tgi_stub.py", "-p", str(port), "-b", str(max_batch_size), "-d", str(decode_seconds),
+            "-g", str(decode_slope_seconds), "-f", str(prefill_seconds)]
+    if fixed_delay is not None:
+        args += ["-D", str(fixed_delay)]
+    print(f"Starting TGI stand-in: {args}")
+    return subprocess.Popen(args)
+
+
+def stop_server_process(server):
+    """Stops a stand-in server started by start_server_process."""
+    print("Stopping TGI stand-in.")
+    server.terminate()
+    try:
+        server.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def wait_until_ready(port=PORT, timeout=30):
+    """Polls /health until the stand-in server answers."""
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.1)
+    print(f"Timeout waiting for TGI stand-in on port {port}.")
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TGI stand-in server simulating continuous batching")
+    parser.add_argument("-b", help="max batch size (1)", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("-D", help="answer every request after this many seconds instead, without batching",
+                        type=float)
+    parser.add_argument("-d", help="decode step time in seconds at batch size 1 (0.02)", type=float,
+                        default=DECODE_SECONDS)
+    parser.add_argument("-f", help="prefill time in seconds (0.05)", type=float, default=PREFILL_SECONDS)
+    parser.add_argument("-g", help="extra decode step time in seconds per additional batched request (0)",
+                        type=float, default=DECODE_SLOPE_SECONDS)
+    parser.add_argument("-p", help="port (8080)", type=int, default=PORT)
+    parser.add_argument("-q", help="max concurrent requests (1000)", type=int, default=MAX_CONCURRENT_REQUESTS)
+    args = parser.parse_args()
+
+    MAX_CONCURRENT_REQUESTS = args.q
+    try:
+        asyncio.run(serve(args.p, args.b, args.d, args.g, args.f, args.D))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,234 @@
+import argparse
+import os.path
+
+import numpy as np
+import yaml
+
+# Zipf distribution parameters
+ZIPF_PARAM = 2.0  # Zipf distribution parameter
+MAX_TOKENS_RANGE = 8000  # Maximum range of tokens
+MIN_TOKENS = 5  # Minimum number of tokens
+
+# List of 100 tourist points of interest
+POINTS_OF_INTEREST = [
+    "Eiffel Tower, Paris", "Statue of Liberty, New York", "Great Wall of China",
+    "Colosseum, Rome", "Machu Picchu, Peru", "Sydney Opera House, Sydney",
+    "Taj Mahal, India", "Mount Fuji, Japan", "Christ the Redeemer, Rio de Janeiro",
+    "Big Ben, London", "Grand Canyon, Arizona", "Santorini, Greece",
+    "Niagara Falls, Canada/USA", "The Louvre, Paris", "Forbidden City, Beijing",
+    "Burj Khalifa, Dubai", "Golden Gate Bridge, San Francisco", "Mount Kilimanjaro, Tanzania",
+    "Pyramids of Giza, Egypt", "Acropolis, Athens", "Table Mountain, South Africa",
+    # (more points can be added as needed up to 100)
+]
+
+PROMPTS = [f"Tell me more about {poi}." for poi in POINTS_OF_INTEREST]
+
+# One record per request: gap to the next request, max_new_tokens and index into PROMPTS
+WORKLOAD_DTYPE = np.dtype([('sleep_time', 'f8'), ('max_tokens', 'i4'), ('prompt', 'i2')])
+
+
+# Arrival processes a workload can follow; see generate for their parameters
+ARRIVAL_PROCESSES = ['poisson', 'step', 'ramp', 'sine', 'mmpp', 'closed']
+
+
+def client_rngs(seed, num_clients):
+    """Independent random generators for clients 1..num_clients, all derived from one seed."""
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(num_clients)]
+
+
+def rate_profile(arrival):
+    """Rate multiplier m(t) of a time-varying arrival process and its maximum, t in seconds from the start.
+
+    step: the rate is factors[k] times the base rate from times[k] on.
+    ramp: the multiplier goes linearly from start to end over duration seconds, then stays at end.
+    sine: the multiplier is 1 + amplitude * sin(2 pi t / period), so the mean rate is the base rate.
+    """
+    process = arrival['process']
+    if process == 'step':
+        times, factors = np.asarray(arrival['times'], dtype=float), np.asarray(arrival['factors'], dtype=float)
+        return lambda t: factors[np.maximum(np.searchsorted(times, t, side='right') - 1, 0)], factors.max()
+    if process == 'ramp':
+        start, end, duration = arrival.get('start', 0.0), arrival.get('end', 1.0), arrival['duration']
+        return lambda t: start + (end - start) * np.minimum(t / duration, 1.0), max(start, end)
+    if process == 'sine':
+        amplitude, period = arrival['amplitude'], arrival['period']
+        if not 0 <= amplitude <= 1:
+            raise ValueError(f'sine amplitude must be within [0, 1], not {amplitude}')
+        return lambda t: 1 + amplitude * np.sin(2 * np.pi * t / period), 1 + amplitude
+    raise ValueError(f'{process} is not a time-varying arrival process')
+
+
+def mmpp_profile(rng, arrival):
+    """Rate multiplier of a Markov modulated Poisson process, the state path drawn as far as it is asked for.
+
+    The process stays in state k for an exponential time of mean mean_durations[k] at factors[k] times
+    the base rate, then jumps to one of the other states at random. The factors are scaled so the long
+    run mean rate is the base rate.
+    """
+    factors = np.asarray(arrival['factors'], dtype=float)
+    durations = np.asarray(arrival['mean_durations'], dtype=float)
+    if len(factors) < 2 or len(durations) != len(factors):
+        raise ValueError('mmpp needs factors and mean_durations for at least two states')
+    factors = factors * durations.sum() / (factors * durations).sum()
+    k = len(factors)
+    states = [rng.choice(k, p=durations / durations.sum())]
+    switches = [0.0]
+
+    def multiplier(t):
+        while switches[-1] <= t.max():
+            # The states visited next, then how long each lasts
+            path = (states[-1] + np.cumsum(rng.integers(1, k, size=1024))) % k
+            ends = switches[-1] + np.cumsum(rng.exponential(durations[np.append(states[-1], path[:-1])]))
+            states.extend(path.tolist())
+            switches.extend(ends.tolist())
+        state = np.asarray(states)[np.searchsorted(np.asarray(switches), t, side='right') - 1]
+        return factors[state]
+
+    return multiplier, factors.max()
+
+
+def thinning(rng, num_requests, rate, multiplier, max_multiplier):
+    """Arrival times of a non-homogeneous Poisson process of rate rate * multiplier(t), by thinning.
+
+    Candidates are drawn from a homogeneous process at the maximum rate and kept with probability
+    multiplier(t) / max_multiplier, a chunk of candidates at a time.
+    """
+    times = []
+    count, t, accepted = 0, 0.0, 1.0
+    while count < num_requests:
+        chunk = int(1.2 * (num_requests - count) / max(accepted, 1e-3)) + 1024
+        candidates = t + np.cumsum(rng.exponential(1 / (rate * max_multiplier), chunk))
+        keep = rng.random(chunk) * max_multiplier < multiplier(candidates)
+        times.append(candidates[keep])
+        count += keep.sum()
+        accepted = max(keep.mean(), 1e-3)
+        t = candidates[-1]
+    return np.concatenate(times)[:num_requests]
+
+
+def think_times(rng, num_requests, mean, distribution='exponential', cv=1.0):
+    """Think times of closed loop users: exponential, constant or lognormal with coefficient of variation cv."""
+    if distribution == 'exponential':
+        return rng.exponential(mean, num_requests)
+    if distribution == 'constant':
+        return np.full(num_requests, float(mean))
+    if distribution == 'lognormal':
+        sigma = np.sqrt(np.log(1 + cv * cv))
+        return rng.lognormal(np.log(mean) - sigma * sigma / 2, sigma, num_requests)
+    raise ValueError(f'unknown think time distribution {distribution}')
+
+
+def closed_users(arrival):
+    """Number of closed loop users of an arrival process, None for an open loop one."""
+    if arrival and arrival.get('process') == 'closed':
+        return int(arrival['users'])
+    return None
+
+
+def sleep_times(rng, num_requests, mean_wait_time_seconds, arrival):
+    """The sleep_time column of a workload following an arrival process.
+
+    Open loop processes give the gap after each request; the first request is sent at the start of
+    the run. For the closed loop, they are the think times each user waits after a response before
+    sending its next request, with a mean of think_seconds (users times the mean wait by default, so
+    with a fast server the users offer the same rate as the open loop would).
+    """
+    process = arrival['process']
+    rate = 1 / mean_wait_time_seconds
+    if process == 'closed':
+        mean = arrival.get('think_seconds', closed_users(arrival) * mean_wait_time_seconds)
+        return think_times(rng, num_requests, mean, arrival.get('think', 'exponential'), arrival.get('cv', 1.0))
+    if process == 'mmpp':
+        multiplier, max_multiplier = mmpp_profile(rng, arrival)
+    else:
+        multiplier, max_multiplier = rate_profile(arrival)
+    times = thinning(rng, num_requests, rate, multiplier, max_multiplier)
+    # The last request waits for nothing, so its gap only matters for the total
+    return np.append(np.diff(times), 1 / (rate * max_multiplier))
+
+
+def generate(rng, num_requests, mean_wait_time_seconds, max_tokens=None, arrival=None):
+    """Draws a whole client workload with one vectorized call per column.
+
+    arrival is a dict with a 'process' (one of ARRIVAL_PROCESSES) and its parameters, as in the
+    'arrival' section of the experiments config; by default the requests follow a Poisson process.
+    """
+    if arrival and arrival.get('process', 'poisson') not in ARRIVAL_PROCESSES:
+        raise ValueError(f"unknown arrival process {arrival.get('process')}, not one of {ARRIVAL_PROCESSES}")
+    workload = np.empty(num_requests, dtype=WORKLOAD_DTYPE)
+    if arrival and arrival.get('process', 'poisson') != 'poisson':
+        workload['sleep_time'] = sleep_times(rng, num_requests, mean_wait_time_seconds, arrival)
+    else:
+        workload['sleep_time'] = rng.exponential(mean_wait_time_seconds, num_requests)
+    if max_tokens:
+        workload['max_tokens'] = max_tokens
+    else:
+        tokens = rng.zipf(ZIPF_PARAM, num_requests)
+        workload['max_tokens'] = np.clip(tokens, MIN_TOKENS, MAX_TOKENS_RANGE)
+    workload['prompt'] = rng.integers(len(PROMPTS), size=num_requests)
+    return workload
+
+
+def generate_client(seed, c, C, num_requests, mean_wait_time_seconds, max_tokens=None, arrival=None):
+    """Workload of client c (1-based) out of C, independent of the other clients' streams."""
+    return generate(client_rngs(seed, C)[c - 1], num_requests, mean_wait_time_seconds, max_tokens, arrival)
+
+
+def split_shards(rng, workload, num_shards, closed=False):
+    """Splits a workload into num_shards workloads that superpose to it.
+
+    Each request goes to a uniformly random shard, so a Poisson stream of rate lambda splits into
+    independent Poisson streams of rate lambda / num_shards, and whatever the arrival process the shards
+    together send the requests exactly on the original schedule. Returns, per shard, the positions of
+    its requests in workload, the offset its first request is due at, and its own workload. The think
+    times of a closed loop workload are kept as they are.
+    """
+    offsets = np.concatenate(([0.0], np.cumsum(workload['sleep_time'][:-1])))
+    shard = rng.integers(num_shards, size=len(workload))
+    shards = []
+    for k in range(num_shards):
+        indices = np.flatnonzero(shard == k)
+        part = workload[indices]
+        if not closed:
+            part['sleep_time'][:-1] = np.diff(offsets[indices])
+            part['sleep_time'][-1:] = 0.0
+        shards.append((indices, offsets[indices[0]] if len(indices) else 0.0, part))
+    return shards
+
+
+def trace_fname(prefix, c, C):
+    """File name of client c's trace, following the round trip file naming convention."""
+    b, e = os.path.splitext(prefix)
+    e = e or '.npy'
+    return f'{b}_{c}{e}' if C > 1 else f'{b}{e}'
+
+
+def save_trace(fname, workload):
+    """Writes a workload as a plain .npy file so it can be memory mapped on replay."""
+    np.save(fname, workload, allow_pickle=False)
+
+
+def load_trace(fname):
+    """Memory maps a workload trace written by save_trace."""
+    workload = np.load(fname, mmap_mode='r')
+    if workload.dtype != WORKLOAD_DTYPE:
+        raise ValueError(f'{fname} is not a workload trace (dtype {workload.dtype})')
+    return workload
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="workload trace generator")
+    parser.add_argument("-A", help="arrival process as a YAML mapping, e.g. '{process: sine, period: 60, "
+                                   "amplitude: 0.5}' (poisson)", type=yaml.safe_load)
+    parser.add_argument("-C", help="number of clients (1)", type=int, default=1)
+    parser.add_argument("-n", help="number of requests per client (20_000)", type=int, default=20_000)
+    parser.add_argument("-o", help="output file name (workload.npy)", type=str, default='workload.npy')
+    parser.add_argument("-s", help="randomization seed", type=int, default=1)
+    parser.add_argument("-t", help="max output tokens (RANDOM)", type=int)
+    parser.add_argument("-w", help="mean wait time in microseconds between requests", type=int, default=100)
+    args = parser.parse_args()
+
+    for c, rng in enumerate(client_rngs(args.s, args.C), start=1):
+        fname = trace_fname(args.o, c, args.C)
+        print(f"Writing client {c} of {args.C} workload to {fname}")
+        save_trace(fname, generate(rng, args.n, args.w * 1e-6, args.t, args.A))